@@ -0,0 +1,308 @@
+from diagnostics import run_diagnostics
+import os
+import json
+import shutil
+import platform
+import time
+import numpy as np
+import xarray as xr
+
+##########################################################
+# Benchmark suite for the ARM/ASR diagnostics package.
+
+# This script writes synthetic DP-EAMxx (horiz_avg), E3SM SCM and OBS/LES
+#  files of a given size, runs the full diagnostics package on them and
+#  records the wall time of each stage (loading, variable classification,
+#  rendering of all plots, web pages and tar file) to a JSON file, with the
+#  render time of the profile, time series, time-height and diurnal plots
+#  summed over the plots and workers under cpu_<kind>.  Use it to check the effect of changes to the
+#  package, or of settings such as n_workers and lazy_load, on run time.
+
+# Run from any directory with:  python benchmark_diagnostics.py
+
+##########################################################
+# BEGIN: USER DEFINED SETTINGS
+
+# Where the synthetic input files and diagnostics output are written.
+#  Everything in this directory is overwritten by the benchmark.
+benchmark_dir = "/tmp/iop_diagnostics_benchmark"
+
+# JSON file with the benchmark results
+results_file = os.path.join(benchmark_dir, "benchmark_results.json")
+
+# Configurations to benchmark.  Each configuration is run once with:
+#   model_format = "dpxx" (DP-EAMxx horiz_avg output) or "scm" (E3SM SCM output)
+#   n_datasets   = number of model datasets
+#   n_obs        = number of OBS/LES datasets (added after the model datasets)
+#   n_vars       = number of 3D variables; the same number of 2D variables is added
+#   n_time       = number of time steps
+#   n_lev        = number of vertical levels
+#   steps_per_day = output frequency of the model datasets
+configurations = [
+    {"model_format": "dpxx", "n_datasets": 2, "n_obs": 1, "n_vars": 5, "n_time": 96*4, "n_lev": 72, "steps_per_day": 96},
+    {"model_format": "scm", "n_datasets": 2, "n_obs": 1, "n_vars": 5, "n_time": 96*4, "n_lev": 72, "steps_per_day": 96},
+    {"model_format": "dpxx", "n_datasets": 4, "n_obs": 1, "n_vars": 5, "n_time": 96*4, "n_lev": 72, "steps_per_day": 96},
+    {"model_format": "dpxx", "n_datasets": 2, "n_obs": 1, "n_vars": 20, "n_time": 96*4, "n_lev": 72, "steps_per_day": 96},
+    {"model_format": "dpxx", "n_datasets": 2, "n_obs": 1, "n_vars": 5, "n_time": 96*16, "n_lev": 128, "steps_per_day": 96},
+]
+
+# Diagnostics settings used for every configuration
+height_cord = "z"
+do_timeheight = True
+do_diurnal_composites = True
+n_workers = 1
+lazy_load = False
+time_height_renderer = "contourf"
+decimate = True
+report_mode = "static"
+archive_compression = None
+
+# END: USER DEFINED SETTINGS
+##########################################################
+##########################################################
+
+def _vertical_grid(n_lev):
+    """
+    Hybrid coefficients and a standard-atmosphere height for n_lev levels
+    between 10 and 1000 hPa, ordered from the model top to the surface.
+
+    Returns:
+        dict: lev, ilev, hyam, hybm, hyai, hybi, p_mid (hPa) and z_mid (m).
+    """
+    ilev = np.linspace(10.0, 1000.0, n_lev + 1)
+    lev = 0.5 * (ilev[1:] + ilev[:-1])
+    hybi = ((ilev - ilev[0]) / (ilev[-1] - ilev[0]))**2
+    hyai = (ilev - hybi * 1000.0) / 1000.0
+    hybm = 0.5 * (hybi[1:] + hybi[:-1])
+    hyam = 0.5 * (hyai[1:] + hyai[:-1])
+    z_mid = 7000.0 * np.log(1013.25 / lev)
+    return {"lev": lev, "ilev": ilev, "hyam": hyam, "hybm": hybm,
+            "hyai": hyai, "hybi": hybi, "p_mid": lev, "z_mid": z_mid}
+
+def _synthetic_fields(rng, time_vals, n_vars, n_lev, seed_offset=0.0):
+    """
+    Smooth synthetic 3D (time, lev) and 2D (time) fields with a diurnal
+    cycle, a vertical structure and some noise.
+    """
+    diurnal = np.sin(2.0 * np.pi * time_vals)
+    levels = np.linspace(0.0, 1.0, n_lev)
+    fields_3d = []
+    fields_2d = []
+    for i in range(n_vars):
+        profile = (i + 1) * np.exp(-((levels - (i % 5 + 1) / 6.0) / 0.2)**2)
+        fields_3d.append(profile[None, :] * (1.0 + 0.3 * diurnal[:, None] + seed_offset)
+                         + 0.05 * rng.standard_normal((len(time_vals), n_lev)))
+        fields_2d.append((i + 1) * (1.0 + 0.5 * diurnal + seed_offset)
+                         + 0.1 * rng.standard_normal(len(time_vals)))
+    return fields_3d, fields_2d
+
+def make_dpxx_dataset(n_vars, n_time, n_lev, steps_per_day=96, start_date="2013-07-21 00:00:00", seed=0):
+    """
+    Make a synthetic DP-EAMxx horizontally averaged (horiz_avg) dataset.
+
+    Parameters:
+        n_vars (int): Number of 3D variables; the same number of 2D variables is added.
+        n_time (int): Number of time steps.
+        n_lev (int): Number of vertical levels.
+        steps_per_day (int): Output frequency.
+        start_date (str): Reference date of the time axis.
+        seed (int): Seed of the random noise.
+
+    Returns:
+        xarray.Dataset: The synthetic dataset.
+    """
+    rng = np.random.default_rng(seed)
+    grid = _vertical_grid(n_lev)
+    time_vals = np.arange(n_time) / steps_per_day
+    ds = xr.Dataset(coords={"time": ("time", time_vals, {"units": f"days since {start_date}"}),
+                            "lev": ("lev", grid["lev"]), "ilev": ("ilev", grid["ilev"])})
+    ds["hyam"] = ("lev", grid["hyam"])
+    ds["hybm"] = ("lev", grid["hybm"])
+    ds["z_mid_horiz_avg"] = (("time", "lev"), np.broadcast_to(grid["z_mid"], (n_time, n_lev)).copy(), {"units": "m"})
+    ds["ps_horiz_avg"] = ("time", 101325.0 + 100.0 * np.sin(2.0 * np.pi * time_vals), {"units": "Pa"})
+    fields_3d, fields_2d = _synthetic_fields(rng, time_vals, n_vars, n_lev, 0.01 * seed)
+    for i in range(n_vars):
+        ds[f"var3d_{i:03d}_horiz_avg"] = (("time", "lev"), fields_3d[i],
+                                          {"units": "K", "long_name": f"Synthetic 3D variable {i}"})
+        ds[f"var2d_{i:03d}_horiz_avg"] = ("time", fields_2d[i],
+                                          {"units": "W/m2", "long_name": f"Synthetic 2D variable {i}"})
+    return ds
+
+def make_scm_dataset(n_vars, n_time, n_lev, steps_per_day=96, start_date="2013-07-21 00:00:00", seed=0):
+    """
+    Make a synthetic E3SM SCM dataset with Z3, PS, hybrid coefficients,
+    PRECC/PRECL (so that PRECT is derived) and a singleton ncol dimension.
+
+    Parameters:
+        See make_dpxx_dataset.
+
+    Returns:
+        xarray.Dataset: The synthetic dataset.
+    """
+    rng = np.random.default_rng(seed)
+    grid = _vertical_grid(n_lev)
+    time_vals = np.arange(n_time) / steps_per_day
+    ds = xr.Dataset(coords={"time": ("time", time_vals, {"units": f"days since {start_date}"}),
+                            "lev": ("lev", grid["lev"]), "ilev": ("ilev", grid["ilev"])})
+    for name in ["hyam", "hybm"]:
+        ds[name] = ("lev", grid[name])
+    for name in ["hyai", "hybi"]:
+        ds[name] = ("ilev", grid[name])
+    ds["Z3"] = (("time", "lev", "ncol"), np.broadcast_to(grid["z_mid"][None, :, None], (n_time, n_lev, 1)).copy(), {"units": "m"})
+    ds["PS"] = (("time", "ncol"), (101325.0 + 100.0 * np.sin(2.0 * np.pi * time_vals))[:, None], {"units": "Pa"})
+    rain = np.maximum(np.sin(2.0 * np.pi * time_vals), 0.0)[:, None]
+    ds["PRECC"] = (("time", "ncol"), 2e-8 * rain, {"units": "m/s", "long_name": "Convective precipitation rate"})
+    ds["PRECL"] = (("time", "ncol"), 1e-8 * rain, {"units": "m/s", "long_name": "Large-scale precipitation rate"})
+    fields_3d, fields_2d = _synthetic_fields(rng, time_vals, n_vars, n_lev, 0.01 * seed)
+    for i in range(n_vars):
+        ds[f"VAR3D{i:03d}"] = (("time", "lev", "ncol"), fields_3d[i][:, :, None],
+                               {"units": "K", "long_name": f"Synthetic 3D variable {i}"})
+        ds[f"VAR2D{i:03d}"] = (("time", "ncol"), fields_2d[i][:, None],
+                               {"units": "W/m2", "long_name": f"Synthetic 2D variable {i}"})
+    return ds
+
+def make_obs_dataset(n_vars, n_time, n_lev, steps_per_day=24, start_date="2013-07-21 00:00:00", seed=0,
+                     model_format="dpxx"):
+    """
+    Make a synthetic OBS/LES dataset on its own vertical grid, with z_mid and
+    p_mid_obs and variable names that match the model datasets.
+
+    Parameters:
+        See make_dpxx_dataset.
+        model_format (str): "dpxx" or "scm"; selects the variable names.
+
+    Returns:
+        xarray.Dataset: The synthetic dataset.
+    """
+    rng = np.random.default_rng(seed)
+    grid = _vertical_grid(n_lev)
+    time_vals = np.arange(n_time) / steps_per_day
+    ds = xr.Dataset(coords={"time": ("time", time_vals, {"units": f"days since {start_date}"}),
+                            "lev": ("lev", grid["lev"])})
+    ds["z_mid"] = (("time", "lev"), np.broadcast_to(grid["z_mid"], (n_time, n_lev)).copy(), {"units": "m"})
+    ds["p_mid_obs"] = ("lev", grid["p_mid"], {"units": "hPa"})
+    fields_3d, fields_2d = _synthetic_fields(rng, time_vals, n_vars, n_lev, 0.01 * seed)
+    for i in range(n_vars):
+        name_3d = f"var3d_{i:03d}_horiz_avg" if model_format == "dpxx" else f"VAR3D{i:03d}"
+        name_2d = f"var2d_{i:03d}_horiz_avg" if model_format == "dpxx" else f"VAR2D{i:03d}"
+        ds[name_3d] = (("time", "lev"), fields_3d[i], {"units": "K"})
+        ds[name_2d] = ("time", fields_2d[i], {"units": "W/m2"})
+    return ds
+
+def write_benchmark_datasets(data_dir, config):
+    """
+    Write the synthetic files of one configuration.
+
+    Returns:
+        list: Dataset dictionaries in the format expected by run_diagnostics.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    make_model = make_dpxx_dataset if config["model_format"] == "dpxx" else make_scm_dataset
+    colors = ["blue", "green", "red", "orange", "purple", "brown", "cyan", "olive"]
+    datasets = []
+    for i in range(config["n_datasets"]):
+        filename = os.path.join(data_dir, f"model_{i:02d}.nc")
+        make_model(config["n_vars"], config["n_time"], config["n_lev"],
+                   config["steps_per_day"], seed=i).to_netcdf(filename)
+        datasets.append({"filename": filename, "short_id": f"Model {i}",
+                         "line_color": colors[i % len(colors)], "line_style": "-"})
+
+    # Observations are hourly and cover the same period as the model datasets
+    n_days = config["n_time"] / config["steps_per_day"]
+    for i in range(config["n_obs"]):
+        filename = os.path.join(data_dir, f"obs_{i:02d}.nc")
+        make_obs_dataset(config["n_vars"], int(n_days * 24), max(config["n_lev"] // 2, 2), 24,
+                         seed=100 + i, model_format=config["model_format"]).to_netcdf(filename)
+        datasets.append({"filename": filename, "short_id": "OBS" if i == 0 else f"OBS {i}",
+                         "line_color": "gray", "line_style": "--"})
+    return datasets
+
+def run_benchmark(config, work_dir):
+    """
+    Write the synthetic files of one configuration, run the diagnostics
+    package on them and time each stage.
+
+    Parameters:
+        config (dict): One entry of configurations.
+        work_dir (str): Directory for the input files and output of this run.
+
+    Returns:
+        dict: The configuration, the wall time of each stage in seconds, the
+        total wall time and the time spent writing the input files.
+    """
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+
+    start = time.perf_counter()
+    datasets = write_benchmark_datasets(os.path.join(work_dir, "data"), config)
+    generate_time = time.perf_counter() - start
+
+    n_days = config["n_time"] / config["steps_per_day"]
+    profile_time_s = [float(day) for day in range(int(n_days))]
+    profile_time_e = [day + 1.0 for day in profile_time_s]
+
+    timings = {}
+    start = time.perf_counter()
+    run_diagnostics(
+        os.path.join(work_dir, "output"),
+        "benchmark",
+        datasets,
+        profile_time_s,
+        profile_time_e,
+        do_timeheight,
+        height_cord,
+        None,
+        None,
+        2,
+        None,
+        None,
+        None,
+        None,
+        do_diurnal_composites=do_diurnal_composites,
+        diurnal_start_day=0,
+        diurnal_end_day=n_days,
+        n_workers=n_workers,
+        lazy_load=lazy_load,
+        time_height_renderer=time_height_renderer,
+        decimate=decimate,
+        report_mode=report_mode,
+        archive_compression=archive_compression,
+        timings=timings
+    )
+    total_time = time.perf_counter() - start
+
+    return {"config": config, "generate_time": generate_time,
+            "total_time": total_time, "stages": timings}
+
+def main():
+    # run_diagnostics copies the logos relative to the package directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    os.makedirs(benchmark_dir, exist_ok=True)
+
+    results = []
+    for i, config in enumerate(configurations):
+        print(f"Benchmark {i + 1} of {len(configurations)}: {config}")
+        record = run_benchmark(config, os.path.join(benchmark_dir, f"config_{i:02d}"))
+        results.append(record)
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in record["stages"].items())
+        print(f"Total {record['total_time']:.2f}s ({stages})")
+
+    summary = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "xarray": xr.__version__,
+        "cpu_count": os.cpu_count(),
+        "settings": {"height_cord": height_cord, "do_timeheight": do_timeheight,
+                     "do_diurnal_composites": do_diurnal_composites,
+                     "n_workers": n_workers, "lazy_load": lazy_load,
+                     "time_height_renderer": time_height_renderer, "decimate": decimate,
+                     "report_mode": report_mode, "archive_compression": archive_compression},
+        "results": results
+    }
+    with open(results_file, "w") as f:
+        json.dump(summary, f, indent=2)
+    print(f"Wrote benchmark results to {results_file}")
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,349 @@ import os
 import numpy as np
 import xarray as xr
 import matplotlib.pyplot as plt
+from matplotlib.colors import to_hex
 import tarfile
+import queue
+import threading
+import hashlib
+import base64
+import json
+import csv
+import glob
+import ast
 from jinja2 import Template
 from scipy.interpolate import interp1d
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import sys
+import time
+import functools
+from contextlib import contextmanager, ExitStack
+import tracemalloc
+
+try:
+    import dask  # enables chunked lazy loading
+    HAS_DASK = True
+except ImportError:
+    HAS_DASK = False
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+try:
+    import netCDF4  # (reads file headers for the OBS/LES catalog)
+    HAS_NETCDF4 = True
+except ImportError:
+    HAS_NETCDF4 = False
+
+#################################
+###### Instrumentation
+
+# Profiling state; None when profiling is disabled, otherwise a dict with the
+#  finished 'records' and the 'stack' of open stages (see enable_profiling).
+_profiler = None
+
+# Hooks called at the start of every instrumented stage (see add_profile_hook)
+_profile_hooks = []
+
+def enable_profiling(memory=False):
+    """
+    Start recording the wall time (and peak memory) of instrumented stages.
+
+    Parameters:
+        memory (bool): Also record the peak memory of each stage with tracemalloc.
+            Tracing every allocation makes plotting several times slower.
+    """
+    global _profiler
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _profiler = {"records": [], "stack": [], "memory": memory}
+
+def disable_profiling():
+    """
+    Stop profiling.
+
+    Returns:
+        list: The records of every finished stage (see instrument).
+    """
+    global _profiler
+    if _profiler is None:
+        return []
+    # Exit the hooks of stages left open by an exception
+    for entry in reversed(_profiler["stack"]):
+        entry["hooks"].close()
+    records = _profiler["records"]
+    if _profiler["memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _profiler = None
+    return records
+
+def add_profile_hook(hook):
+    """
+    Register a hook that is called at the start of every instrumented stage
+    while profiling is enabled, i.e. to attach cProfile to individual plots.
+
+    Parameters:
+        hook (callable): Called as hook(stage, variable).  It returns a context
+            manager that is active for the duration of the stage, or None to
+            skip the stage.
+    """
+    _profile_hooks.append(hook)
+
+def remove_profile_hook(hook):
+    """
+    Remove a hook registered with add_profile_hook.
+    """
+    if hook in _profile_hooks:
+        _profile_hooks.remove(hook)
+
+PLOT_STAGES = ('profile', 'timeseries', 'time_height', 'diurnal1d', 'diurnal2d')
+
+def cprofile_hook(profile_dir, stages=PLOT_STAGES):
+    """
+    Make a hook that runs cProfile on each instance of the given stages and
+    writes the statistics to profile_dir/<stage>_<variable>_<n>.prof.
+    The files can be read with pstats or snakeviz.
+
+    Parameters:
+        profile_dir (str): Directory for the statistics files.
+        stages (tuple): Stages to profile; by default each plot.
+
+    Returns:
+        callable: A hook for add_profile_hook.
+    """
+    import cProfile
+
+    counter = {}
+
+    @contextmanager
+    def run_cprofile(stage, variable):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            name = f"{stage}_{variable}" if variable is not None else stage
+            counter[name] = counter.get(name, 0) + 1
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, f"{name}_{os.getpid()}_{counter[name]}.prof"))
+
+    def hook(stage, variable):
+        return run_cprofile(stage, variable) if stage in stages else None
+
+    return hook
+
+def _begin_stage(stage=None, variable=None):
+    entry = {"stage": stage, "variable": variable, "start": time.perf_counter(), "peak": 0, "hooks": ExitStack()}
+    if _profiler is None:
+        return entry
+    if _profiler["memory"]:
+        # The peak so far belongs to the enclosing stages
+        peak = tracemalloc.get_traced_memory()[1]
+        for outer in _profiler["stack"]:
+            outer["peak"] = max(outer["peak"], peak)
+        tracemalloc.reset_peak()
+    _profiler["stack"].append(entry)
+    if stage is not None:
+        for hook in _profile_hooks:
+            context = hook(stage, variable)
+            if context is not None:
+                entry["hooks"].enter_context(context)
+    return entry
+
+def _end_stage(entry, stage=None, timings=None):
+    # Finish a stage started by _begin_stage; stage names the entry if it was
+    #  started without one.  Returns the wall time in seconds.
+    elapsed = time.perf_counter() - entry["start"]
+    stage = stage if stage is not None else entry["stage"]
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + elapsed
+    if _profiler is None or entry not in _profiler["stack"]:
+        return elapsed
+
+    entry["hooks"].close()
+    stack = _profiler["stack"]
+    stack.remove(entry)
+    record = {"stage": stage, "variable": entry["variable"], "wall_time": elapsed,
+              "pid": os.getpid()}
+    if _profiler["memory"]:
+        peak = max(entry["peak"], tracemalloc.get_traced_memory()[1])
+        for outer in stack:
+            outer["peak"] = max(outer["peak"], peak)
+        record["peak_memory_mb"] = peak / 1e6
+    _profiler["records"].append(record)
+    return elapsed
+
+def _next_stage(entry, stage, timings=None):
+    # Finish the current top-level stage of run_diagnostics and start the next one
+    _end_stage(entry, stage, timings)
+    return _begin_stage()
+
+@contextmanager
+def instrument(stage, variable=None):
+    """
+    Context manager that records the wall time and peak memory of a stage
+    while profiling is enabled (see enable_profiling); otherwise it does nothing.
+
+        with instrument("savefig", var_name):
+            plt.savefig(outfile)
+    """
+    entry = _begin_stage(stage, variable) if _profiler is not None else None
+    try:
+        yield
+    finally:
+        if entry is not None:
+            _end_stage(entry)
+
+def instrumented(stage, variable_arg=None):
+    """
+    Decorator that runs a function inside instrument(stage, variable), where
+    variable is the positional argument at index variable_arg (if given).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            variable = args[variable_arg] if variable_arg is not None and len(args) > variable_arg else None
+            with instrument(stage, variable):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def summarize_profile(records):
+    """
+    Aggregate profile records by stage and by variable.
+
+    Returns:
+        dict: 'stages' (stage -> count, wall_time and max_peak_memory_mb) and
+            'variables' (variable -> stage -> wall_time).  Times of nested
+            stages are also included in the stages that enclose them.
+    """
+    stages = {}
+    variables = {}
+    for record in records:
+        summary = stages.setdefault(record["stage"], {"count": 0, "wall_time": 0.0, "max_peak_memory_mb": None})
+        summary["count"] += 1
+        summary["wall_time"] += record["wall_time"]
+        if record.get("peak_memory_mb") is not None:
+            summary["max_peak_memory_mb"] = max(summary["max_peak_memory_mb"] or 0.0, record["peak_memory_mb"])
+        if record["variable"] is not None:
+            per_stage = variables.setdefault(record["variable"], {})
+            per_stage[record["stage"]] = per_stage.get(record["stage"], 0.0) + record["wall_time"]
+    return {"stages": stages, "variables": variables}
+
+def write_profile_report(records, report_dir):
+    """
+    Write the profile records to profile.json and a profile.html page.
+
+    Parameters:
+        records (list): Records returned by disable_profiling.
+        report_dir (str): Output directory.
+    """
+    summary = summarize_profile(records)
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+        max_rss = max_rss / 1e3 if sys.platform == "darwin" else max_rss  # bytes on macOS, kB elsewhere
+    except ImportError:
+        max_rss = None
+
+    with open(os.path.join(report_dir, "profile.json"), "w") as f:
+        json.dump({"max_rss_mb": max_rss, "stages": summary["stages"],
+                   "variables": summary["variables"], "records": records}, f, indent=1)
+
+    stages = sorted(summary["stages"].items(), key=lambda item: -item[1]["wall_time"])
+    plot_stages = [stage for stage in PLOT_STAGES if stage in summary["stages"]]
+    other_stages = sorted({stage for per_stage in summary["variables"].values() for stage in per_stage}
+                          - set(plot_stages))
+    variables = [(var, per_stage, sum(per_stage.get(stage, 0.0) for stage in plot_stages))
+                 for var, per_stage in summary["variables"].items()]
+    variables.sort(key=lambda item: -item[2])
+
+    html = Template("""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <title>Diagnostics Profile</title>
+        <style>
+            table { border-collapse: collapse; margin-bottom: 30px; }
+            th, td { border: 1px solid #ccc; padding: 4px 10px; text-align: right; }
+            th:first-child, td:first-child { text-align: left; }
+        </style>
+    </head>
+    <body>
+        <h1>Diagnostics Profile</h1>
+        {% if max_rss is not none %}<p>Maximum resident memory of the main process: {{ "%.1f" | format(max_rss) }} MB</p>{% endif %}
+        <h2>Stages</h2>
+        <p>Times of nested stages (i.e. savefig within a plot) are also included in the stages that enclose them.</p>
+        <table>
+            <tr><th>Stage</th><th>Count</th><th>Wall time (s)</th><th>Peak memory (MB)</th></tr>
+            {% for stage, s in stages %}
+            <tr><td>{{ stage }}</td><td>{{ s.count }}</td><td>{{ "%.3f" | format(s.wall_time) }}</td>
+                <td>{% if s.max_peak_memory_mb is not none %}{{ "%.1f" | format(s.max_peak_memory_mb) }}{% endif %}</td></tr>
+            {% endfor %}
+        </table>
+        <h2>Variables</h2>
+        <table>
+            <tr><th>Variable</th><th>Plots (s)</th>{% for stage in plot_stages + other_stages %}<th>{{ stage }} (s)</th>{% endfor %}</tr>
+            {% for var, per_stage, plot_time in variables %}
+            <tr><td>{{ var }}</td>
+                <td>{{ "%.3f" | format(plot_time) }}</td>
+                {% for stage in plot_stages + other_stages %}
+                <td>{% if stage in per_stage %}{{ "%.3f" | format(per_stage[stage]) }}{% endif %}</td>
+                {% endfor %}
+            </tr>
+            {% endfor %}
+        </table>
+    </body>
+    </html>
+    """).render(stages=stages, variables=variables, plot_stages=plot_stages,
+                other_stages=other_stages, max_rss=max_rss)
+    with open(os.path.join(report_dir, "profile.html"), "w") as f:
+        f.write(html)
+
+# Cache of vertical coordinates shared by the profile, time-height and diurnal
+#  stages.  Keys start with id(ds); entries are removed by clear_dataset_caches
+#  when the datasets are closed.  Cached coordinates must not be modified in place.
+_y_coord_cache = {}
+
+def clear_y_coord_cache(ds=None):
+    """
+    Clear cached vertical coordinates.
+
+    Parameters:
+        ds (xarray.Dataset, optional): Only clear the entries of this dataset.
+            If None the whole cache is cleared.
+    """
+    if ds is None:
+        _y_coord_cache.clear()
+        return
+    for key in [key for key in _y_coord_cache if key[0] == id(ds)]:
+        del _y_coord_cache[key]
+
+def _cached(key, func):
+    if key not in _y_coord_cache:
+        value = func()
+        # Evaluate dask-backed coordinates once rather than on every use
+        if isinstance(value, xr.DataArray) and value.chunks is not None:
+            value = value.compute()
+        _y_coord_cache[key] = value
+    return _y_coord_cache[key]
 
 def compute_y_coord(ds, time_indices, height_cord, var_name):
     """
     Compute the vertical coordinate (y_coord) for a dataset.
 
+    Results are memoized per dataset, time window, height_cord and vertical
+    dimension of the variable (see clear_y_coord_cache).
+
     Parameters:
         ds (xarray.Dataset): Dataset containing the variables.
         time_indices (numpy.ndarray): Indices of the time range to average over.
@@ -21,6 +354,17 @@ def compute_y_coord(ds, time_indices, height_cord, var_name):
     Returns:
         numpy.ndarray: The computed y-coordinate.
     """
+    time_indices = np.asarray(time_indices)
+    var_dims = ds[var_name].dims
+    window_key = (time_indices.dtype.str, time_indices.tobytes())
+    key = (id(ds), "y_coord", height_cord, "lev" in var_dims, "ilev" in var_dims) + window_key
+
+    if key in _y_coord_cache:
+        return _y_coord_cache[key]
+    with instrument("y_coord", var_name):
+        return _cached(key, lambda: _compute_y_coord(ds, time_indices, height_cord, var_name, window_key))
+
+def _compute_y_coord(ds, time_indices, height_cord, var_name, window_key):
     if height_cord == "z":
         if height_cord == "z":
             if "z_mid" in ds.data_vars:
@@ -33,9 +377,11 @@ def compute_y_coord(ds, time_indices, height_cord, var_name):
                 raise ValueError("Cannot determine height coordinates ('z_mid', 'z_mid_horiz_avg', or 'Z3').")
 
             # Compute y_coord and subtract surface elevation
-            y_coord = ds[height_var].isel(time=time_indices).mean(dim="time",skipna=True).squeeze()
-            surface_elevation = ds[height_var].isel(lev=-1).mean(dim="time",skipna=True).squeeze() - 10.  # Surface elevation from highest index level
-            y_coord -= surface_elevation
+            y_coord = _cached((id(ds), "height_mean", height_var) + window_key,
+                              lambda: ds[height_var].isel(time=time_indices).mean(dim="time",skipna=True).squeeze())
+            surface_elevation = _cached((id(ds), "surface_elevation", height_var),
+                                        lambda: ds[height_var].isel(lev=-1).mean(dim="time",skipna=True).squeeze() - 10.)  # Surface elevation from highest index level
+            y_coord = y_coord - surface_elevation
 
         # If variable has dimensions of ilev then we need to interpolate the height coordinate to the ilev grid
         if "ilev" in ds[var_name].dims:
@@ -49,7 +395,8 @@ def compute_y_coord(ds, time_indices, height_cord, var_name):
         ps_var = 'PS' if 'PS' in ds.data_vars else 'ps' if 'ps' in ds.data_vars else 'ps_horiz_avg' if 'ps_horiz_avg' in ds.data_vars else None
         model = 'hyam' in ds.data_vars and 'hybm' in ds.data_vars
         if ps_var and model:
-            ps_avg = ds[ps_var].isel(time=time_indices).mean(dim="time",skipna=True) / 100.0  # Convert to hPa
+            ps_avg = _cached((id(ds), "ps_mean", ps_var) + window_key,
+                             lambda: ds[ps_var].isel(time=time_indices).mean(dim="time",skipna=True) / 100.0)  # Convert to hPa
             if "lev" in ds[var_name].dims and all(var in ds for var in ['hyam', 'hybm']):
                 hyam = ds['hyam']
                 hybm = ds['hybm']
@@ -78,103 +425,53 @@ def compute_y_coord(ds, time_indices, height_cord, var_name):
 
     return y_coord
 
-def plot_time_height_panel_grid(
-    var_name,
-    datasets,
-    short_ids,
-    time_offset,
-    height_cord,
-    output_subdir,
-    labelsize,
-    ticksize,
-    usercmap,
-    start_time,
-    end_time,
-    max_height,
-    is_diurnal=False,
-    time_labels=None,
-    title_suffix=""
-):
-    import matplotlib.pyplot as plt
-    import numpy as np
-    import os
+def time_height_panel_data(var_name, datasets, time_offset, height_cord, start_time, end_time, max_height,
+                           is_diurnal=False, dataset_indices=None, window_table=None):
+    """
+    Collect the panels of a time-height (or 2D diurnal composite) plot.
 
+    Returns:
+        tuple or None: (panels, levels) where panels is a list of (dataset
+            index, times, data (time, level), vertical coordinate) below
+            max_height and levels are the 20 color levels spanning all panels;
+            None if no dataset has valid data.
+    """
     global_min, global_max = float('inf'), float('-inf')
     valid_datasets = []
 
     for idx, ds in enumerate(datasets):
         if var_name not in ds:
             continue
+        if dataset_indices is not None and idx not in dataset_indices:
+            continue
 
         if is_diurnal:
-            composite, hour_labels, success, ndim, stime, etime = compute_diurnal_composite(
-                ds, var_name, idx, time_offset, start_time, end_time)
-            if not success or ndim != 2:
-                continue
-            time_vals = hour_labels
-            time_indices = np.where((time_vals >= 0) & (time_vals <= 24))[0]
-            data = composite
-            # height levels should come from lev or ilev (assumes consistent across time)
-            if 'lev' in ds[var_name].dims:
-                lev_dim = 'lev'
-            elif 'ilev' in ds[var_name].dims:
-                lev_dim = 'ilev'
-            else:
+            product = diurnal_product(ds, idx, var_name, time_offset, start_time, end_time, height_cord)
+            if product is None or product[0].ndim != 2:
                 continue
-
-            y_coord = compute_y_coord(ds, time_indices, height_cord, var_name)
-
-            if height_cord == "z":
-                y_min, y_max = (0, max_height) if max_height is not None else (y_coord.min(), y_coord.max())
-            elif height_cord == "p":
-                y_min, y_max = (max_height, y_coord.max()) if max_height is not None else (y_coord.min(), y_coord.max())
-
-            valid_lev_idx = np.where((y_coord >= y_min) & (y_coord <= y_max))[0]
-
-            if max_height is not None:
-                if height_cord == "z":
-                    valid_idx = np.where(y_coord <= max_height)[0]
-                else:
-                    valid_idx = np.where(y_coord >= max_height)[0]
-                data = data[:, valid_lev_idx]
-
-            global_min = min(global_min, float(data.min()))
-            global_max = max(global_max, float(data.max()))
-            valid_datasets.append((idx, time_vals, data, y_coord[valid_lev_idx]))
-
+            data, time_vals, _, _, y_coord = product
         else:
-            time_vals = ds['time'].values - time_offset[idx]
-
-            stime = start_time if start_time is not None else time_vals[0]
-            etime = end_time if end_time is not None else time_vals[-1]
-
-            time_indices = np.where((time_vals >= stime) & (time_vals <= etime))[0]
-            time_vals = time_vals[time_indices]
-            if len(time_indices) == 0:
+            product = time_height_product(ds, idx, var_name, time_offset, height_cord,
+                                          start_time, end_time, window_table)
+            if product is None:
                 continue
-            y_coord = compute_y_coord(ds, time_indices, height_cord, var_name)
-
-            if height_cord == "z":
-                y_min, y_max = (0, max_height) if max_height is not None else (y_coord.min(), y_coord.max())
-            elif height_cord == "p":
-                y_min, y_max = (max_height, y_coord.max()) if max_height is not None else (y_coord.min(), y_coord.max())
+            time_vals, y_coord, data = product
 
-            valid_lev_idx = np.where((y_coord >= y_min) & (y_coord <= y_max))[0]
+        if height_cord == "z":
+            y_min, y_max = (0, max_height) if max_height is not None else (y_coord.min(), y_coord.max())
+        elif height_cord == "p":
+            y_min, y_max = (max_height, y_coord.max()) if max_height is not None else (y_coord.min(), y_coord.max())
 
-            data = ds[var_name].isel(time=time_indices)
-            if "lev" in ds[var_name].dims:
-                data = data.isel(lev=valid_lev_idx)
-            elif "ilev" in ds[var_name].dims:
-                data = data.isel(ilev=valid_lev_idx)
-            if 'ncol' in data.dims:
-                data = data.mean(dim="ncol",skipna=True)
+        valid_lev_idx = np.where((y_coord >= y_min) & (y_coord <= y_max))[0]
+        data = data[:, valid_lev_idx]
+        if data.size == 0:
+            continue
 
-            global_min = min(global_min, float(data.min().values))
-            global_max = max(global_max, float(data.max().values))
-            valid_datasets.append((idx, time_vals, data, y_coord[valid_lev_idx]))
+        global_min = min(global_min, float(np.nanmin(data)))
+        global_max = max(global_max, float(np.nanmax(data)))
+        valid_datasets.append((idx, time_vals, data, y_coord[valid_lev_idx]))
 
     if not valid_datasets:
-        print(f"Warning: No valid data found for {var_name}. Skipping.")
         return None
 
     if global_min == global_max:
@@ -182,6 +479,41 @@ def plot_time_height_panel_grid(
         global_max += 0.01 * abs(global_max) if global_max != 0 else 0.01
 
     levels = np.linspace(global_min, global_max, 20)
+    return valid_datasets, levels
+
+@instrumented("time_height_panel", 0)
+def plot_time_height_panel_grid(
+    var_name,
+    datasets,
+    short_ids,
+    time_offset,
+    height_cord,
+    output_subdir,
+    labelsize,
+    ticksize,
+    usercmap,
+    start_time,
+    end_time,
+    max_height,
+    is_diurnal=False,
+    time_labels=None,
+    title_suffix="",
+    dataset_indices=None,
+    window_table=None,
+    renderer="contourf",
+    decimate=False
+):
+    import matplotlib.pyplot as plt
+    import numpy as np
+    import os
+
+    product = time_height_panel_data(var_name, datasets, time_offset, height_cord, start_time, end_time,
+                                     max_height, is_diurnal, dataset_indices, window_table)
+    if product is None:
+        print(f"Warning: No valid data found for {var_name}. Skipping.")
+        return None
+    valid_datasets, levels = product
+
     n_cols = 2
     n_rows = -(-len(valid_datasets) // n_cols)
     fig, axes = plt.subplots(n_rows, n_cols, figsize=(15, n_rows * 6), sharey=True, constrained_layout=True)
@@ -191,7 +523,10 @@ def plot_time_height_panel_grid(
     for ax, (idx, time_vals, data, y_coord) in zip(axes.flat, valid_datasets):
 
         y_coord = np.squeeze(y_coord)
-        contour = ax.contourf(time_vals, y_coord, data.T, levels=levels, cmap=usercmap)
+        if decimate:
+            time_vals, data = time_block_average(time_vals, data, axes_pixel_width(ax))
+        with instrument(renderer, var_name):
+            contour = draw_time_height_panel(ax, time_vals, y_coord, data, levels, usercmap, renderer)
         contours.append(contour)
 
         ax.set_title(short_ids[idx], fontsize=16)
@@ -226,60 +561,175 @@ def plot_time_height_panel_grid(
 
     outname = f"{var_name}_{'diurnal2d' if is_diurnal else 'time_height'}.jpg"
     outfile = os.path.join(output_subdir, outname)
-    plt.savefig(outfile, format='jpg')
+    with instrument("savefig", var_name):
+        plt.savefig(outfile, format='jpg')
     plt.close()
     return outfile
 
-def compute_diurnal_composite(ds, var_name, idx, time_offset, diurnal_start_day, diurnal_end_day):
+# Diurnal composites of every variable of a dataset, keyed by
+#  (id(ds), time offset, start day, end day).  Shared by the 1D and 2D stages.
+_diurnal_cache = {}
+
+def clear_diurnal_cache(ds=None):
     """
-    Compute the diurnal composite for a given variable in a dataset.
+    Clear cached diurnal composites.
+
+    Parameters:
+        ds (xarray.Dataset, optional): Only clear the entries of this dataset.
+            If None the whole cache is cleared.
+    """
+    if ds is None:
+        _diurnal_cache.clear()
+        return
+    for key in [key for key in _diurnal_cache if key[0] == id(ds)]:
+        del _diurnal_cache[key]
+
+def clear_dataset_caches(ds=None):
+    """
+    Clear every per-dataset cache; called before a dataset is closed.
+    """
+    clear_y_coord_cache(ds)
+    clear_diurnal_cache(ds)
+    clear_window_mean_cache(ds)
+    clear_time_bin_cache(ds)
+    clear_digest_cache(ds)
+
+def compute_diurnal_composites(ds, time_vals, diurnal_start_day, diurnal_end_day, max_bins=96,
+                               max_batch_size=2**24):
+    """
+    Compute the diurnal composite of every time dependent variable of a dataset
+    in one batched pass.
+
+    Samples are binned by their UTC hour of day, taken from the actual time
+    stamps and the reference time in 'time:units', so irregular sampling is
+    handled.  The number of bins follows the median output frequency, up to
+    max_bins per day.
+
+    Parameters:
+        ds (xarray.Dataset): Dataset containing the variables.
+        time_vals (numpy.ndarray): Time in days, aligned to the first dataset.
+        diurnal_start_day (float): Start of the composite period, None for the first time.
+        diurnal_end_day (float): End of the composite period, None for the last time.
+        max_bins (int): Maximum number of hour-of-day bins.
+        max_batch_size (int): Maximum number of values reduced in one batch.
+
     Returns:
-        composite (np.ndarray), hour_labels (np.ndarray), success (bool), ndim (int)
+        dict or None: 'composites' (variable name -> numpy.ndarray with the hour
+            bin as first dimension, and the ensemble member as second for
+            ensembles), 'hour_labels', 'stime' and 'etime', or
+            None if the dataset is not suitable for diurnal composites.
     """
-    try:
-        times = ds['time'].values
-        time_vals = times - time_offset[idx]
-        time_res = float(time_vals[1] - time_vals[0])
-        steps_per_day = int(round(1.0 / time_res))
-
-        total_days = len(time_vals) / steps_per_day
-        if steps_per_day < 4:
-            print(f"Skipping {var_name}: fewer than 4 time steps/day.")
-            return None, None, False, None
-        if total_days < 3:
-            print(f"Skipping {var_name}: fewer than 3 days in dataset.")
-            return None, None, False, None
-
-        stime = diurnal_start_day if diurnal_start_day is not None else time_vals[0]
-        etime = diurnal_end_day if diurnal_end_day is not None else time_vals[-1]
-
-        valid_idx = np.where((time_vals >= stime) & (time_vals <= etime))[0]
-        if len(valid_idx) == 0:
-            return None, None, False, None
-
-        data = ds[var_name].isel(time=valid_idx)
+    source = ds.encoding.get('source', 'dataset')
+    if len(time_vals) < 2:
+        print(f"Skipping diurnal composites for {source}: fewer than 2 time steps.")
+        return None
+
+    time_res = float(np.median(np.diff(time_vals)))
+    steps_per_day = int(round(1.0 / time_res)) if time_res > 0 else 0
+    total_days = float(time_vals[-1] - time_vals[0]) + time_res
+    if steps_per_day < 4:
+        print(f"Skipping diurnal composites for {source}: fewer than 4 time steps/day.")
+        return None
+    if total_days < 3:
+        print(f"Skipping diurnal composites for {source}: fewer than 3 days in dataset.")
+        return None
+
+    stime = diurnal_start_day if diurnal_start_day is not None else time_vals[0]
+    etime = diurnal_end_day if diurnal_end_day is not None else time_vals[-1]
+
+    valid_idx = np.where((time_vals >= stime) & (time_vals <= etime))[0]
+    if len(valid_idx) == 0:
+        return None
+
+    # Hour-of-day bin of every sample (UTC)
+    _, ref_seconds = extract_time_info(ds)
+    ref_seconds = 0 if ref_seconds == -999 else ref_seconds
+    day_fraction = np.mod(ds['time'].values[valid_idx] + ref_seconds / 86400.0, 1.0)
+    n_bins = min(steps_per_day, max_bins)
+    bins = np.minimum(np.floor(day_fraction * n_bins + 1e-6).astype(int), n_bins - 1)
+
+    hour_bins = np.linspace(0, 24, n_bins + 1)
+    hour_labels = (hour_bins[:-1] + hour_bins[1:]) / 2
+
+    composites = {}
+
+    def reduce_batch(names, shapes, columns):
+        stacked = np.concatenate(columns, axis=1)
+        n_cols = stacked.shape[1]
+        finite = np.isfinite(stacked)
+        flat_idx = (bins[:, None] * n_cols + np.arange(n_cols)).ravel()
+        sums = np.bincount(flat_idx, weights=np.where(finite, stacked, 0.0).ravel(), minlength=n_bins * n_cols)
+        counts = np.bincount(flat_idx, weights=finite.ravel(), minlength=n_bins * n_cols)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(counts > 0, sums / counts, np.nan).reshape(n_bins, n_cols)
+
+        offset = 0
+        for var_name, shape, block in zip(names, shapes, columns):
+            width = block.shape[1]
+            composites[var_name] = means[:, offset:offset + width].reshape((n_bins,) + shape)
+            offset += width
+
+    # Stack the variables into (time, column) matrices, reduced in batches of
+    #  at most max_batch_size values (or one variable if it is larger)
+    names, shapes, columns = [], [], []
+    batch_size = 0
+    for var_name, da in ds.data_vars.items():
+        if classify_variable(da)[0] not in ('profile', 'timeseries'):
+            continue
+        if not set(da.dims) <= {'time', 'ncol', 'lev', 'ilev', 'member'}:
+            continue
+        data = da.isel(time=valid_idx)
         if 'ncol' in data.dims:
-            data = data.mean(dim='ncol',skipna=True)
+            data = data.mean(dim='ncol', skipna=True)
+        # Composites of ensembles keep the members as second dimension
+        values = np.asarray(data.transpose('time', *[d for d in ['member'] if d in data.dims], ...).values,
+                            dtype=float)
+        if names and batch_size + values.size > max_batch_size:
+            reduce_batch(names, shapes, columns)
+            names, shapes, columns = [], [], []
+            batch_size = 0
+        names.append(var_name)
+        shapes.append(values.shape[1:])
+        columns.append(values.reshape(len(valid_idx), -1))
+        batch_size += values.size
+
+    if names:
+        reduce_batch(names, shapes, columns)
+
+    return {'composites': composites, 'hour_labels': hour_labels, 'stime': stime, 'etime': etime}
+
+def compute_diurnal_composite(ds, var_name, idx, time_offset, diurnal_start_day, diurnal_end_day):
+    """
+    Compute the diurnal composite for a given variable in a dataset.
 
-        hour_bins = np.linspace(0, 24, steps_per_day + 1)
-        hour_labels = (hour_bins[:-1] + hour_bins[1:]) / 2
+    The composites of all variables of the dataset are computed on the first
+    call and cached (see compute_diurnal_composites).
 
-        daily_data = []
-        for i in range(0, len(data), steps_per_day):
-            if i + steps_per_day > len(data):
-                break
-            daily_data.append(data[i:i + steps_per_day])
+    Returns:
+        composite (np.ndarray), hour_labels (np.ndarray), success (bool), ndim (int),
+        stime (float), etime (float)
+    """
+    key = (id(ds), time_offset[idx], diurnal_start_day, diurnal_end_day)
+    if key not in _diurnal_cache:
+        try:
+            time_vals = ds['time'].values - time_offset[idx]
+            with instrument("diurnal_composites"):
+                _diurnal_cache[key] = compute_diurnal_composites(ds, time_vals, diurnal_start_day, diurnal_end_day)
+        except Exception as e:
+            print(f"Error computing diurnal composites for {ds.encoding.get('source', 'dataset')}: {e}")
+            _diurnal_cache[key] = None
 
-        composite = np.nanmean(daily_data, axis=0)
+    result = _diurnal_cache[key]
+    if result is None or var_name not in result['composites']:
+        return None, None, False, None, None, None
 
-        return composite, hour_labels, True, data.ndim, stime, etime
-    except Exception as e:
-        print(f"Error computing diurnal composite for {var_name}: {e}")
-        return None, None, False, None
+    composite = result['composites'][var_name]
+    if 'member' in ds[var_name].dims:
+        composite = np.nanmean(composite, axis=1)
+    return composite, result['hour_labels'], True, composite.ndim, result['stime'], result['etime']
 
 #############################
 
-import netCDF4
 from datetime import datetime
 
 def extract_time_info(ds):
@@ -351,16 +801,3253 @@ def compute_date_time_difference(date1, time1_seconds, date2, time2_seconds):
         # Compute the difference in days as a float
         day_difference = abs((datetime2 - datetime1).total_seconds()) / 86400.0
 
-        return round(day_difference, 6)  # Rounded for better precision
+        return round(day_difference, 6)  # Rounded for better precision
+
+    except ValueError:
+        print("Error: One or both dates are not in the correct 'yyyymmdd' format.")
+        return -999.0  # Error flag
+
+#################################
+###### Time windows
+
+def _window_bounds(sorted_time, stime, etime):
+    return int(np.searchsorted(sorted_time, stime, side='left')), int(np.searchsorted(sorted_time, etime, side='right'))
+
+def build_time_window_table(ds, time_offset, profile_time_s, profile_time_e,
+                            time_series_time_s, time_series_time_e,
+                            time_height_time_s, time_height_time_e):
+    """
+    Build the table of time windows used by the profile, time series and
+    time-height stages of one dataset.
+
+    Parameters:
+        ds (xarray.Dataset): Dataset containing the time coordinate.
+        time_offset (float): Offset in days of this dataset to the first dataset.
+        profile_time_s, profile_time_e (list): Profile averaging windows in days.
+        time_series_time_s, time_series_time_e (float): Time series range, None for the entire range.
+        time_height_time_s, time_height_time_e (float): Time-height range, None for the entire range.
+
+    Returns:
+        dict: 'time_in_days' (numpy.ndarray), 'order' (time sorting order),
+            'profile_bounds' (list of (start, stop) into the sorted time) and the
+            time indices of each window under 'profile' (list), 'timeseries'
+            and 'time_height'.
+    """
+    time_in_days = ds['time'].values - time_offset
+    order = np.argsort(time_in_days, kind='stable')
+    sorted_time = time_in_days[order]
+
+    def indices(bounds):
+        return np.sort(order[bounds[0]:bounds[1]])
+
+    table = {'time_in_days': time_in_days, 'order': order, 'profile_bounds': [], 'profile': []}
+
+    for start_time, end_time in zip(profile_time_s, profile_time_e):
+        stime = start_time if start_time != "end" else time_in_days[0]
+        etime = end_time if end_time != "end" else time_in_days[-1]
+        bounds = _window_bounds(sorted_time, stime, etime)
+        table['profile_bounds'].append(bounds)
+        table['profile'].append(indices(bounds))
+
+    stime = time_series_time_s if time_series_time_s is not None else time_in_days[0]
+    etime = time_series_time_e if time_series_time_e is not None else time_in_days[-1]
+    table['timeseries'] = indices(_window_bounds(sorted_time, stime, etime))
+
+    stime = time_height_time_s if time_height_time_s is not None else time_in_days[0]
+    etime = time_height_time_e if time_height_time_e is not None else time_in_days[-1]
+    table['time_height'] = indices(_window_bounds(sorted_time, stime, etime))
+
+    return table
+
+# Window means of each variable, keyed by (id(ds), var_name, window bounds)
+_window_mean_cache = {}
+
+def clear_window_mean_cache(ds=None):
+    """
+    Clear cached window means.
+
+    Parameters:
+        ds (xarray.Dataset, optional): Only clear the entries of this dataset.
+            If None the whole cache is cleared.
+    """
+    if ds is None:
+        _window_mean_cache.clear()
+        return
+    for key in [key for key in _window_mean_cache if key[0] == id(ds)]:
+        del _window_mean_cache[key]
+
+@instrumented("window_means", 1)
+def compute_window_means(ds, var_name, table):
+    """
+    Compute the time mean of a variable over every profile window in one pass.
+
+    The data is put in time order once and reduced with a cumulative sum, so
+    each window mean is the difference of two cumulative sums (NaNs skipped).
+
+    Parameters:
+        ds (xarray.Dataset): Dataset containing the variable.
+        var_name (str): Variable to average.
+        table (dict): Time window table of the dataset (see build_time_window_table).
+
+    Returns:
+        xarray.DataArray: Window means with a leading 'window' dimension.
+    """
+    bounds = tuple(table['profile_bounds'])
+    key = (id(ds), var_name, bounds)
+    if key in _window_mean_cache:
+        return _window_mean_cache[key]
+
+    da = ds[var_name].transpose('time', ...)
+    values = np.asarray(da.values, dtype=float)
+    order = table['order']
+    if np.any(np.diff(order) < 0):
+        values = values[order]
+
+    # Accumulate anomalies from the first sample to limit round-off in the differences
+    finite = np.isfinite(values)
+    reference = np.where(finite[0], values[0], 0.0) if len(values) else 0.0
+    zero = np.zeros((1,) + values.shape[1:])
+    csum = np.concatenate([zero, np.cumsum(np.where(finite, values - reference, 0.0), axis=0)])
+    ccount = np.concatenate([zero, np.cumsum(finite, axis=0)])
+
+    starts = np.array([b[0] for b in bounds], dtype=int)
+    stops = np.array([b[1] for b in bounds], dtype=int)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        counts = ccount[stops] - ccount[starts]
+        means = np.where(counts > 0, reference + (csum[stops] - csum[starts]) / counts, np.nan)
+
+    result = xr.DataArray(means, dims=('window',) + da.dims[1:], attrs=da.attrs)
+    _window_mean_cache[key] = result
+    return result
+
+#################################
+###### Variable classification
+
+def classify_variable(da):
+    """
+    Classify a single variable by its shape.
+
+    Parameters:
+        da (xarray.DataArray): The variable to classify.
+
+    Returns:
+        tuple: (shape, vert_dim) where shape is 'profile', 'timeseries', 'string'
+            or 'other' and vert_dim is 'lev', 'ilev' or None.
+    """
+    dims = set(da.dims)
+    vert_dim = 'lev' if 'lev' in dims else 'ilev' if 'ilev' in dims else None
+
+    if da.dtype.kind in {'S', 'U'}:
+        return 'string', vert_dim
+    if 'time' not in dims:
+        return 'other', vert_dim
+    # Ensemble members ('member') are averaged like columns
+    if vert_dim is not None and da.ndim - ('member' in dims) in [2, 3]:
+        return 'profile', vert_dim
+    if vert_dim is None and dims - {'time'} <= {'ncol', 'member'}:
+        return 'timeseries', vert_dim
+    return 'other', vert_dim
+
+def classify_variables(datasets):
+    """
+    Build the variable index used by every stage of the diagnostics in one pass
+    over the datasets.
+
+    A variable takes the first plottable shape found in dataset order and keeps
+    the indices of the datasets that hold it with that shape.
+
+    Parameters:
+        datasets (list): Opened xarray datasets.
+
+    Returns:
+        dict: Maps each variable name (sorted) to a dict with keys 'shape',
+            'vert_dim' and 'datasets'.
+    """
+    var_index = {}
+    for idx, ds in enumerate(datasets):
+        for var_name, da in ds.data_vars.items():
+            shape, vert_dim = classify_variable(da)
+            entry = var_index.get(var_name)
+            if entry is None or (entry['shape'] in ('string', 'other') and shape not in ('string', 'other')):
+                var_index[var_name] = {'shape': shape, 'vert_dim': vert_dim, 'datasets': [idx]}
+            elif entry['shape'] == shape:
+                entry['datasets'].append(idx)
+
+    return dict(sorted(var_index.items()))
+
+def variables_of_shape(var_index, shape):
+    """
+    Return the names of the variables in var_index with the given shape class.
+    """
+    return [var_name for var_name, entry in var_index.items() if entry['shape'] == shape]
+
+#################################
+###### Reduced products
+
+# The plots are drawn from reduced products (window-mean profiles, clipped time
+#  series, time-height slabs and diurnal composites).  These are computed from
+#  the input datasets, or read back from a data cube written by write_data_cube,
+#  which holds one netCDF file per dataset with the product of each variable
+#  stored as '<variable>__<product>'.
+
+def is_data_cube(ds):
+    """
+    Return True if the dataset is a data cube file written by write_data_cube.
+    """
+    return bool(ds.attrs.get('diagnostics_data_cube', 0))
+
+def _vertical_dim(da):
+    return 'lev' if 'lev' in da.dims else 'ilev' if 'ilev' in da.dims else None
+
+def _vertical_profile(values, vert_dim=None):
+    # Return a 1D array over the vertical; other dimensions (i.e. ncol) are averaged
+    if isinstance(values, xr.DataArray):
+        if vert_dim in values.dims:
+            values = values.transpose(vert_dim, ...)
+        values = values.values
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 0:
+        return values.reshape(1)
+    values = values.reshape(values.shape[0], -1)
+    return values[:, 0] if values.shape[1] == 1 else np.nanmean(values, axis=1)
+
+def _member_mean(data):
+    # Average over columns and ensemble members
+    dims = [dim for dim in ('ncol', 'member') if dim in data.dims]
+    return data.mean(dim=dims, skipna=True) if dims else data
+
+@instrumented("data", 2)
+def profile_product(ds, idx, var_name, window_idx, opts):
+    """
+    Return the window mean profile of a variable and its vertical coordinate.
+
+    Returns:
+        tuple: (values, y_coord) as 1D numpy arrays over the vertical.
+    """
+    if is_data_cube(ds):
+        return (ds[f"{var_name}__profile"].values[window_idx],
+                ds[f"{var_name}__profile_y"].values[window_idx])
+
+    windows = opts["window_table"][idx]
+    time_indices = windows["profile"][window_idx]
+    vert_dim = _vertical_dim(ds[var_name])
+
+    values = compute_window_means(ds, var_name, windows).isel(window=window_idx)
+    y_coord = compute_y_coord(ds, time_indices, opts["height_cord"], var_name)
+    return _vertical_profile(values, vert_dim), _vertical_profile(y_coord, vert_dim)
+
+@instrumented("data", 2)
+def timeseries_product(ds, idx, var_name, opts):
+    """
+    Return the time series of a variable clipped to the time series range.
+
+    Returns:
+        tuple: (time in days, values) as 1D numpy arrays.
+    """
+    if is_data_cube(ds):
+        da = ds[f"{var_name}__timeseries"]
+        return da['ts_time'].values, da.values
+
+    windows = opts["window_table"][idx]
+    time_indices = windows["timeseries"]
+    data = _member_mean(ds[var_name].isel(time=time_indices))
+    return windows["time_in_days"][time_indices], np.asarray(data.values)
+
+@instrumented("data", 2)
+def time_height_product(ds, idx, var_name, time_offset, height_cord, start_time, end_time, window_table=None):
+    """
+    Return the time-height slab of a variable and its vertical coordinate.
+
+    Returns:
+        tuple or None: (time in days, y_coord, values with shape (time, vertical)),
+            or None if the dataset has no data in the time range.
+    """
+    if is_data_cube(ds):
+        if f"{var_name}__time_height" not in ds:
+            return None
+        da = ds[f"{var_name}__time_height"]
+        return da['th_time'].values, ds[f"{var_name}__time_height_y"].values, da.values
+
+    if window_table is not None:
+        time_vals = window_table[idx]['time_in_days']
+        time_indices = window_table[idx]['time_height']
+    else:
+        time_vals = ds['time'].values - time_offset[idx]
+
+        stime = start_time if start_time is not None else time_vals[0]
+        etime = end_time if end_time is not None else time_vals[-1]
+
+        time_indices = np.where((time_vals >= stime) & (time_vals <= etime))[0]
+    if len(time_indices) == 0:
+        return None
+
+    vert_dim = _vertical_dim(ds[var_name])
+    y_coord = compute_y_coord(ds, time_indices, height_cord, var_name)
+
+    data = _member_mean(ds[var_name].isel(time=time_indices))
+    values = np.asarray(data.transpose('time', vert_dim, ...).values)
+    return time_vals[time_indices], _vertical_profile(y_coord, vert_dim), values
+
+@instrumented("data", 2)
+def diurnal_product(ds, idx, var_name, time_offset, diurnal_start_day, diurnal_end_day, height_cord=None):
+    """
+    Return the diurnal composite of a variable.
+
+    Returns:
+        tuple or None: (composite, hour_labels, stime, etime, y_coord) where
+            y_coord is only set for composites with a vertical dimension and
+            height_cord given, or None if no composite is available.
+    """
+    if is_data_cube(ds):
+        if f"{var_name}__diurnal" not in ds:
+            return None
+        da = ds[f"{var_name}__diurnal"]
+        y_coord = ds[f"{var_name}__diurnal_y"].values if f"{var_name}__diurnal_y" in ds else None
+        return da.values, da['hour'].values, ds.attrs['diurnal_stime'], ds.attrs['diurnal_etime'], y_coord
+
+    composite, hour_labels, success, ndim, stime, etime = compute_diurnal_composite(
+        ds, var_name, idx, time_offset, diurnal_start_day, diurnal_end_day)
+    if not success:
+        return None
+
+    y_coord = None
+    vert_dim = _vertical_dim(ds[var_name])
+    if ndim == 2 and vert_dim is not None and height_cord is not None:
+        time_indices = np.where((hour_labels >= 0) & (hour_labels <= 24))[0]
+        y_coord = _vertical_profile(compute_y_coord(ds, time_indices, height_cord, var_name), vert_dim)
+    return composite, hour_labels, stime, etime, y_coord
+
+@instrumented("data", 2)
+def histogram_product(ds, idx, var_name, opts):
+    """
+    Return the histogram across columns of a variable (see horizontal_average).
+
+    Returns:
+        tuple or None: (counts, bin edges, y_coord), where counts has the shape
+            (vertical, bin) for a CFAD, or (bin,) with y_coord None otherwise;
+            None if the dataset has no histogram of the variable.
+    """
+    if f"{var_name}__bin_edges" not in ds:
+        return None
+    edges = ds[f"{var_name}__bin_edges"].values
+    if f"{var_name}__histogram" in ds:
+        return ds[f"{var_name}__histogram"].values, edges, None
+
+    counts = ds[f"{var_name}__cfad"]
+    if is_data_cube(ds):
+        y_coord = ds[f"{var_name}__cfad_y"].values
+    else:
+        # Vertical coordinate averaged over the whole run, like the histograms
+        time_indices = np.arange(ds.sizes['time'])
+        y_coord = _vertical_profile(compute_y_coord(ds, time_indices, opts["height_cord"], var_name),
+                                    counts.dims[0])
+    return counts.values, edges, y_coord
+
+def joint_histogram_product(ds, x_name, y_name):
+    """
+    Return the joint histogram of two variables (see horizontal_average).
+
+    Returns:
+        tuple or None: (counts with shape (x bin, y bin), x bin edges, y bin edges),
+            or None if the dataset has no joint histogram of the variables.
+    """
+    name = f"{x_name}__{y_name}__joint"
+    if name not in ds:
+        return None
+    return ds[name].values, ds[f"{x_name}__bin_edges"].values, ds[f"{y_name}__bin_edges"].values
+
+def data_cube_products(ds, idx, opts, do_timeheight, do_diurnal_composites):
+    """
+    Compute every reduced product of one dataset.
+
+    Returns:
+        xarray.Dataset: The products, in the data cube layout.
+    """
+    var_index = opts["var_index"]
+    window_table = opts["window_table"]
+    cube = xr.Dataset()
+    diurnal_window = None
+
+    for var_name, entry in var_index.items():
+        if idx not in entry["datasets"]:
+            continue
+        attrs = {k: v for k, v in ds[var_name].attrs.items() if k in ('units', 'long_name')}
+        # Placeholder carrying the metadata of the variable
+        cube[var_name] = xr.DataArray(0, attrs=attrs)
+
+        if entry["shape"] == "profile":
+            vert_dim = _vertical_dim(ds[var_name])
+            profiles = [profile_product(ds, idx, var_name, w, opts) for w in range(len(window_table[idx]["profile"]))]
+            cube[f"{var_name}__profile"] = (('window', vert_dim), np.array([p[0] for p in profiles]), attrs)
+            cube[f"{var_name}__profile_y"] = (('window', vert_dim), np.array([p[1] for p in profiles]))
+            if 'member' in ds[var_name].dims:
+                bands = [ensemble_band_product(ds, idx, var_name, "profile", opts, w) for w in range(len(profiles))]
+                cube[f"{var_name}__profile_band"] = (('bound', 'window', vert_dim),
+                                                     np.array(bands).transpose(1, 0, 2), attrs)
+
+            if do_timeheight:
+                product = time_height_product(ds, idx, var_name, opts["time_offset"], opts["height_cord"],
+                                              None, None, window_table)
+                if product is not None:
+                    time_vals, y_coord, values = product
+                    cube[f"{var_name}__time_height"] = xr.DataArray(
+                        values, dims=('th_time', vert_dim), coords={'th_time': time_vals}, attrs=attrs)
+                    cube[f"{var_name}__time_height_y"] = ((vert_dim,), y_coord)
+
+        elif entry["shape"] == "timeseries":
+            time_vals, values = timeseries_product(ds, idx, var_name, opts)
+            cube[f"{var_name}__timeseries"] = xr.DataArray(
+                values, dims=('ts_time',), coords={'ts_time': time_vals}, attrs=attrs)
+            if 'member' in ds[var_name].dims:
+                band = ensemble_band_product(ds, idx, var_name, "timeseries", opts)
+                cube[f"{var_name}__timeseries_band"] = (('bound', 'ts_time'), np.array(band), attrs)
+
+        if do_diurnal_composites:
+            product = diurnal_product(ds, idx, var_name, opts["time_offset"], opts["diurnal_start_day"],
+                                      opts["diurnal_end_day"], opts["height_cord"])
+            if product is not None:
+                composite, hour_labels, stime, etime, y_coord = product
+                dims = ('hour',) if composite.ndim == 1 else ('hour', _vertical_dim(ds[var_name]))
+                cube[f"{var_name}__diurnal"] = xr.DataArray(
+                    composite, dims=dims, coords={'hour': hour_labels}, attrs=attrs)
+                if y_coord is not None:
+                    cube[f"{var_name}__diurnal_y"] = ((dims[1],), y_coord)
+                band = ensemble_band_product(ds, idx, var_name, "diurnal", opts)
+                if band is not None:
+                    cube[f"{var_name}__diurnal_band"] = (('bound', 'hour'), np.array(band), attrs)
+                diurnal_window = (stime, etime)
+
+    # Histograms across columns are copied, with the vertical coordinate of each CFAD
+    for name, da in ds.data_vars.items():
+        if name.endswith(("__bin_edges", "__histogram", "__joint")):
+            cube[name] = da
+        elif name.endswith("__cfad"):
+            var_name = name[:-len("__cfad")]
+            cube[name] = da
+            cube[f"{var_name}__cfad_y"] = ((da.dims[0],), histogram_product(ds, idx, var_name, opts)[2])
+
+    cube.attrs['diagnostics_data_cube'] = 1
+    cube.attrs['source'] = str(ds.encoding.get('source', 'Unknown source'))
+    if diurnal_window is not None:
+        cube.attrs['diurnal_stime'], cube.attrs['diurnal_etime'] = diurnal_window
+    return cube
+
+# Settings the reduced products depend on.  A data cube can only be rendered
+#  with the same values; every other setting is free to change.
+DATA_CUBE_SETTINGS = ["profile_time_s", "profile_time_e", "height_cord",
+                      "time_series_time_s", "time_series_time_e",
+                      "time_height_time_s", "time_height_time_e",
+                      "do_timeheight", "do_diurnal_composites",
+                      "diurnal_start_day", "diurnal_end_day", "ensemble_band"]
+
+def write_data_cube(cube_dir, datasets, opts, settings):
+    """
+    Write the reduced products of every dataset to a data cube directory.
+
+    The directory holds one netCDF file per dataset plus index.json, which
+    records the variable index, time offsets and the settings of DATA_CUBE_SETTINGS.
+
+    Returns:
+        list: Paths of the netCDF files, in dataset order.
+    """
+    os.makedirs(cube_dir, exist_ok=True)
+    cube_files = []
+    for idx, ds in enumerate(datasets):
+        cube = data_cube_products(ds, idx, opts, settings["do_timeheight"], settings["do_diurnal_composites"])
+        cube_file = os.path.join(cube_dir, f"dataset{idx+1}.nc")
+        cube.to_netcdf(cube_file)
+        cube_files.append(cube_file)
+
+    index = {
+        "files": [os.path.basename(f) for f in cube_files],
+        "short_ids": opts["short_ids"],
+        "time_offset": [float(t) for t in opts["time_offset"]],
+        "var_index": opts["var_index"],
+        "settings": {k: settings[k] for k in DATA_CUBE_SETTINGS},
+    }
+    with open(os.path.join(cube_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=1, default=lambda x: x.item() if isinstance(x, np.generic) else str(x))
+    return cube_files
+
+def read_data_cube_index(cube_dir, settings):
+    """
+    Read index.json of a data cube and check that it matches the settings.
+
+    Returns:
+        dict: The index, with the paths of the netCDF files under 'files'.
+    """
+    index_file = os.path.join(cube_dir, "index.json")
+    if not os.path.exists(index_file):
+        raise ValueError(f"No data cube found in {cube_dir}. Run once with data_cube=True first.")
+    with open(index_file) as f:
+        index = json.load(f)
+
+    stored = index["settings"]
+    current = json.loads(json.dumps({k: settings[k] for k in DATA_CUBE_SETTINGS}, default=lambda x: x.item() if isinstance(x, np.generic) else str(x)))
+    changed = [k for k in DATA_CUBE_SETTINGS if stored.get(k) != current[k]]
+    if changed:
+        raise ValueError(f"Settings {', '.join(changed)} differ from the data cube in {cube_dir}. "
+                         "Rerun from the input files with data_cube=True.")
+
+    index["files"] = [os.path.join(cube_dir, f) for f in index["files"]]
+    return index
+
+#################################
+###### Ensembles
+
+# An ensemble dataset holds its members along a 'member' dimension (see
+#  open_ensemble_dataset).  Its products are the ensemble mean; the spread
+#  across members is drawn as a shaded band around the mean.
+
+def ensemble_statistics(values, percentiles=(10, 90)):
+    """
+    Compute statistics across ensemble members in one stacked reduction.
+
+    Parameters:
+        values (numpy.ndarray): Member values, members on the first axis.
+        percentiles (tuple): Percentiles to compute, in 0-100.
+
+    Returns:
+        dict: 'mean', 'std', 'min', 'max' and 'p<q>' for each percentile q,
+            each of the shape of values without its first axis.
+    """
+    values = np.asarray(values, dtype=float)
+    quantiles = np.nanpercentile(values, [0.0] + list(percentiles) + [100.0], axis=0)
+    stats = {'mean': np.nanmean(values, axis=0), 'std': np.nanstd(values, axis=0),
+             'min': quantiles[0], 'max': quantiles[-1]}
+    for q, quantile in zip(percentiles, quantiles[1:-1]):
+        stats[f"p{q:g}"] = quantile
+    return stats
+
+def ensemble_band(values, band=(10, 90)):
+    """
+    Return the lower and upper edge of the band of member values (members on
+    the first axis): band is "minmax", "std" (mean -/+ one standard deviation)
+    or a pair of percentiles.
+    """
+    if band == "minmax":
+        stats = ensemble_statistics(values, ())
+        return stats['min'], stats['max']
+    if band == "std":
+        stats = ensemble_statistics(values, ())
+        return stats['mean'] - stats['std'], stats['mean'] + stats['std']
+    low, high = band
+    stats = ensemble_statistics(values, (low, high))
+    return stats[f"p{low:g}"], stats[f"p{high:g}"]
+
+def ensemble_band_product(ds, idx, var_name, kind, opts, window_idx=None):
+    """
+    Return the band of the spread across members of a product.
+
+    Parameters:
+        kind (str): 'profile' (of window window_idx), 'timeseries' or 'diurnal'
+            (1D composites).
+
+    Returns:
+        tuple or None: (lower, upper), aligned with the values returned by
+            profile_product, timeseries_product or diurnal_product; None if
+            the dataset is not an ensemble.
+    """
+    if is_data_cube(ds):
+        name = f"{var_name}__{kind}_band"
+        if name not in ds:
+            return None
+        band = ds[name].values
+        if kind == "profile":
+            band = band[:, window_idx]
+        return band[0], band[1]
+
+    da = ds[var_name]
+    if 'member' not in da.dims:
+        return None
+    if kind == "profile":
+        data = compute_window_means(ds, var_name, opts["window_table"][idx]).isel(window=window_idx)
+        data = data.mean(dim='ncol', skipna=True) if 'ncol' in data.dims else data
+        values = data.transpose('member', _vertical_dim(da)).values
+    elif kind == "timeseries":
+        data = da.isel(time=opts["window_table"][idx]["timeseries"])
+        data = data.mean(dim='ncol', skipna=True) if 'ncol' in data.dims else data
+        values = data.transpose('member', 'time').values
+    else:
+        compute_diurnal_composite(ds, var_name, idx, opts["time_offset"],
+                                  opts["diurnal_start_day"], opts["diurnal_end_day"])
+        key = (id(ds), opts["time_offset"][idx], opts["diurnal_start_day"], opts["diurnal_end_day"])
+        result = _diurnal_cache.get(key)
+        if result is None or var_name not in result['composites'] or result['composites'][var_name].ndim != 2:
+            return None
+        values = result['composites'][var_name].T
+    return ensemble_band(values, opts["ensemble_band"])
+
+#################################
+###### Vertical interpolation
+
+# Datasets sit on different vertical grids (hybrid model levels, sounding or LES
+#  heights).  For comparisons across datasets the reduced products are put on a
+#  common target grid, with one vectorized interpolation per dataset for all
+#  variables and time steps (or windows) at once.
+
+def default_vertical_grid(height_cord, max_height=None, n_levels=100):
+    """
+    Return the default common vertical grid: n_levels heights from the surface
+    to max_height (m) for height_cord 'z', or pressures from 1000 hPa to
+    max_height (hPa) for 'p'.
+    """
+    if height_cord == "z":
+        return np.linspace(0.0, max_height if max_height else 20000.0, n_levels)
+    return np.linspace(1000.0, max_height if max_height else 100.0, n_levels)
+
+def interpolate_to_grid(y_coord, values, target):
+    """
+    Linearly interpolate profiles onto a target vertical grid.
+
+    The vertical is the last axis.  y_coord is broadcast against values, so a
+    single coordinate can serve any number of variables and time steps, or
+    every profile can have its own.  The coordinate does not have to be sorted
+    and may hold NaNs; targets outside the range of a profile give NaN.
+
+    Parameters:
+        y_coord (numpy.ndarray): Vertical coordinate, shape (..., n_levels).
+        values (numpy.ndarray): Profiles, shape (..., n_levels).
+        target (numpy.ndarray): Target grid, shape (n_target,).
+
+    Returns:
+        numpy.ndarray: The profiles on the target grid, shape (..., n_target).
+    """
+    target = np.asarray(target, dtype=float)
+    values = np.asarray(values, dtype=float)
+    y_coord = np.asarray(y_coord, dtype=float)
+    y_coord = y_coord.reshape((1,) * (values.ndim - y_coord.ndim) + y_coord.shape)
+
+    # Interpolation indices and weights are found on the coordinate alone, so a
+    #  shared coordinate is searched once; NaN coordinates are sorted last
+    order = np.argsort(y_coord, axis=-1)
+    y = np.take_along_axis(y_coord, order, axis=-1)
+    n_valid = np.isfinite(y).sum(axis=-1, keepdims=True)
+    upper = (y[..., :, None] <= target).sum(axis=-2)
+    upper = np.clip(upper, 1, np.maximum(n_valid - 1, 1))
+    lower = upper - 1
+    y0, y1 = np.take_along_axis(y, lower, axis=-1), np.take_along_axis(y, upper, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(y1 > y0, (target - y0) / (y1 - y0), 0.0)
+    inside = (target >= y0) & (target <= y1) & (n_valid > 1)
+
+    out_shape = np.broadcast_shapes(values.shape[:-1], y.shape[:-1]) + (len(target),)
+    v = np.take_along_axis(values, np.broadcast_to(order, np.broadcast_shapes(values.shape, order.shape)), axis=-1)
+    v0 = np.take_along_axis(v, np.broadcast_to(lower, out_shape), axis=-1)
+    v1 = np.take_along_axis(v, np.broadcast_to(upper, out_shape), axis=-1)
+    return np.where(inside, v0 + weight * (v1 - v0), np.nan)
+
+def _grid_key(opts):
+    grid = np.asarray(opts["vertical_grid"], dtype=float)
+    return (opts["height_cord"], grid.tobytes())
+
+def interpolated_profiles(ds, idx, var_names, opts):
+    """
+    Return the window mean profiles of variables on the common vertical grid
+    opts["vertical_grid"].
+
+    The variables that are not cached yet are interpolated in one call per
+    vertical grid of the dataset (lev or ilev).
+
+    Returns:
+        dict: Variable -> numpy.ndarray of shape (window, level of the grid).
+    """
+    n_windows = len(opts["window_table"][idx]["profile"]) if opts["window_table"] is not None \
+        else min(ds[f"{v}__profile"].shape[0] for v in var_names)
+    key = (id(ds), "interp_profile") + _grid_key(opts)
+    if opts["window_table"] is not None:
+        key += (tuple(opts["window_table"][idx]["profile_bounds"]),)
+    missing = [v for v in var_names if key + (v,) not in _y_coord_cache]
+
+    groups = {}
+    for var_name in missing:
+        profiles = [profile_product(ds, idx, var_name, w, opts) for w in range(n_windows)]
+        groups.setdefault(profiles[0][0].shape, []).append((var_name, profiles))
+    for group in groups.values():
+        values = np.array([[p[0] for p in profiles] for _, profiles in group])
+        y_coord = np.array([[p[1] for p in profiles] for _, profiles in group])
+        with instrument("interpolation"):
+            result = interpolate_to_grid(y_coord, values, opts["vertical_grid"])
+        for (var_name, _), interpolated in zip(group, result):
+            _y_coord_cache[key + (var_name,)] = interpolated
+
+    return {v: _y_coord_cache[key + (v,)] for v in var_names}
+
+def interpolated_time_height(ds, idx, var_names, opts):
+    """
+    Return the time-height slabs of variables on the common vertical grid
+    opts["vertical_grid"], interpolated in one call per vertical grid of the
+    dataset for all time steps.
+
+    Returns:
+        dict: Variable -> (time in days, numpy.ndarray of shape (time, level
+            of the grid)); variables without data in the time range are left out.
+    """
+    key = (id(ds), "interp_time_height") + _grid_key(opts)
+    if opts["window_table"] is not None:
+        key += (opts["window_table"][idx]["time_height"].tobytes(),)
+    missing = [v for v in var_names if key + (v,) not in _y_coord_cache]
+
+    groups = {}
+    for var_name in missing:
+        product = time_height_product(ds, idx, var_name, opts["time_offset"], opts["height_cord"],
+                                      opts["time_height_time_s"], opts["time_height_time_e"],
+                                      opts["window_table"])
+        if product is None:
+            _y_coord_cache[key + (var_name,)] = None
+            continue
+        time_vals, y_coord, values = product
+        groups.setdefault((values.shape, y_coord.tobytes()), []).append((var_name, time_vals, y_coord, values))
+    for group in groups.values():
+        values = np.array([item[3] for item in group])
+        with instrument("interpolation"):
+            result = interpolate_to_grid(group[0][2], values, opts["vertical_grid"])
+        for (var_name, time_vals, _, _), interpolated in zip(group, result):
+            _y_coord_cache[key + (var_name,)] = (time_vals, interpolated)
+
+    products = {v: _y_coord_cache[key + (v,)] for v in var_names}
+    return {v: product for v, product in products.items() if product is not None}
+
+#################################
+###### Time binning
+
+# Datasets come at very different cadences (15 minute model averages, 1 second
+#  lidar, a few soundings a day, irregular radar).  To compare them they are
+#  averaged into the bins of a common time axis, in days since the start of the
+#  first dataset (time_offset applied), with the count of samples and the
+#  fraction of each bin covered by them.
+
+_time_bin_cache = {}
+
+def clear_time_bin_cache(ds=None):
+    """
+    Clear cached time bin means.
+
+    Parameters:
+        ds (xarray.Dataset, optional): Only clear the entries of this dataset.
+            If None the whole cache is cleared.
+    """
+    if ds is None:
+        _time_bin_cache.clear()
+        return
+    for key in [key for key in _time_bin_cache if key[0] == id(ds)]:
+        del _time_bin_cache[key]
+
+def _sample_interval(time_vals):
+    # Typical time between samples (median), None for fewer than two samples
+    steps = np.diff(np.sort(np.asarray(time_vals, dtype=float)))
+    steps = steps[steps > 0]
+    return float(np.median(steps)) if len(steps) else None
+
+def _dataset_series_times(ds, idx, opts):
+    # Times (days) of the time series range of a dataset
+    if opts["window_table"] is not None:
+        windows = opts["window_table"][idx]
+        return windows["time_in_days"][windows["timeseries"]]
+    return ds['ts_time'].values if 'ts_time' in ds.coords else np.array([])
+
+def common_time_axis(datasets, opts, width=None):
+    """
+    Return the bin edges of the common time axis: bins of width days (None
+    for the coarsest sampling interval of the datasets) spanning the time
+    series range of all datasets.
+
+    Returns:
+        list: The bin edges in days.
+    """
+    times = [_dataset_series_times(ds, idx, opts) for idx, ds in enumerate(datasets)]
+    times = [t for t in times if len(t)]
+    if not times:
+        return [0.0, 1.0]
+    start = min(float(np.min(t)) for t in times)
+    end = max(float(np.max(t)) for t in times)
+    if not width:
+        intervals = [interval for interval in map(_sample_interval, times) if interval]
+        width = max(intervals) if intervals else max(end - start, 1.0)
+    n_bins = max(1, int(np.ceil((end - start) / width - 1e-9)))
+    return [start + width * i for i in range(n_bins + 1)]
+
+def bin_to_time_axis(time_vals, values, edges, sample_interval=None):
+    """
+    Average samples into time bins.
+
+    Parameters:
+        time_vals (numpy.ndarray): Times of the samples, shape (time,).
+        values (numpy.ndarray): Samples, shape (time, ...); any number of
+            variables or levels can be stacked on the trailing axes.
+        edges (array-like): Bin edges (the last edge belongs to the last bin).
+        sample_interval (float): Time each sample represents, used for the
+            coverage; None for the median interval of time_vals.
+
+    Returns:
+        tuple: (mean, count, coverage), each of shape (bin, ...).  Bins without
+            a valid sample have a NaN mean; coverage is count * sample_interval
+            over the bin width, at most 1.
+    """
+    edges = np.asarray(edges, dtype=float)
+    time_vals = np.asarray(time_vals, dtype=float)
+    values = np.asarray(values, dtype=float)
+    n_bins = len(edges) - 1
+    flat = values.reshape(len(time_vals), -1)
+    n_cols = flat.shape[1]
+
+    bins = np.searchsorted(edges, time_vals, side='right') - 1
+    bins[time_vals == edges[-1]] = n_bins - 1
+    valid = np.isfinite(flat) & ((bins >= 0) & (bins < n_bins))[:, None]
+    index = (bins[:, None] * n_cols + np.arange(n_cols))[valid]
+    sums = np.bincount(index, weights=flat[valid], minlength=n_bins * n_cols).reshape(n_bins, n_cols)
+    counts = np.bincount(index, minlength=n_bins * n_cols).reshape(n_bins, n_cols)
+
+    if sample_interval is None:
+        sample_interval = _sample_interval(time_vals) or float(edges[-1] - edges[0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(counts > 0, sums / counts, np.nan)
+    coverage = np.minimum(counts * sample_interval / np.diff(edges)[:, None], 1.0)
+    shape = (n_bins,) + values.shape[1:]
+    return mean.reshape(shape), counts.reshape(shape), coverage.reshape(shape)
+
+def binned_timeseries(ds, idx, var_names, opts):
+    """
+    Return the time series of variables averaged into the bins of the common
+    time axis opts["time_bin_edges"].
+
+    The variables that are not cached yet are binned together in one call.
+
+    Returns:
+        dict: Variable -> (mean, count, coverage), each of shape (bin,).
+    """
+    edges = np.asarray(opts["time_bin_edges"], dtype=float)
+    key = (id(ds), edges.tobytes())
+    missing = [v for v in var_names if key + (v,) not in _time_bin_cache]
+    if missing:
+        series = [timeseries_product(ds, idx, v, opts) for v in missing]
+        with instrument("time_binning"):
+            mean, count, coverage = bin_to_time_axis(series[0][0], np.stack([s[1] for s in series], axis=-1), edges)
+        for i, var_name in enumerate(missing):
+            _time_bin_cache[key + (var_name,)] = (mean[:, i], count[:, i], coverage[:, i])
+    return {v: _time_bin_cache[key + (v,)] for v in var_names}
+
+#################################
+###### Skill metrics
+
+# Bias, RMSE, correlation and standard deviation ratio of every dataset against a
+#  reference dataset.  The profiles and time series of all variables of a dataset
+#  are stacked and scored with one set of array operations.
+
+SKILL_METRICS = ["bias", "rmse", "correlation", "std_ratio", "n"]
+
+def skill_metrics(values, reference):
+    """
+    Score values against reference along the last axis.  Pairs where either
+    is NaN are skipped.
+
+    Parameters:
+        values, reference (numpy.ndarray): Arrays of the same shape, i.e.
+            (variable, window, level) or (variable, time).
+
+    Returns:
+        dict: 'bias', 'rmse', 'correlation', 'std_ratio' (standard deviation of
+            values over that of reference) and 'n' (number of valid pairs),
+            each an array of the leading shape.
+    """
+    valid = np.isfinite(values) & np.isfinite(reference)
+    n = valid.sum(axis=-1)
+    x = np.where(valid, values, 0.0)
+    y = np.where(valid, reference, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = x.sum(axis=-1) / n
+        mean_y = y.sum(axis=-1) / n
+        dx = np.where(valid, x - mean_x[..., None], 0.0)
+        dy = np.where(valid, y - mean_y[..., None], 0.0)
+        std_x = np.sqrt((dx**2).sum(axis=-1) / n)
+        std_y = np.sqrt((dy**2).sum(axis=-1) / n)
+        return {
+            "bias": mean_x - mean_y,
+            "rmse": np.sqrt(((x - y)**2).sum(axis=-1) / n),
+            "correlation": (dx * dy).sum(axis=-1) / n / (std_x * std_y),
+            "std_ratio": std_x / std_y,
+            "n": n,
+        }
+
+def _metric_rows(scores, var_names, windows, short_id, reference_id, kind):
+    # One row per variable (and window) of the scored stack
+    rows = []
+    for i, var_name in enumerate(var_names):
+        for j, window in enumerate(windows):
+            row = {"variable": var_name, "kind": kind, "window": window,
+                   "dataset": short_id, "reference": reference_id}
+            for metric in SKILL_METRICS:
+                value = scores[metric][i] if window is None else scores[metric][i, j]
+                row[metric] = int(value) if metric == "n" else (float(value) if np.isfinite(value) else None)
+            rows.append(row)
+    return rows
+
+def compute_skill_metrics(datasets, opts):
+    """
+    Compute the skill metrics of every dataset against the reference dataset
+    opts["reference_index"] for every shared profile variable (per averaging
+    window, on the common vertical grid) and time series variable (bin means
+    on the common time axis, see binned_timeseries).
+
+    Returns:
+        list: One dict per variable, window and dataset, with 'variable',
+            'kind' ('profile' or 'timeseries'), 'window' (1-based, None for time
+            series), 'dataset', 'reference' and the SKILL_METRICS.
+    """
+    ref = opts["reference_index"]
+    var_index = opts["var_index"]
+    short_ids = opts["short_ids"]
+    shared = lambda shape: [v for v in variables_of_shape(var_index, shape) if ref in var_index[v]["datasets"]]
+    profile_vars = shared('profile')
+    timeseries_vars = shared('timeseries')
+
+    ref_profiles = interpolated_profiles(datasets[ref], ref, profile_vars, opts)
+    ref_series = binned_timeseries(datasets[ref], ref, timeseries_vars, opts)
+
+    rows = []
+    for idx, ds in enumerate(datasets):
+        if idx == ref:
+            continue
+        var_names = [v for v in profile_vars if idx in var_index[v]["datasets"]]
+        if var_names:
+            profiles = interpolated_profiles(ds, idx, var_names, opts)
+            scores = skill_metrics(np.array([profiles[v] for v in var_names]),
+                                   np.array([ref_profiles[v] for v in var_names]))
+            windows = list(range(1, scores["n"].shape[1] + 1))
+            rows += _metric_rows(scores, var_names, windows, short_ids[idx], short_ids[ref], "profile")
+
+        var_names = [v for v in timeseries_vars if idx in var_index[v]["datasets"]]
+        if var_names:
+            series = binned_timeseries(ds, idx, var_names, opts)
+            scores = skill_metrics(np.array([series[v][0] for v in var_names]),
+                                   np.array([ref_series[v][0] for v in var_names]))
+            rows += _metric_rows(scores, var_names, [None], short_ids[idx], short_ids[ref], "timeseries")
+    return rows
+
+def write_skill_metrics(rows, report_dir):
+    """
+    Write the skill metrics to metrics.csv and metrics.json.
+
+    Parameters:
+        rows (list): Rows returned by compute_skill_metrics.
+        report_dir (str): Output directory.
+    """
+    columns = ["variable", "kind", "window", "dataset", "reference"] + SKILL_METRICS
+    with open(os.path.join(report_dir, "metrics.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(os.path.join(report_dir, "metrics.json"), "w") as f:
+        json.dump(rows, f, indent=1)
+
+#################################
+###### Display decimation
+
+# Long series (months of 15 minute output, 1 second lidar) have many more samples
+#  than the saved image has pixels.  Before plotting, series are reduced to the
+#  first, last, minimum and maximum sample of each pixel column of the axes, which
+#  draws the same line, and time-height data are averaged over blocks of times so
+#  that there is about one time per pixel column.  Set decimate = False for exact
+#  plotting.
+
+def axes_pixel_width(ax):
+    """
+    Return the width in pixels of an axes in the saved figure.
+    """
+    fig = ax.figure
+    dpi = plt.rcParams['savefig.dpi']
+    dpi = fig.dpi if dpi == 'figure' else dpi
+    return max(1, int(round(ax.get_position().width * fig.get_size_inches()[0] * dpi)))
+
+def minmax_decimation_indices(x, y, n_pixels):
+    """
+    Return the indices of the samples to plot for a line drawn over n_pixels
+    pixel columns: the first, last, minimum and maximum sample of the samples
+    falling in each column.
+
+    Parameters:
+        x (numpy.ndarray): Sorted coordinates of the samples, shape (n,).
+        y (numpy.ndarray): Values, shape (n,); NaN values are never chosen as
+            minimum or maximum.
+        n_pixels (int): Number of pixel columns.
+
+    Returns:
+        numpy.ndarray: Sorted sample indices; all indices if there are fewer
+            than four samples per column.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) <= 4 * n_pixels or not x[-1] > x[0]:
+        return np.arange(len(x))
+
+    columns = np.minimum(((x - x[0]) / (x[-1] - x[0]) * n_pixels).astype(int), n_pixels - 1)
+    starts = np.flatnonzero(np.r_[True, columns[1:] != columns[:-1]])
+    ends = np.r_[starts[1:], len(x)] - 1
+
+    column_of = np.repeat(np.arange(len(starts)), ends - starts + 1)
+
+    def first_match(column_values):
+        # First sample of each column equal to its value (NaN never matches)
+        hit = np.flatnonzero(y == column_values[column_of])
+        return hit[np.r_[True, column_of[hit][1:] != column_of[hit][:-1]]] if len(hit) else hit
+
+    minimum = first_match(np.fmin.reduceat(y, starts))
+    maximum = first_match(np.fmax.reduceat(y, starts))
+    return np.unique(np.concatenate([starts, ends, minimum, maximum]))
+
+def decimate_series(x, series, n_pixels):
+    """
+    Decimate one or more series sharing the coordinate x, keeping the samples
+    chosen by minmax_decimation_indices for any of them.
+
+    Returns:
+        tuple: (x, list of series) at the kept samples.
+    """
+    series = [np.asarray(y) for y in series]
+    keep = np.unique(np.concatenate([minmax_decimation_indices(x, y, n_pixels) for y in series]))
+    if len(keep) == len(x):
+        return x, series
+    return np.asarray(x)[keep], [y[keep] for y in series]
+
+def time_block_average(time_vals, data, n_pixels):
+    """
+    Average time-height data over blocks of consecutive times so that there
+    are at most n_pixels times.
+
+    Parameters:
+        time_vals (numpy.ndarray): Times, shape (time,).
+        data (numpy.ndarray): Values, shape (time, level).
+        n_pixels (int): Number of pixel columns.
+
+    Returns:
+        tuple: (time_vals, data) of the blocks; the input if it has at most
+            n_pixels times.
+    """
+    n_time = len(time_vals)
+    block = -(-n_time // n_pixels)
+    if block < 2:
+        return time_vals, data
+    n_blocks = -(-n_time // block)
+    pad = n_blocks * block - n_time
+    times = np.concatenate([np.asarray(time_vals, dtype=float), np.full(pad, np.nan)])
+    values = np.concatenate([np.asarray(data, dtype=float), np.full((pad,) + data.shape[1:], np.nan)])
+
+    def block_mean(a):
+        a = a.reshape((n_blocks, block) + a.shape[1:])
+        finite = np.isfinite(a)
+        counts = finite.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, np.where(finite, a, 0.0).sum(axis=1) / counts, np.nan)
+
+    return block_mean(times), block_mean(values)
+
+#################################
+###### Plot tasks
+
+# Variables needed to build the vertical coordinate; never dropped when subsetting
+COORDINATE_VARIABLES = ['z_mid', 'z_mid_horiz_avg', 'Z3', 'PS', 'ps', 'ps_horiz_avg',
+                        'hyam', 'hybm', 'hyai', 'hybi', 'p_mid_obs', 'p_mid_les']
+
+# Derived fields: name -> (input variables, long_name).  The field is the sum of
+#  its inputs and takes the units of the first input.
+DERIVED_VARIABLES = {
+    'PRECT': (('PRECC', 'PRECL'), 'Total Surface Precipitation Rate'),
+}
+
+def add_derived_variables(ds):
+    """
+    Add the derived fields of DERIVED_VARIABLES whose inputs are in the dataset.
+
+    For dask-backed datasets the fields are only computed when they are used.
+    """
+    for var_name, (inputs, long_name) in DERIVED_VARIABLES.items():
+        if var_name in ds.data_vars or not all(v in ds.data_vars for v in inputs):
+            continue
+        ds[var_name] = sum(ds[v] for v in inputs)
+        # Add metadata
+        ds[var_name].attrs['long_name'] = long_name
+        ds[var_name].attrs['units'] = ds[inputs[0]].attrs.get('units', 'm/s')
+    return ds
+
+def expand_filenames(fp):
+    """
+    Expand the filename of a dataset into a list of files.
+
+    Parameters:
+        fp (str or list): Path of a netCDF file, a glob pattern (i.e.
+            "run/case.eam.h0.*.nc") or a list of paths and patterns.
+
+    Returns:
+        list: The paths of the files, glob matches in sorted order.
+    """
+    patterns = [fp] if isinstance(fp, str) else list(fp)
+    files = []
+    for pattern in patterns:
+        if any(char in pattern for char in "*?["):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError(f"No files match '{pattern}'.")
+            files.extend(matches)
+        else:
+            files.append(pattern)
+    if not files:
+        raise ValueError("Empty list of files for a dataset.")
+    return files
+
+def _signed_day_difference(ref_date, ref_seconds, date, seconds):
+    # Days from the reference time to (date, seconds); negative if earlier
+    difference = compute_date_time_difference(ref_date, ref_seconds, date, seconds)
+    return difference if (date, seconds) >= (ref_date, ref_seconds) else -difference
+
+def open_multi_file_dataset(files, open_kwargs):
+    """
+    Open several history files of one simulation as a single dataset,
+    concatenated along time.
+
+    The time of every file is put on the time axis (and units) of the file
+    that starts first.  Files are ordered by their first time; where restart segments
+    overlap, the time steps of the earlier segment that are repeated by the
+    later one are dropped.  Variables that are not in every file are skipped.
+
+    Parameters:
+        files (list): Paths of the netCDF files.
+        open_kwargs (dict): Arguments passed to xarray.open_dataset.
+
+    Returns:
+        xarray.Dataset: The concatenated dataset; closing it closes every file.
+    """
+    parts = [xr.open_dataset(f, **open_kwargs) for f in files]
+    for f, part in zip(files, parts):
+        if 'time' not in part.dims:
+            raise ValueError(f"File {f} has no time dimension and cannot be concatenated.")
+
+    ref_date, ref_seconds = extract_time_info(parts[0])
+    times = []
+    offsets = []
+    for part in parts:
+        date, seconds = extract_time_info(part)
+        offset = 0.0
+        if ref_date != -999 and date != -999:
+            offset = _signed_day_difference(ref_date, ref_seconds, date, seconds)
+        offsets.append(offset)
+        times.append(np.asarray(part['time'].values, dtype=float) + offset)
+
+    order = sorted(range(len(parts)), key=lambda i: times[i][0] if len(times[i]) else np.inf)
+    first = parts[order[0]]
+    times = [time_vals - offsets[order[0]] for time_vals in times]
+    common = set.intersection(*[set(part.data_vars) for part in parts])
+    skipped = sorted(set.union(*[set(part.data_vars) for part in parts]) - common)
+    if skipped:
+        print(f"Warning: Variables not in every file of {files[0]} and others are skipped: {', '.join(skipped)}")
+
+    pieces = []
+    n_dropped = 0
+    for position, i in enumerate(order):
+        time_vals = times[i]
+        # Unique, increasing times within the file
+        _, keep = np.unique(time_vals, return_index=True)
+        # Drop the times repeated by the next restart segment
+        if position + 1 < len(order) and len(times[order[position + 1]]):
+            keep = keep[time_vals[keep] < times[order[position + 1]][0]]
+        n_dropped += len(time_vals) - len(keep)
+        if len(keep) == 0:
+            continue
+        piece = parts[i][[v for v in first.data_vars if v in common]].isel(time=keep)
+        pieces.append(piece.assign_coords(time=('time', time_vals[keep], first['time'].attrs)))
+
+    if n_dropped:
+        print(f"Removed {n_dropped} duplicate or overlapping time steps from {files[0]} and others.")
+
+    combined = xr.concat(pieces, dim='time', data_vars='minimal', coords='minimal',
+                         compat='override', join='override', combine_attrs='override')
+
+    # Warn about gaps between the files (i.e. a missing history file)
+    time_vals = combined['time'].values
+    if len(time_vals) > 2:
+        steps = np.diff(time_vals)
+        dt = np.median(steps)
+        n_gaps = int(np.sum(steps > 1.5 * dt))
+        if n_gaps:
+            print(f"Warning: {n_gaps} gaps in the time coordinate of {files[0]} and others.")
+
+    combined.encoding['source'] = f"{files[0]} (+{len(files) - 1} files)"
+    combined.set_close(lambda: [part.close() for part in parts])
+    return combined
+
+def open_ensemble_dataset(files, open_kwargs):
+    """
+    Open the member files of an ensemble as a single dataset with a 'member'
+    dimension.
+
+    Time dependent variables are stacked along 'member'; the vertical
+    coordinate variables are averaged over the members, so every member is
+    plotted on the same grid.  Members are cut to the shortest time axis.
+
+    Parameters:
+        files (list): Paths of the netCDF files, one per member.
+        open_kwargs (dict): Arguments passed to xarray.open_dataset.
+
+    Returns:
+        xarray.Dataset: The stacked dataset; closing it closes every file.
+    """
+    parts = [xr.open_dataset(f, **open_kwargs) for f in files]
+    for f, part in zip(files, parts):
+        if 'time' not in part.dims:
+            raise ValueError(f"Ensemble member {f} has no time dimension.")
+        if 'ncol' in part.dims and part.sizes['ncol'] > 1:
+            raise ValueError(f"Ensemble member {f} is full-field output; ensembles need horizontally "
+                             "averaged output.")
+
+    n_time = min(part.sizes['time'] for part in parts)
+    if any(part.sizes['time'] != n_time for part in parts):
+        print(f"Warning: Ensemble members of {files[0]} differ in length; using the first {n_time} time steps.")
+    common = set.intersection(*[set(part.data_vars) for part in parts])
+    first = parts[0]
+    stacked = [v for v in first.data_vars if v in common and 'time' in first[v].dims]
+    fixed = [v for v in first.data_vars if v in common and 'time' not in first[v].dims]
+
+    members = xr.concat([part[stacked].isel(time=slice(0, n_time)) for part in parts], dim='member',
+                        data_vars='all', coords='minimal', compat='override', join='override',
+                        combine_attrs='override')
+    for var_name in COORDINATE_VARIABLES:
+        if var_name in members.data_vars:
+            members[var_name] = members[var_name].mean(dim='member', keep_attrs=True)
+    ds = xr.merge([members, first[fixed]], compat='override', combine_attrs='override')
+
+    ds.attrs['ensemble_members'] = len(files)
+    ds.encoding['source'] = f"{files[0]} (ensemble of {len(files)} members)"
+    ds.set_close(lambda: [part.close() for part in parts])
+    return ds
+
+def load_dataset(fp, lazy_load=False, time_chunk=None, drop_variables=None, ensemble=False):
+    """
+    Open a diagnostics dataset and add derived fields.
+
+    Parameters:
+        fp (str or list): Path to the netCDF file, a glob pattern or a list of
+            files that are concatenated along time (see open_multi_file_dataset),
+            or the members of an ensemble.
+        lazy_load (bool): Open the file with dask chunks along time, so that
+            reductions stream through the data rather than loading whole variables.
+        time_chunk (int): Number of time steps per chunk, None lets dask choose.
+        drop_variables (list): Variables in the file that should not be read.
+        ensemble (bool): The files are ensemble members (see open_ensemble_dataset).
+
+    Returns:
+        xarray.Dataset: The opened dataset.
+    """
+    files = expand_filenames(fp)
+    shared = _shared_datasets.get(tuple(os.path.abspath(f) for f in files)) if not ensemble else None
+    if shared is not None:
+        # In-memory copy shared by the cases of a campaign, see share_datasets
+        return shared.drop_vars(drop_variables or [], errors='ignore')
+
+    open_kwargs = {'decode_times': False, 'drop_variables': drop_variables}
+    if lazy_load and HAS_DASK:
+        open_kwargs['chunks'] = {'time': time_chunk if time_chunk else 'auto'}
+    elif len(files) > 1 and HAS_DASK:
+        # One chunk per file, so the files are only read when a stage needs them
+        open_kwargs['chunks'] = {}
+
+    if ensemble:
+        ds = open_ensemble_dataset(files, open_kwargs)
+    elif len(files) > 1:
+        ds = open_multi_file_dataset(files, open_kwargs)
+    else:
+        ds = xr.open_dataset(files[0], **open_kwargs)
+    return add_derived_variables(ds)
+
+def select_dataset_variables(ds, var_index):
+    """
+    Return the variables of a file that are not needed by the diagnostics.
+
+    Kept are the variables in var_index, the vertical coordinate variables and
+    the inputs of any derived field that is kept.
+
+    Parameters:
+        ds (xarray.Dataset): The opened dataset.
+        var_index (dict): Variable index (see classify_variables).
+
+    Returns:
+        list: Names of the variables that can be dropped.
+    """
+    keep = set(var_index) | set(COORDINATE_VARIABLES)
+    for var_name, (inputs, _) in DERIVED_VARIABLES.items():
+        if var_name in keep:
+            keep.update(inputs)
+    return [v for v in ds.data_vars if v not in keep and v not in DERIVED_VARIABLES]
+
+#################################
+###### Conditional sampling
+
+# Masks select columns (or grid cells) of full-field output, i.e. cloudy cores
+#  "qc > 1e-5 and omega < 0".  They are evaluated on every time chunk of the
+#  horizontal averaging pass (see horizontal_average), so a run is read once
+#  for all masks.
+
+GRAVITY = 9.80616  # m/s2, as in E3SM
+
+def _mask_logical_and(*values):
+    return np.logical_and.reduce(values)
+
+def _mask_logical_or(*values):
+    return np.logical_or.reduce(values)
+
+class _MaskExpressionTransformer(ast.NodeTransformer):
+    # Rewrite 'and', 'or' and 'not' into element-wise functions of arrays
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        func = '_and' if isinstance(node.op, ast.And) else '_or'
+        return ast.copy_location(ast.Call(func=ast.Name(id=func, ctx=ast.Load()), args=node.values, keywords=[]), node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(ast.Call(func=ast.Name(id='_not', ctx=ast.Load()),
+                                              args=[node.operand], keywords=[]), node)
+        return node
+
+# Syntax allowed in mask expressions; anything else (calls, attributes, ...) is rejected
+_MASK_UNARY_OPERATORS = (ast.Not, ast.Invert, ast.USub, ast.UAdd)
+_MASK_COMPARISONS = (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+def _mask_node_allowed(node):
+    if isinstance(node, ast.BinOp):
+        return isinstance(node.op, (ast.BitAnd, ast.BitOr))
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, _MASK_UNARY_OPERATORS)
+    if isinstance(node, ast.Compare):
+        return all(isinstance(op, _MASK_COMPARISONS) for op in node.ops)
+    if isinstance(node, ast.Constant):
+        return type(node.value) in (int, float)
+    # The operators themselves are checked with the node using them
+    return isinstance(node, (ast.Expression, ast.BoolOp, ast.Name, ast.Load,
+                             ast.boolop, ast.operator, ast.unaryop, ast.cmpop))
+
+def parse_conditional_mask(expression):
+    """
+    Compile a mask expression, i.e. "qc > 1e-5 and omega < 0".
+
+    The expression may only use variable names, numbers, comparisons, 'and',
+    'or', 'not' and the element-wise &, |, ~ (with parentheses).
+
+    Returns:
+        tuple: (compiled expression, sorted list of the variable names used).
+    """
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Invalid conditional sampling mask '{expression}': {e}")
+    for node in ast.walk(tree):
+        if not _mask_node_allowed(node):
+            raise ValueError(f"Invalid conditional sampling mask '{expression}': '{ast.unparse(node)}' is not "
+                             "allowed; use variable names, numbers, comparisons, 'and', 'or', 'not', '&', '|' and '~'.")
+    names = sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name)})
+    tree = ast.fix_missing_locations(_MaskExpressionTransformer().visit(tree))
+    return compile(tree, f"<mask {expression}>", 'eval'), names
+
+def evaluate_conditional_mask(expression, code, values):
+    """
+    Evaluate a compiled mask on arrays of the variables it uses.
+
+    Returns:
+        numpy.ndarray: Boolean mask, broadcast to the shape of the arrays.
+    """
+    namespace = {'_and': _mask_logical_and, '_or': _mask_logical_or, '_not': np.logical_not}
+    namespace.update(values)
+    try:
+        mask = eval(code, {'__builtins__': {}}, namespace)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Cannot evaluate conditional sampling mask '{expression}': {e}. "
+                         "Combine conditions with 'and'/'or' or put them in parentheses, i.e. "
+                         "'(qc > 1e-5) & (omega < 0)'.")
+    return np.broadcast_to(np.asarray(mask, dtype=bool), np.broadcast_shapes(*[v.shape for v in values.values()]))
+
+def conditional_sample_names(conditional_masks, conditional_variables=None):
+    """
+    Names of the variables made by conditional sampling: '<mask>_fraction',
+    '<mask>_mass_flux' and '<variable>_<mask>' for every sampled variable.
+    """
+    names = []
+    for mask_name, expression in (conditional_masks or {}).items():
+        sampled = conditional_variables if conditional_variables is not None else parse_conditional_mask(expression)[1]
+        names += [f"{mask_name}_fraction", f"{mask_name}_mass_flux"] + [f"{v}_{mask_name}" for v in sampled]
+    return names
+
+def _masked_sum(values, mask, weights):
+    # Weighted sum over columns (axis 1) of values where mask is set, and the weight summed
+    if values.ndim == 2:
+        values = values[:, :, None]
+    w = np.where(mask & np.isfinite(values), weights[None, :, None], 0.0)
+    return (np.where(w > 0, values, 0.0) * w).sum(axis=1), w.sum(axis=1)
+
+#################################
+###### Horizontal averaging
+
+# Full-field output (i.e. DP-EAMxx without *_horiz_avg) holds every column of
+#  the domain in an 'ncol' dimension.  It is reduced to domain means once, in a
+#  single pass over time chunks, and the plots are made from the means.
+
+def is_full_field(ds):
+    """
+    Return True if the dataset holds more than one column.
+    """
+    return 'ncol' in ds.dims and ds.sizes['ncol'] > 1
+
+def _column_statistics(values, weights, variance):
+    # Weighted mean (and variance) over axis 1 of values, NaNs skipped
+    finite = np.isfinite(values)
+    w = np.where(finite, weights.reshape((1, -1) + (1,) * (values.ndim - 2)), 0.0)
+    wsum = w.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(finite, values, 0.0)
+        mean = (mean * w).sum(axis=1) / wsum
+        if not variance:
+            return mean, None
+        anomaly = np.where(finite, values - np.expand_dims(mean, 1), 0.0)
+        return mean, (anomaly**2 * w).sum(axis=1) / wsum
+
+def _horizontal_average_signature(fp, variables, variance, histograms=None, joint_histograms=None,
+                                  conditional_masks=None, conditional_variables=None):
+    files = expand_filenames(fp)
+    return json.dumps({"files": [[os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f)] for f in files],
+                       "variables": sorted(variables) if variables is not None else None,
+                       "variance": bool(variance),
+                       "histograms": _histogram_settings(histograms),
+                       "joint_histograms": [list(pair) for pair in joint_histograms or []],
+                       "conditional_masks": conditional_masks or {},
+                       "conditional_variables": conditional_variables},
+                      default=lambda x: x.tolist() if isinstance(x, np.ndarray) else str(x))
+
+def _histogram_settings(histograms):
+    # Histogram variables as a dict of variable -> bin edges (None for automatic)
+    if histograms is None:
+        return {}
+    if isinstance(histograms, dict):
+        return {k: (np.asarray(v, dtype=float) if v is not None else None) for k, v in histograms.items()}
+    return {var_name: None for var_name in histograms}
+
+def automatic_bin_edges(values, n_bins=40):
+    """
+    Bin edges spanning the range of values (widened around a constant value).
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return np.linspace(0.0, 1.0, n_bins + 1)
+    lo, hi = float(values.min()), float(values.max())
+    pad = 0.0 if hi > lo else max(abs(lo), 1.0) * 0.5
+    return np.linspace(lo - pad, hi + pad, n_bins + 1)
+
+def _value_ranges(ds, var_names, time_chunk):
+    # Minimum and maximum of variables over the whole run, read in time chunks
+    lo = {v: np.inf for v in var_names}
+    hi = {v: -np.inf for v in var_names}
+    for start in range(0, ds.sizes['time'], time_chunk):
+        for var_name in var_names:
+            values = np.asarray(ds[var_name].isel(time=slice(start, start + time_chunk)).values, dtype=float)
+            values = values[np.isfinite(values)]
+            if values.size:
+                lo[var_name] = min(lo[var_name], float(values.min()))
+                hi[var_name] = max(hi[var_name], float(values.max()))
+    return {v: [lo[v], hi[v]] for v in var_names}
+
+def _bin_indices(values, edges):
+    # Bin of every value, and whether it falls inside the edges (last edge included)
+    n_bins = len(edges) - 1
+    bins = np.searchsorted(edges, values, side='right') - 1
+    bins[values == edges[-1]] = n_bins - 1
+    valid = np.isfinite(values) & (bins >= 0) & (bins < n_bins)
+    return bins, valid
+
+def horizontal_average(ds, time_chunk=None, variance=False, variables=None, max_chunk_values=2**25,
+                       histograms=None, joint_histograms=None, conditional_masks=None,
+                       conditional_variables=None):
+    """
+    Reduce full-field output to domain means in one pass over time chunks.
+
+    Only one chunk of each variable is in memory at a time, so the memory use
+    does not depend on the length of the run.  Columns are weighted by 'area'
+    if the dataset has it.  Histograms across the columns are accumulated in
+    the same pass with fixed bin edges: CFADs (counts per vertical level) of
+    variables with a vertical dimension, plain histograms of the others and
+    joint histograms of pairs of variables.  Conditional sampling masks are
+    evaluated on the same chunks.
+
+    Parameters:
+        ds (xarray.Dataset): Dataset with an 'ncol' dimension.
+        time_chunk (int): Number of time steps per chunk; None picks the largest
+            chunk with at most max_chunk_values values of all variables.
+        variance (bool): Also compute the variance across columns of every
+            field, stored as '<variable>_horiz_variance'.
+        variables (list): Only average these variables (and the vertical
+            coordinate variables); None averages every variable.
+        max_chunk_values (int): See time_chunk.
+        histograms (list or dict): Variables to accumulate histograms of, or
+            a dict of variable -> bin edges (None for automatic_bin_edges of
+            the range over the whole run, found in a first pass over the
+            chunks of those variables).  Values outside given edges are not
+            counted; the fraction left out is reported.  Stored as '<variable>__cfad' or
+            '<variable>__histogram' with edges '<variable>__bin_edges'.
+        joint_histograms (list): Pairs (x, y) of variables of the same shape,
+            stored as '<x>__<y>__joint'.  Both need histogram bin edges.
+        conditional_masks (dict): Mask name -> expression (see
+            parse_conditional_mask).  Every mask gives the fraction of the
+            domain it selects ('<mask>_fraction'), the mass flux -omega/g in
+            it ('<mask>_mass_flux') and the means of the sampled variables in
+            it ('<variable>_<mask>').
+        conditional_variables (list): Variables sampled by every mask; None
+            samples the variables used in each mask.
+
+    Returns:
+        xarray.Dataset: The domain means, without the 'ncol' dimension.
+    """
+    edges = _histogram_settings(histograms)
+    joint_histograms = [tuple(pair) for pair in joint_histograms or []]
+    for pair in joint_histograms:
+        for var_name in pair:
+            edges.setdefault(var_name, None)
+
+    masks = {}
+    for mask_name, expression in (conditional_masks or {}).items():
+        if not mask_name.isidentifier():
+            raise ValueError(f"Conditional sampling mask name '{mask_name}' must be a valid variable name.")
+        code, mask_vars = parse_conditional_mask(expression)
+        sampled = conditional_variables if conditional_variables is not None else mask_vars
+        masks[mask_name] = {'expression': expression, 'code': code, 'variables': mask_vars, 'sampled': list(sampled)}
+
+    keep = None
+    if variables is not None:
+        keep = set(variables) | set(COORDINATE_VARIABLES) | set(edges)
+        for mask in masks.values():
+            keep.update(mask['variables'] + mask['sampled'] + ['omega'])
+        for var_name, (inputs, _) in DERIVED_VARIABLES.items():
+            if var_name in keep:
+                keep.update(inputs)
+
+    names = []
+    out = xr.Dataset(attrs=ds.attrs)
+    for var_name, da in ds.data_vars.items():
+        if var_name in DERIVED_VARIABLES or (keep is not None and var_name not in keep):
+            continue
+        if 'ncol' not in da.dims:
+            out[var_name] = da.load()
+        elif 'time' in da.dims and da.dtype.kind in 'fiu':
+            names.append(var_name)
+
+    for var_name in list(edges):
+        if var_name not in names:
+            print(f"Warning: No histograms of '{var_name}', which is not a full-field variable of "
+                  f"{ds.encoding.get('source', 'dataset')}.")
+            del edges[var_name]
+        elif ds[var_name].ndim > 3:
+            print(f"Warning: No histograms of '{var_name}', which has more than one non-column dimension.")
+            del edges[var_name]
+    joint_histograms = [(x, y) for x, y in joint_histograms if x in edges and y in edges
+                        and ds[x].transpose('time', 'ncol', ...).shape == ds[y].transpose('time', 'ncol', ...).shape]
+
+    for mask_name, mask in list(masks.items()):
+        vert_dims = {_vertical_dim(ds[v]) for v in mask['variables'] if v in names}
+        if any(v not in names or ds[v].ndim > 3 for v in mask['variables']) or len(vert_dims - {None}) > 1:
+            print(f"Warning: Conditional sampling mask '{mask_name}' is skipped; it must use full-field "
+                  f"variables on a single vertical grid.")
+            del masks[mask_name]
+            continue
+        # A mask without a vertical dimension selects whole columns
+        mask['vert_dim'] = (vert_dims - {None}).pop() if vert_dims - {None} else None
+        compatible = lambda v: v in names and ds[v].ndim <= 3 and (
+            mask['vert_dim'] is None or _vertical_dim(ds[v]) == mask['vert_dim'])
+        mask['sampled'] = [v for v in mask['sampled'] if compatible(v)]
+        mask['mass_flux'] = compatible('omega') and _vertical_dim(ds['omega']) is not None
+    mask_vars = {v for mask in masks.values() for v in mask['variables']}
+
+    weights = np.ones(ds.sizes['ncol'])
+    if 'area' in ds.data_vars and ds['area'].dims == ('ncol',):
+        weights = np.asarray(ds['area'].values, dtype=float)
+
+    n_time = ds.sizes['time']
+    if not time_chunk:
+        values_per_step = sum(ds[v].size // max(n_time, 1) for v in names)
+        time_chunk = max(1, int(max_chunk_values // max(values_per_step, 1)))
+    print(f"Computing horizontal means of {ds.encoding.get('source', 'dataset')} "
+          f"({ds.sizes['ncol']} columns) in chunks of {time_chunk} time steps")
+
+    # Automatic bin edges span the whole run, so no value falls outside them
+    automatic = [v for v, var_edges in edges.items() if var_edges is None]
+    for var_name, value_range in _value_ranges(ds, automatic, time_chunk).items():
+        edges[var_name] = automatic_bin_edges(value_range)
+
+    means = {}
+    variances = {}
+    counts = {}
+    n_binned = {}
+    for var_name in names:
+        dims = ('time',) + tuple(d for d in ds[var_name].dims if d not in ('time', 'ncol'))
+        shape = tuple(ds.sizes[d] for d in dims)
+        means[var_name] = (dims, np.empty(shape))
+        if variance and var_name not in COORDINATE_VARIABLES:
+            variances[var_name] = (dims, np.empty(shape))
+
+    # Conditional sampling outputs: name -> (dims, values, attrs)
+    sampled = {}
+    total_weight = weights.sum()
+    for mask_name, mask in masks.items():
+        mask_dims = ('time',) + ((mask['vert_dim'],) if mask['vert_dim'] else ())
+        label = f"{mask_name}: {mask['expression']}"
+        sampled[f"{mask_name}_fraction"] = (mask_dims, np.empty(tuple(ds.sizes[d] for d in mask_dims)),
+                                            {'long_name': f"Fraction of domain ({label})", 'units': '1'})
+        if mask['mass_flux']:
+            dims = means['omega'][0]
+            sampled[f"{mask_name}_mass_flux"] = (dims, np.empty(tuple(ds.sizes[d] for d in dims)),
+                                                 {'long_name': f"Mass flux ({label})", 'units': 'kg/m2/s'})
+        for var_name in mask['sampled']:
+            dims = means[var_name][0]
+            attrs = {'long_name': f"{ds[var_name].attrs.get('long_name', var_name)} ({label})"}
+            if 'units' in ds[var_name].attrs:
+                attrs['units'] = ds[var_name].attrs['units']
+            sampled[f"{var_name}_{mask_name}"] = (dims, np.empty(tuple(ds.sizes[d] for d in dims)), attrs)
+
+    for start in range(0, n_time, time_chunk):
+        block = slice(start, min(start + time_chunk, n_time))
+        binned = {}
+
+        # The variables of the masks are read first and reused below
+        chunk_values = {v: np.asarray(ds[v].isel(time=block).transpose('time', 'ncol', ...).values, dtype=float)
+                        for v in mask_vars}
+        mask_values = {}
+        for mask_name, mask in masks.items():
+            arrays = {v: chunk_values[v] if chunk_values[v].ndim == 3 else chunk_values[v][:, :, None]
+                      for v in mask['variables']}
+            mask_values[mask_name] = evaluate_conditional_mask(mask['expression'], mask['code'], arrays)
+            fraction = (mask_values[mask_name] * weights[None, :, None]).sum(axis=1) / total_weight
+            sampled[f"{mask_name}_fraction"][1][block] = fraction if mask['vert_dim'] else fraction[:, 0]
+
+        for var_name in names:
+            if var_name in chunk_values:
+                values = chunk_values[var_name]
+            else:
+                da = ds[var_name].isel(time=block).transpose('time', 'ncol', ...)
+                values = np.asarray(da.values, dtype=float)
+
+            for mask_name, mask in masks.items():
+                if var_name in mask['sampled']:
+                    total, wsum = _masked_sum(values, mask_values[mask_name], weights)
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        mean = np.where(wsum > 0, total / wsum, np.nan)
+                    target = sampled[f"{var_name}_{mask_name}"][1]
+                    target[block] = mean.reshape((mean.shape[0],) + target.shape[1:])
+                if var_name == 'omega' and mask['mass_flux']:
+                    total, _ = _masked_sum(-values / GRAVITY, mask_values[mask_name], weights)
+                    sampled[f"{mask_name}_mass_flux"][1][block] = total / total_weight
+
+            mean, var = _column_statistics(values, weights, var_name in variances)
+            means[var_name][1][block] = mean
+            if var_name in variances:
+                variances[var_name][1][block] = var
+
+            if var_name in edges:
+                n_bins = len(edges[var_name]) - 1
+                bins, valid = _bin_indices(values, edges[var_name])
+                finite, inside = n_binned.get(var_name, (0, 0))
+                n_binned[var_name] = (finite + int(np.isfinite(values).sum()), inside + int(valid.sum()))
+                # One histogram per vertical level (a single one without a vertical dimension)
+                n_levels = values.shape[2] if values.ndim == 3 else 1
+                level = np.broadcast_to(np.arange(n_levels), values.shape) if values.ndim == 3 else np.zeros(values.shape, dtype=int)
+                flat = (level * n_bins + bins)[valid]
+                counts[var_name] = counts.get(var_name, 0) + np.bincount(flat, minlength=n_levels * n_bins).reshape(n_levels, n_bins)
+                if any(var_name in pair for pair in joint_histograms):
+                    binned[var_name] = (bins, valid)
+
+        for x, y in joint_histograms:
+            (xbins, xvalid), (ybins, yvalid) = binned[x], binned[y]
+            n_x, n_y = len(edges[x]) - 1, len(edges[y]) - 1
+            valid = xvalid & yvalid
+            flat = (xbins * n_y + ybins)[valid]
+            counts[(x, y)] = counts.get((x, y), 0) + np.bincount(flat, minlength=n_x * n_y).reshape(n_x, n_y)
+
+    for var_name, (finite, inside) in n_binned.items():
+        if inside < finite:
+            print(f"Warning: {100.0 * (finite - inside) / finite:.1f}% of the values of '{var_name}' are "
+                  f"outside the histogram bin edges [{edges[var_name][0]:g}, {edges[var_name][-1]:g}] "
+                  f"and are not counted.")
+
+    for var_name in names:
+        attrs = ds[var_name].attrs
+        out[var_name] = xr.DataArray(means[var_name][1], dims=means[var_name][0], attrs=attrs)
+        if var_name in variances:
+            var_attrs = {'long_name': f"{attrs.get('long_name', var_name)} (horizontal variance)"}
+            if 'units' in attrs:
+                var_attrs['units'] = f"({attrs['units']})^2"
+            out[f"{var_name}_horiz_variance"] = xr.DataArray(variances[var_name][1], dims=variances[var_name][0],
+                                                             attrs=var_attrs)
+
+    for name, (dims, values, attrs) in sampled.items():
+        out[name] = xr.DataArray(values, dims=dims, attrs=attrs)
+
+    for var_name, var_edges in edges.items():
+        out[f"{var_name}__bin_edges"] = ((f"{var_name}__edge",), var_edges)
+        vert_dim = _vertical_dim(ds[var_name])
+        if vert_dim is not None:
+            out[f"{var_name}__cfad"] = ((vert_dim, f"{var_name}__bin"), counts[var_name])
+        else:
+            out[f"{var_name}__histogram"] = ((f"{var_name}__bin",), counts[var_name][0])
+    for x, y in joint_histograms:
+        out[f"{x}__{y}__joint"] = ((f"{x}__bin", f"{y}__bin"), counts[(x, y)])
+
+    out = out.assign_coords({name: ds[name] for name in ['time', 'lev', 'ilev'] if name in ds.coords})
+    out = out.drop_vars([v for v in ['area', 'lat', 'lon'] if v in out.data_vars])
+    return out
+
+def write_horizontal_average(fp, ds, outfile, time_chunk=None, variance=False, variables=None,
+                             histograms=None, joint_histograms=None, conditional_masks=None,
+                             conditional_variables=None):
+    """
+    Write the domain means of a full-field dataset to outfile, unless outfile
+    already holds the means of the same (unchanged) input files.
+
+    Parameters:
+        fp (str or list): Filename of the dataset, as given by the user.
+        ds (xarray.Dataset): The opened full-field dataset.
+        outfile (str): netCDF file for the domain means.
+        time_chunk, variance, variables, histograms, joint_histograms, conditional_masks,
+            conditional_variables: See horizontal_average.
+
+    Returns:
+        str: outfile.
+    """
+    signature = _horizontal_average_signature(fp, variables, variance, histograms, joint_histograms,
+                                              conditional_masks, conditional_variables)
+    if os.path.exists(outfile):
+        with xr.open_dataset(outfile, decode_times=False) as previous:
+            if previous.attrs.get('horiz_avg_signature') == signature:
+                print(f"Using horizontal means in {outfile}")
+                return outfile
+
+    means = horizontal_average(ds, time_chunk, variance, variables,
+                               histograms=histograms, joint_histograms=joint_histograms,
+                               conditional_masks=conditional_masks,
+                               conditional_variables=conditional_variables)
+    means.attrs['horiz_avg_signature'] = signature
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    means.to_netcdf(outfile)
+    return outfile
+
+def plot_profile(var_name, window_idx, start_time, end_time, datasets, opts):
+    """
+    Plot the time averaged profile of a variable for one averaging window.
+
+    Returns:
+        str or None: Path of the saved plot, or None if nothing was plotted.
+    """
+    short_ids = opts["short_ids"]
+    line_colors = opts["line_colors"]
+    line_styles = opts["line_styles"]
+    height_cord = opts["height_cord"]
+    max_height_profile = opts["max_height_profile"]
+    dataset_indices = opts["var_index"][var_name]["datasets"]
+
+    plt.figure(figsize=(8, 6))
+    valid_plot = False
+
+    for idx, (ds, short_id) in enumerate(zip(datasets, short_ids)):
+        if idx not in dataset_indices:
+            continue
+
+        valid_plot = True
+        time_filtered_data, y_coord = profile_product(ds, idx, var_name, window_idx, opts)
+
+        if height_cord == "z":
+            y_min, y_max = (0, max_height_profile) if max_height_profile else (y_coord.min(), y_coord.max())
+        else:
+            y_min, y_max = (max_height_profile, y_coord.max()) if max_height_profile else (y_coord.min(), y_coord.max())
+
+        valid_indices = np.where((y_coord >= y_min) & (y_coord <= y_max))[0]
+        filtered_y_coord = y_coord[valid_indices]
+        filtered_data = time_filtered_data[valid_indices]
+
+        plot_kwargs = {'label': short_id, 'linewidth': opts["linewidth"]}
+        if line_colors: plot_kwargs['color'] = line_colors[idx]
+        if line_styles: plot_kwargs['linestyle'] = line_styles[idx]
+
+        line, = plt.plot(filtered_data, filtered_y_coord, **plot_kwargs)
+
+        band = ensemble_band_product(ds, idx, var_name, "profile", opts, window_idx)
+        if band is not None:
+            plt.fill_betweenx(filtered_y_coord, band[0][valid_indices], band[1][valid_indices],
+                              color=line.get_color(), alpha=0.25, linewidth=0)
+
+    if not valid_plot:
+        plt.close()
+        print(f"Warning: Variable '{var_name}' is not a valid plotting variable. Skipping this variable.")
+        return None
+
+    plt.ylim([y_min, y_max])
+    if height_cord == "p":
+        plt.gca().invert_yaxis()
+
+    var_units = next((ds[var_name].attrs.get('units', 'Value') for ds in datasets if var_name in ds.data_vars), 'Value')
+    var_long_name = next((ds[var_name].attrs.get('long_name', var_name) for ds in datasets if var_name in ds.data_vars), var_name)
+    if var_long_name == "MISSING": var_long_name = var_name
+
+    plt.xlabel(var_units, fontsize=opts["labelsize"])
+    ylabel = 'Height (m)' if height_cord == "z" else 'Pressure (hPa)'
+    plt.ylabel(ylabel, fontsize=opts["labelsize"])
+    plt.title(f"{var_long_name} Profile (Day {start_time} to Day {end_time})", fontsize=16)
+    plt.legend(fontsize=14)
+    plt.grid(color='#95a5a6', linestyle='--', linewidth=2, alpha=0.5)
+    plt.tick_params(labelsize=opts["ticksize"])
+
+    plot_filename = os.path.join(opts["output_subdir"], f"{var_name}_profile_window{window_idx+1}.jpg")
+    with instrument("savefig", var_name):
+        plt.savefig(plot_filename, format='jpg')
+    plt.close()
+    return plot_filename
+
+def plot_profile_difference(var_name, window_idx, start_time, end_time, datasets, opts):
+    """
+    Plot the window mean profile of a variable minus that of the reference
+    dataset, with every dataset interpolated to the common vertical grid.
+
+    Returns:
+        str or None: Path of the saved plot, or None if nothing was plotted.
+    """
+    short_ids = opts["short_ids"]
+    line_colors = opts["line_colors"]
+    line_styles = opts["line_styles"]
+    height_cord = opts["height_cord"]
+    max_height_profile = opts["max_height_profile"]
+    ref = opts["reference_index"]
+    dataset_indices = opts["var_index"][var_name]["datasets"]
+    if ref not in dataset_indices or len(dataset_indices) < 2:
+        return None
+
+    grid = np.asarray(opts["vertical_grid"], dtype=float)
+    reference = interpolated_profiles(datasets[ref], ref, [var_name], opts)[var_name][window_idx]
+
+    plt.figure(figsize=(8, 6))
+    for idx, (ds, short_id) in enumerate(zip(datasets, short_ids)):
+        if idx not in dataset_indices or idx == ref:
+            continue
+        profile = interpolated_profiles(ds, idx, [var_name], opts)[var_name][window_idx]
+
+        plot_kwargs = {'label': f"{short_id} - {short_ids[ref]}", 'linewidth': opts["linewidth"]}
+        if line_colors: plot_kwargs['color'] = line_colors[idx]
+        if line_styles: plot_kwargs['linestyle'] = line_styles[idx]
+        plt.plot(profile - reference, grid, **plot_kwargs)
+
+    if height_cord == "z":
+        y_min, y_max = (0, max_height_profile) if max_height_profile else (grid.min(), grid.max())
+    else:
+        y_min, y_max = (max_height_profile, grid.max()) if max_height_profile else (grid.min(), grid.max())
+    plt.ylim([y_min, y_max])
+    if height_cord == "p":
+        plt.gca().invert_yaxis()
+    plt.axvline(0.0, color='k', linewidth=1)
+
+    var_long_name, var_units = _variable_labels(var_name, datasets)
+    plt.xlabel(var_units, fontsize=opts["labelsize"])
+    plt.ylabel('Height (m)' if height_cord == "z" else 'Pressure (hPa)', fontsize=opts["labelsize"])
+    plt.title(f"{var_long_name} Difference (Day {start_time} to Day {end_time})", fontsize=16)
+    plt.legend(fontsize=14)
+    plt.grid(color='#95a5a6', linestyle='--', linewidth=2, alpha=0.5)
+    plt.tick_params(labelsize=opts["ticksize"])
+
+    plot_filename = os.path.join(opts["output_subdir"], f"{var_name}_profile_difference_window{window_idx+1}.jpg")
+    with instrument("savefig", var_name):
+        plt.savefig(plot_filename, format='jpg')
+    plt.close()
+    return plot_filename
+
+def plot_timeseries(var_name, datasets, opts):
+    """
+    Plot the time series of a variable with no vertical dimension.
+
+    Returns:
+        str or None: Path of the saved plot, or None if nothing was plotted.
+    """
+    short_ids = opts["short_ids"]
+    line_colors = opts["line_colors"]
+    line_styles = opts["line_styles"]
+    run_mean_npts = opts["run_mean_npts"]
+    dataset_indices = opts["var_index"][var_name]["datasets"]
+
+    plt.figure(figsize=(10, 5))
+    valid_plot = False
+
+    for idx, (ds, short_id) in enumerate(zip(datasets, short_ids)):
+        if idx not in dataset_indices:
+            continue
+
+        band = None
+        if opts.get("time_bin_width"):
+            # Bin means on the common time axis, plotted at the bin centers
+            edges = np.asarray(opts["time_bin_edges"])
+            time_plot = 0.5 * (edges[:-1] + edges[1:])
+            variable_data = binned_timeseries(ds, idx, [var_name], opts)[var_name][0]
+        else:
+            time_plot, variable_data = timeseries_product(ds, idx, var_name, opts)
+            band = ensemble_band_product(ds, idx, var_name, "timeseries", opts)
+
+        # Apply running mean if requested
+        if run_mean_npts > 0 and variable_data.size >= run_mean_npts:
+            variable_data = xr.DataArray(variable_data, dims="time").rolling(time=run_mean_npts, center=True).mean(skipna=True)
+            if band is not None:
+                band = [xr.DataArray(b, dims="time").rolling(time=run_mean_npts, center=True).mean(skipna=True)
+                        for b in band]
+
+        if opts["decimate"]:
+            series = [variable_data] + (list(band) if band is not None else [])
+            time_plot, series = decimate_series(time_plot, series, axes_pixel_width(plt.gca()))
+            variable_data, band = series[0], (series[1:] if band is not None else None)
+
+        plot_kwargs = {'label': short_id, 'linewidth': opts["linewidth"]}
+        if line_colors: plot_kwargs['color'] = line_colors[idx]
+        if line_styles: plot_kwargs['linestyle'] = line_styles[idx]
+
+        line, = plt.plot(time_plot, variable_data, **plot_kwargs)
+        if band is not None:
+            plt.fill_between(time_plot, band[0], band[1], color=line.get_color(), alpha=0.25, linewidth=0)
+        valid_plot = True
+
+    if not valid_plot:
+        plt.close()
+        print(f"Warning: Variable '{var_name}' is not a valid plotting variable. Skipping this variable.")
+        return None
+
+    var_units = next((ds[var_name].attrs.get('units', 'Value') for ds in datasets if var_name in ds.data_vars), 'Value')
+    var_long_name = next((ds[var_name].attrs.get('long_name', var_name) for ds in datasets if var_name in ds.data_vars), var_name)
+    if var_long_name == "MISSING":
+        var_long_name = var_name
+
+    plt.xlabel("Time (days)", fontsize=opts["labelsize"])
+    plt.ylabel(var_units, fontsize=opts["labelsize"])
+    plt.title(f"{var_long_name} Time Series", fontsize=16)
+    plt.legend(fontsize=14)
+    plt.grid(color='#95a5a6', linestyle='--', linewidth=2, alpha=0.5)
+    plt.tick_params(labelsize=opts["ticksize"])
+
+    plot_filename = os.path.join(opts["output_subdir"], f"{var_name}_timeseries.jpg")
+    with instrument("savefig", var_name):
+        plt.savefig(plot_filename, format='jpg')
+    plt.close()
+    return plot_filename
+
+def plot_diurnal_1d(var_name, datasets, opts):
+    """
+    Plot the 1D diurnal composite of a variable.
+
+    Returns:
+        tuple: (plot filename or None, (start day, end day) of the composite or None)
+    """
+    short_ids = opts["short_ids"]
+    line_colors = opts["line_colors"]
+    line_styles = opts["line_styles"]
+    dataset_indices = opts["var_index"][var_name]["datasets"]
+
+    # Initialize figure
+    plt.figure(figsize=(10, 5))
+    valid_plot = False
+    diurnal_window = None
+
+    for idx, (ds, short_id) in enumerate(zip(datasets, short_ids)):
+        if idx not in dataset_indices:
+            continue
+
+        product = diurnal_product(ds, idx, var_name, opts["time_offset"],
+                                  opts["diurnal_start_day"], opts["diurnal_end_day"])
+        if product is None or product[0].ndim != 1:
+            continue
+        composite, hour_labels, stime, etime, _ = product
+
+        diurnal_window = (stime, etime)
+
+        plot_kwargs = {'label': short_id, 'linewidth': opts["linewidth"]}
+        if line_colors: plot_kwargs['color'] = line_colors[idx]
+        if line_styles: plot_kwargs['linestyle'] = line_styles[idx]
+        line, = plt.plot(hour_labels, composite, **plot_kwargs)
+        band = ensemble_band_product(ds, idx, var_name, "diurnal", opts)
+        if band is not None:
+            plt.fill_between(hour_labels, band[0], band[1], color=line.get_color(), alpha=0.25, linewidth=0)
+        valid_plot = True
+
+    if not valid_plot:
+        plt.close()
+        return None, diurnal_window
+
+    plt.xlabel("Time (hour - UTC)", fontsize=opts["labelsize"])
+    var_units = next((ds[var_name].attrs.get('units', 'Value') for ds in datasets if var_name in ds.data_vars), 'Value')
+    var_long_name = next((ds[var_name].attrs.get('long_name', var_name) for ds in datasets if var_name in ds.data_vars), var_name)
+    if var_long_name == "MISSING": var_long_name = var_name
+
+    plt.ylabel(var_units, fontsize=opts["labelsize"])
+    plt.title(f"{var_long_name} Diurnal Composite", fontsize=16)
+    plt.legend(fontsize=14)
+    plt.grid(color='#95a5a6', linestyle='--', linewidth=2, alpha=0.5)
+    plt.tick_params(labelsize=opts["ticksize"])
+
+    plot_filename = os.path.join(opts["output_subdir"], f"{var_name}_diurnal1d.jpg")
+    with instrument("savefig", var_name):
+        plt.savefig(plot_filename, format='jpg')
+    plt.close()
+    return plot_filename, diurnal_window
+
+# Renderers of time-height panels; see draw_time_height_panel
+TIME_HEIGHT_RENDERERS = ["contourf", "pcolormesh", "image"]
+
+def draw_time_height_panel(ax, time_vals, y_coord, data, levels, cmap, renderer="contourf",
+                           max_image_size=(1024, 512)):
+    """
+    Draw one time-height panel with the given color levels.
+
+    Parameters:
+        ax (matplotlib.axes.Axes): Panel to draw on.
+        time_vals (numpy.ndarray): Times (or hours), shape (time,).
+        y_coord (numpy.ndarray): Vertical coordinate, shape (level,).
+        data (numpy.ndarray): Values, shape (time, level).
+        levels (numpy.ndarray): Color levels shared by all panels.
+        cmap (str): Colormap.
+        renderer (str): 'contourf' (filled contours), 'pcolormesh' (one
+            rasterized cell per value on the native grid) or 'image' (an image
+            of at most max_image_size (time, level) pixels, each taking the
+            nearest value).  The rasterized renderers map colors to the same
+            discrete levels as the contours.
+        max_image_size (tuple): See renderer.
+
+    Returns:
+        The mappable for the colorbar.
+    """
+    from matplotlib.colors import BoundaryNorm
+
+    if renderer == "contourf":
+        return ax.contourf(time_vals, y_coord, data.T, levels=levels, cmap=cmap)
+
+    norm = BoundaryNorm(levels, ncolors=plt.get_cmap(cmap).N)
+    data = np.ma.masked_invalid(data)
+    if renderer == "pcolormesh":
+        return ax.pcolormesh(time_vals, y_coord, data.T, cmap=cmap, norm=norm, shading='nearest', rasterized=True)
+    if renderer != "image":
+        raise ValueError(f"Invalid time-height renderer: {renderer}. Must be one of {TIME_HEIGHT_RENDERERS}.")
+
+    # Sample the nearest value for each pixel of a regular grid
+    def nearest(coord, n_pixels):
+        order = np.argsort(coord)
+        sorted_coord = coord[order]
+        pixels = np.linspace(sorted_coord[0], sorted_coord[-1], min(n_pixels, max(len(coord), 2)))
+        right = np.clip(np.searchsorted(sorted_coord, pixels), 1, max(len(coord) - 1, 1))
+        left = right - 1
+        right = np.minimum(right, len(coord) - 1)
+        pick = np.where(pixels - sorted_coord[left] <= sorted_coord[right] - pixels, left, right)
+        return order[pick], pixels
+
+    time_idx, time_pixels = nearest(np.asarray(time_vals, dtype=float), max_image_size[0])
+    y_idx, y_pixels = nearest(np.asarray(y_coord, dtype=float), max_image_size[1])
+    image = data[time_idx][:, y_idx].T
+    return ax.imshow(image, extent=[time_pixels[0], time_pixels[-1], y_pixels[0], y_pixels[-1]], origin='lower',
+                     aspect='auto', interpolation='nearest', cmap=cmap, norm=norm)
+
+def plot_time_height(var_name, datasets, opts, is_diurnal=False):
+    """
+    Task wrapper around plot_time_height_panel_grid for time-height and 2D diurnal plots.
+    """
+    if is_diurnal:
+        start_time, end_time = opts["diurnal_start_day"], opts["diurnal_end_day"]
+    else:
+        start_time, end_time = opts["time_height_time_s"], opts["time_height_time_e"]
+
+    return plot_time_height_panel_grid(
+        var_name,
+        datasets,
+        opts["short_ids"],
+        opts["time_offset"],
+        opts["height_cord"],
+        opts["output_subdir"],
+        opts["labelsize"],
+        opts["ticksize"],
+        opts["usercmap"],
+        start_time,
+        end_time,
+        opts["max_height_timeheight"],
+        is_diurnal=is_diurnal,
+        dataset_indices=opts["var_index"][var_name]["datasets"],
+        window_table=None if is_diurnal else opts["window_table"],
+        renderer=opts["time_height_renderer"],
+        decimate=opts["decimate"]
+    )
+
+def _variable_labels(var_name, datasets):
+    # (long_name, units) of a variable, from the first dataset that has it
+    units = next((ds[var_name].attrs.get('units', 'Value') for ds in datasets if var_name in ds.data_vars), 'Value')
+    long_name = next((ds[var_name].attrs.get('long_name', var_name) for ds in datasets if var_name in ds.data_vars), var_name)
+    if long_name == "MISSING":
+        long_name = var_name
+    return long_name, units
+
+def _panel_axes(n_panels):
+    # Grid of panels, two per row, as used by the time-height plots
+    n_cols = 2
+    n_rows = -(-n_panels // n_cols)
+    fig, axes = plt.subplots(n_rows, n_cols, figsize=(15, n_rows * 6), sharey=True, constrained_layout=True)
+    axes = np.atleast_2d(axes)
+    for ax in axes.flat[n_panels:]:
+        ax.set_visible(False)
+    return fig, axes
+
+def plot_cfad(var_name, datasets, opts):
+    """
+    Plot the contoured frequency by altitude diagram (CFAD) of a variable,
+    one panel per dataset.  The frequency is normalized at every level.
+
+    Returns:
+        str or None: Path of the saved plot, or None if nothing was plotted.
+    """
+    height_cord = opts["height_cord"]
+    max_height = opts["max_height_timeheight"]
+
+    panels = []
+    for idx, ds in enumerate(datasets):
+        product = histogram_product(ds, idx, var_name, opts)
+        if product is None or product[2] is None:
+            continue
+        counts, edges, y_coord = product
+
+        if height_cord == "z":
+            y_min, y_max = (0, max_height) if max_height is not None else (y_coord.min(), y_coord.max())
+        else:
+            y_min, y_max = (max_height, y_coord.max()) if max_height is not None else (y_coord.min(), y_coord.max())
+        valid_lev_idx = np.where((y_coord >= y_min) & (y_coord <= y_max))[0]
+        if len(valid_lev_idx) == 0:
+            continue
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frequency = 100.0 * counts / counts.sum(axis=1, keepdims=True)
+        frequency = np.ma.masked_where(~(counts > 0), frequency)[valid_lev_idx]
+        panels.append((idx, edges, y_coord[valid_lev_idx], frequency))
+
+    if not panels:
+        print(f"Warning: No CFAD found for {var_name}. Skipping.")
+        return None
+
+    long_name, units = _variable_labels(var_name, datasets)
+    vmax = max(float(frequency.max()) for _, _, _, frequency in panels)
+    fig, axes = _panel_axes(len(panels))
+
+    for ax, (idx, edges, y_coord, frequency) in zip(axes.flat, panels):
+        centers = 0.5 * (edges[1:] + edges[:-1])
+        mesh = ax.pcolormesh(centers, y_coord, frequency, shading='nearest', cmap=opts["usercmap"], vmin=0, vmax=vmax)
+        ax.set_title(opts["short_ids"][idx], fontsize=16)
+        ax.set_xlabel(units, fontsize=opts["labelsize"])
+        ax.set_ylabel("Height (m)" if height_cord == "z" else "Pressure (hPa)", fontsize=opts["labelsize"])
+        if height_cord == "p":
+            ax.invert_yaxis()
+        ax.tick_params(axis='both', labelsize=opts["ticksize"])
+
+    cbar = fig.colorbar(mesh, ax=axes, orientation='vertical', aspect=30, shrink=0.8, pad=0.02)
+    cbar.set_label("Frequency at each level (%)", fontsize=14)
+    cbar.ax.tick_params(labelsize=12)
+    plt.suptitle(f"{long_name} CFAD", fontsize=18)
+
+    outfile = os.path.join(opts["output_subdir"], f"{var_name}_cfad.jpg")
+    with instrument("savefig", var_name):
+        plt.savefig(outfile, format='jpg')
+    plt.close()
+    return outfile
+
+def plot_histogram(var_name, datasets, opts):
+    """
+    Plot the histogram across columns of a variable with no vertical dimension.
+
+    Returns:
+        str or None: Path of the saved plot, or None if nothing was plotted.
+    """
+    line_colors = opts["line_colors"]
+    line_styles = opts["line_styles"]
+
+    plt.figure(figsize=(10, 5))
+    valid_plot = False
+    for idx, ds in enumerate(datasets):
+        product = histogram_product(ds, idx, var_name, opts)
+        if product is None or product[2] is not None or product[0].sum() == 0:
+            continue
+        counts, edges, _ = product
+
+        plot_kwargs = {'label': opts["short_ids"][idx], 'linewidth': opts["linewidth"]}
+        if line_colors: plot_kwargs['color'] = line_colors[idx]
+        if line_styles: plot_kwargs['linestyle'] = line_styles[idx]
+
+        frequency = 100.0 * counts / counts.sum()
+        plt.plot(0.5 * (edges[1:] + edges[:-1]), np.where(frequency > 0, frequency, np.nan), **plot_kwargs)
+        valid_plot = True
+
+    if not valid_plot:
+        plt.close()
+        print(f"Warning: No histogram found for {var_name}. Skipping.")
+        return None
+
+    long_name, units = _variable_labels(var_name, datasets)
+    plt.yscale('log')
+    plt.xlabel(units, fontsize=opts["labelsize"])
+    plt.ylabel("Frequency (%)", fontsize=opts["labelsize"])
+    plt.title(f"{long_name} Histogram", fontsize=16)
+    plt.legend(fontsize=14)
+    plt.grid(color='#95a5a6', linestyle='--', linewidth=2, alpha=0.5)
+    plt.tick_params(labelsize=opts["ticksize"])
+
+    plot_filename = os.path.join(opts["output_subdir"], f"{var_name}_histogram.jpg")
+    with instrument("savefig", var_name):
+        plt.savefig(plot_filename, format='jpg')
+    plt.close()
+    return plot_filename
+
+def plot_joint_histogram(x_name, y_name, datasets, opts):
+    """
+    Plot the joint histogram of two variables, one panel per dataset, with a
+    logarithmic color scale.
+
+    Returns:
+        str or None: Path of the saved plot, or None if nothing was plotted.
+    """
+    from matplotlib.colors import LogNorm
+
+    panels = []
+    for idx, ds in enumerate(datasets):
+        product = joint_histogram_product(ds, x_name, y_name)
+        if product is None or product[0].sum() == 0:
+            continue
+        counts, x_edges, y_edges = product
+        frequency = np.ma.masked_where(counts == 0, 100.0 * counts / counts.sum())
+        panels.append((idx, x_edges, y_edges, frequency))
+
+    if not panels:
+        print(f"Warning: No joint histogram found for {x_name} and {y_name}. Skipping.")
+        return None
+
+    x_long_name, x_units = _variable_labels(x_name, datasets)
+    y_long_name, y_units = _variable_labels(y_name, datasets)
+    norm = LogNorm(vmin=min(float(f.min()) for _, _, _, f in panels),
+                   vmax=max(float(f.max()) for _, _, _, f in panels))
+    fig, axes = _panel_axes(len(panels))
+
+    for ax, (idx, x_edges, y_edges, frequency) in zip(axes.flat, panels):
+        mesh = ax.pcolormesh(x_edges, y_edges, frequency.T, norm=norm, cmap=opts["usercmap"])
+        ax.set_title(opts["short_ids"][idx], fontsize=16)
+        ax.set_xlabel(f"{x_name} ({x_units})", fontsize=opts["labelsize"])
+        ax.set_ylabel(f"{y_name} ({y_units})", fontsize=opts["labelsize"])
+        ax.tick_params(axis='both', labelsize=opts["ticksize"])
+
+    cbar = fig.colorbar(mesh, ax=axes, orientation='vertical', aspect=30, shrink=0.8, pad=0.02)
+    cbar.set_label("Frequency (%)", fontsize=14)
+    cbar.ax.tick_params(labelsize=12)
+    plt.suptitle(f"Joint Histogram of {x_long_name} and {y_long_name}", fontsize=18)
+
+    outfile = os.path.join(opts["output_subdir"], f"{x_name}_{y_name}_joint_histogram.jpg")
+    with instrument("savefig", x_name):
+        plt.savefig(outfile, format='jpg')
+    plt.close()
+    return outfile
+
+def plot_taylor_diagram(rows, title, outfile, opts):
+    """
+    Draw a Taylor diagram of skill metric rows (see compute_skill_metrics):
+    the standard deviation ratio as radius and the correlation as angle, so
+    that the distance to the reference point (1, 0) is the centered RMS error
+    normalized by the standard deviation of the reference.
+
+    Returns:
+        str or None: outfile, or None if no row has a correlation.
+    """
+    rows = [r for r in rows if r["correlation"] is not None and r["std_ratio"] is not None]
+    if not rows:
+        return None
+    short_ids = opts["short_ids"]
+    line_colors = opts["line_colors"]
+    max_ratio = max(1.5, min(3.0, max(r["std_ratio"] for r in rows) * 1.1))
+    max_angle = np.pi if any(r["correlation"] < 0 for r in rows) else np.pi / 2
+
+    fig = plt.figure(figsize=(9, 8))
+    ax = fig.add_subplot(projection='polar')
+    ax.set_thetamin(0)
+    ax.set_thetamax(np.degrees(max_angle))
+    ax.set_rlim(0, max_ratio)
+
+    # Correlation ticks on the angle, centered RMS error contours around the reference
+    correlations = np.array([-0.99, -0.9, -0.6, -0.3, 0.0, 0.3, 0.6, 0.8, 0.9, 0.95, 0.99])
+    correlations = correlations[np.arccos(correlations) <= max_angle + 1e-9]
+    ax.set_thetagrids(np.degrees(np.arccos(correlations)), [f"{c:g}" for c in correlations])
+    theta = np.linspace(0, max_angle, 200)
+    radius = np.linspace(0, max_ratio, 200)
+    t, r = np.meshgrid(theta, radius)
+    crmse = np.sqrt(1.0 + r**2 - 2.0 * r * np.cos(t))
+    contours = ax.contour(t, r, crmse, levels=np.arange(0.25, 2.0, 0.25), colors='#95a5a6', linewidths=1)
+    ax.clabel(contours, fontsize=9, fmt='%.2f')
+    ax.plot(theta, np.ones_like(theta), color='k', linestyle='--', linewidth=1)
+    ax.plot([0], [1.0], marker='*', color='k', markersize=14, linestyle='none', label=rows[0]["reference"])
+
+    for idx, short_id in enumerate(short_ids):
+        points = [r for r in rows if r["dataset"] == short_id]
+        if not points:
+            continue
+        angles = np.arccos(np.clip([r["correlation"] for r in points], -1.0, 1.0))
+        ratios = np.minimum([r["std_ratio"] for r in points], max_ratio)
+        color = line_colors[idx] if line_colors else None
+        ax.plot(angles, ratios, marker='o', linestyle='none', color=color, label=short_id)
+        for angle, ratio, row in zip(angles, ratios, points):
+            ax.annotate(row["variable"], (angle, ratio), fontsize=8, xytext=(3, 3), textcoords='offset points')
+
+    ax.set_xlabel("Standard deviation ratio", fontsize=opts["labelsize"], labelpad=20)
+    ax.tick_params(labelsize=opts["ticksize"] - 2)
+    ax.legend(loc='upper right', bbox_to_anchor=(1.15, 1.1), fontsize=12)
+    ax.set_title(title, fontsize=16)
+
+    with instrument("savefig"):
+        plt.savefig(outfile, format='jpg')
+    plt.close()
+    return outfile
+
+def plot_taylor_diagrams(rows, profile_time_s, profile_time_e, opts):
+    """
+    Draw a Taylor diagram of the time series and one of the profiles of each
+    averaging window.
+
+    Returns:
+        list: (title, path) of every diagram drawn.
+    """
+    diagrams = [("Time Series", [r for r in rows if r["kind"] == "timeseries"], "taylor_timeseries.jpg")]
+    for window_idx, (start_time, end_time) in enumerate(zip(profile_time_s, profile_time_e)):
+        diagrams.append((f"Profiles (Day {start_time} to Day {end_time})",
+                         [r for r in rows if r["kind"] == "profile" and r["window"] == window_idx + 1],
+                         f"taylor_profile_window{window_idx + 1}.jpg"))
+    drawn = []
+    for title, diagram_rows, filename in diagrams:
+        outfile = plot_taylor_diagram(diagram_rows, title, os.path.join(opts["output_subdir"], filename), opts)
+        if outfile:
+            drawn.append((title, outfile))
+    return drawn
+
+#################################
+###### Interactive reports
+
+# With report_mode = "interactive" the profile, time series, time-height and
+#  diurnal plot tasks write the reduced data of each plot to a small script,
+#  plots/<plot>.js, instead of encoding a JPEG.  The report pages load these
+#  scripts and draw the plots in the browser (interactive/interactive_plots.js),
+#  with zoom and check boxes to show or hide each dataset.  Arrays are stored as
+#  base64 encoded float32.  CFADs, histograms and Taylor diagrams stay images.
+
+REPORT_MODES = ["static", "interactive"]
+
+# Samples along time written per series or field when decimating (opts["decimate"])
+PAYLOAD_PIXELS = 2000
+
+def _payload_array(values):
+    values = np.ascontiguousarray(np.asarray(values, dtype='<f4'))
+    return {"f32": base64.b64encode(values.tobytes()).decode("ascii")}
+
+def _payload_line(idx, n_lines, label, x, y, opts, band=None):
+    # One line of a payload in the color and style of dataset idx; datasets
+    #  without a color take the next color of the matplotlib cycle
+    cycle = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    color = opts["line_colors"][idx] if opts["line_colors"] else cycle[n_lines % len(cycle)]
+    line = {
+        "label": label,
+        "color": to_hex(color),
+        "style": opts["line_styles"][idx] if opts["line_styles"] else "-",
+        "x": _payload_array(x),
+        "y": _payload_array(y),
+    }
+    if band is not None:
+        line["band"] = [_payload_array(b) for b in band]
+    return line
+
+def _vertical_limits(y_coord, height_cord, max_height):
+    # Vertical plotting range, as used by the profile plots
+    if height_cord == "z":
+        return (0, max_height) if max_height else (float(np.min(y_coord)), float(np.max(y_coord)))
+    return (max_height, float(np.max(y_coord))) if max_height else (float(np.min(y_coord)), float(np.max(y_coord)))
+
+def write_plot_payload(payload, outfile):
+    """
+    Write the data of one interactive plot as a script registering it with
+    the viewer.
+
+    Returns:
+        str: outfile
+    """
+    payload["name"] = os.path.splitext(os.path.basename(outfile))[0]
+    with instrument("payload"):
+        with open(outfile, "w") as f:
+            f.write("diagnosticsPayload(" + json.dumps(payload, separators=(",", ":")) + ");\n")
+    return outfile
+
+def profile_payload(var_name, window_idx, start_time, end_time, datasets, opts):
+    """
+    Interactive counterpart of plot_profile.
+
+    Returns:
+        str or None: Path of the payload, or None if nothing was written.
+    """
+    height_cord = opts["height_cord"]
+    dataset_indices = opts["var_index"][var_name]["datasets"]
+
+    lines = []
+    for idx, ds in enumerate(datasets):
+        if idx not in dataset_indices:
+            continue
+        data, y_coord = profile_product(ds, idx, var_name, window_idx, opts)
+        y_min, y_max = _vertical_limits(y_coord, height_cord, opts["max_height_profile"])
+        valid = np.where((y_coord >= y_min) & (y_coord <= y_max))[0]
+        band = ensemble_band_product(ds, idx, var_name, "profile", opts, window_idx)
+        lines.append(_payload_line(idx, len(lines), opts["short_ids"][idx], data[valid], y_coord[valid], opts,
+                                   None if band is None else [b[valid] for b in band]))
+
+    if not lines:
+        print(f"Warning: Variable '{var_name}' is not a valid plotting variable. Skipping this variable.")
+        return None
+
+    long_name, units = _variable_labels(var_name, datasets)
+    payload = {
+        "type": "line",
+        "title": f"{long_name} Profile (Day {start_time} to Day {end_time})",
+        "xlabel": units,
+        "ylabel": 'Height (m)' if height_cord == "z" else 'Pressure (hPa)',
+        "ylim": [float(y_min), float(y_max)],
+        "invert_y": height_cord == "p",
+        "band_axis": "x",
+        "width": 560,
+        "height": 480,
+        "lines": lines,
+    }
+    return write_plot_payload(payload, os.path.join(opts["output_subdir"], f"{var_name}_profile_window{window_idx+1}.js"))
+
+def profile_difference_payload(var_name, window_idx, start_time, end_time, datasets, opts):
+    """
+    Interactive counterpart of plot_profile_difference.
+
+    Returns:
+        str or None: Path of the payload, or None if nothing was written.
+    """
+    height_cord = opts["height_cord"]
+    ref = opts["reference_index"]
+    dataset_indices = opts["var_index"][var_name]["datasets"]
+    if ref not in dataset_indices or len(dataset_indices) < 2:
+        return None
+
+    grid = np.asarray(opts["vertical_grid"], dtype=float)
+    reference = interpolated_profiles(datasets[ref], ref, [var_name], opts)[var_name][window_idx]
+    lines = []
+    for idx, ds in enumerate(datasets):
+        if idx not in dataset_indices or idx == ref:
+            continue
+        profile = interpolated_profiles(ds, idx, [var_name], opts)[var_name][window_idx]
+        lines.append(_payload_line(idx, len(lines), f"{opts['short_ids'][idx]} - {opts['short_ids'][ref]}",
+                                   profile - reference, grid, opts))
+
+    long_name, units = _variable_labels(var_name, datasets)
+    payload = {
+        "type": "line",
+        "title": f"{long_name} Difference (Day {start_time} to Day {end_time})",
+        "xlabel": units,
+        "ylabel": 'Height (m)' if height_cord == "z" else 'Pressure (hPa)',
+        "ylim": [float(v) for v in _vertical_limits(grid, height_cord, opts["max_height_profile"])],
+        "invert_y": height_cord == "p",
+        "zero_x": True,
+        "width": 560,
+        "height": 480,
+        "lines": lines,
+    }
+    return write_plot_payload(payload, os.path.join(opts["output_subdir"],
+                                                    f"{var_name}_profile_difference_window{window_idx+1}.js"))
+
+def timeseries_payload(var_name, datasets, opts):
+    """
+    Interactive counterpart of plot_timeseries.
+
+    Returns:
+        str or None: Path of the payload, or None if nothing was written.
+    """
+    run_mean_npts = opts["run_mean_npts"]
+    dataset_indices = opts["var_index"][var_name]["datasets"]
+
+    lines = []
+    for idx, ds in enumerate(datasets):
+        if idx not in dataset_indices:
+            continue
+
+        band = None
+        if opts.get("time_bin_width"):
+            edges = np.asarray(opts["time_bin_edges"])
+            time_plot = 0.5 * (edges[:-1] + edges[1:])
+            variable_data = binned_timeseries(ds, idx, [var_name], opts)[var_name][0]
+        else:
+            time_plot, variable_data = timeseries_product(ds, idx, var_name, opts)
+            band = ensemble_band_product(ds, idx, var_name, "timeseries", opts)
+
+        series = [variable_data] + (list(band) if band is not None else [])
+        if run_mean_npts > 0 and variable_data.size >= run_mean_npts:
+            series = [xr.DataArray(y, dims="time").rolling(time=run_mean_npts, center=True).mean(skipna=True)
+                      for y in series]
+        if opts["decimate"]:
+            time_plot, series = decimate_series(time_plot, series, PAYLOAD_PIXELS)
+        lines.append(_payload_line(idx, len(lines), opts["short_ids"][idx], time_plot, series[0], opts,
+                                   series[1:] if band is not None else None))
+
+    if not lines:
+        print(f"Warning: Variable '{var_name}' is not a valid plotting variable. Skipping this variable.")
+        return None
+
+    long_name, units = _variable_labels(var_name, datasets)
+    payload = {
+        "type": "line",
+        "title": f"{long_name} Time Series",
+        "xlabel": "Time (days)",
+        "ylabel": units,
+        "band_axis": "y",
+        "width": 800,
+        "height": 400,
+        "lines": lines,
+    }
+    return write_plot_payload(payload, os.path.join(opts["output_subdir"], f"{var_name}_timeseries.js"))
+
+def diurnal1d_payload(var_name, datasets, opts):
+    """
+    Interactive counterpart of plot_diurnal_1d.
+
+    Returns:
+        tuple: (payload path or None, (start day, end day) of the composite or None)
+    """
+    dataset_indices = opts["var_index"][var_name]["datasets"]
+
+    lines = []
+    diurnal_window = None
+    for idx, ds in enumerate(datasets):
+        if idx not in dataset_indices:
+            continue
+        product = diurnal_product(ds, idx, var_name, opts["time_offset"],
+                                  opts["diurnal_start_day"], opts["diurnal_end_day"])
+        if product is None or product[0].ndim != 1:
+            continue
+        composite, hour_labels, stime, etime, _ = product
+        diurnal_window = (stime, etime)
+        lines.append(_payload_line(idx, len(lines), opts["short_ids"][idx], hour_labels, composite, opts,
+                                   ensemble_band_product(ds, idx, var_name, "diurnal", opts)))
+
+    if not lines:
+        return None, diurnal_window
+
+    long_name, units = _variable_labels(var_name, datasets)
+    payload = {
+        "type": "line",
+        "title": f"{long_name} Diurnal Composite",
+        "xlabel": "Time (hour - UTC)",
+        "ylabel": units,
+        "band_axis": "y",
+        "width": 800,
+        "height": 400,
+        "lines": lines,
+    }
+    return write_plot_payload(payload, os.path.join(opts["output_subdir"], f"{var_name}_diurnal1d.js")), diurnal_window
+
+def time_height_payload(var_name, datasets, opts, is_diurnal=False):
+    """
+    Interactive counterpart of plot_time_height: one field per dataset,
+    colored by the levels shared by all panels.
+
+    Returns:
+        str or None: Path of the payload, or None if nothing was written.
+    """
+    if is_diurnal:
+        start_time, end_time = opts["diurnal_start_day"], opts["diurnal_end_day"]
+    else:
+        start_time, end_time = opts["time_height_time_s"], opts["time_height_time_e"]
+    height_cord = opts["height_cord"]
+    max_height = opts["max_height_timeheight"]
+
+    product = time_height_panel_data(var_name, datasets, opts["time_offset"], height_cord, start_time, end_time,
+                                     max_height, is_diurnal, opts["var_index"][var_name]["datasets"],
+                                     None if is_diurnal else opts["window_table"])
+    if product is None:
+        print(f"Warning: No valid data found for {var_name}. Skipping.")
+        return None
+    panels, levels = product
+
+    # Color of each layer between two levels, as filled by contourf
+    cmap = plt.get_cmap(opts["usercmap"])
+    layers = 0.5 * (levels[:-1] + levels[1:])
+    colors = [to_hex(c) for c in cmap((layers - levels[0]) / (levels[-1] - levels[0]))]
+
+    fields = []
+    for idx, time_vals, data, y_coord in panels:
+        y_coord = np.atleast_1d(np.squeeze(np.asarray(y_coord)))
+        data = np.asarray(data, dtype=float)
+        if opts["decimate"]:
+            time_vals, data = time_block_average(time_vals, data, PAYLOAD_PIXELS)
+        fields.append({"label": opts["short_ids"][idx], "nx": data.shape[0], "ny": data.shape[1],
+                       "x": _payload_array(time_vals), "y": _payload_array(y_coord), "values": _payload_array(data)})
+
+    ylim = None
+    if max_height is not None:
+        ylim = [0, max_height] if height_cord == "z" else [max_height, max(float(np.max(f[3])) for f in panels)]
+    long_name, units = _variable_labels(var_name, datasets)
+    payload = {
+        "type": "field",
+        "title": f"{long_name} {'Diurnal Composite' if is_diurnal else 'Time-Height'}",
+        "xlabel": "Hour" if is_diurnal else "Time (days)",
+        "ylabel": "Height (m)" if height_cord == "z" else "Pressure (hPa)",
+        "ylim": ylim,
+        "invert_y": height_cord == "p",
+        "units": units,
+        "levels": [float(v) for v in levels],
+        "colors": colors,
+        "fields": fields,
+    }
+    outname = f"{var_name}_{'diurnal2d' if is_diurnal else 'time_height'}.js"
+    return write_plot_payload(payload, os.path.join(opts["output_subdir"], outname))
+
+# Plot tasks that have an interactive counterpart, see render_plot_task
+PLOT_PAYLOADS = {
+    "profile": profile_payload,
+    "profile_difference": profile_difference_payload,
+    "timeseries": timeseries_payload,
+    "time_height": time_height_payload,
+    "diurnal1d": diurnal1d_payload,
+    "diurnal2d": functools.partial(time_height_payload, is_diurnal=True),
+}
+
+def histogram_plot_tasks(datasets, var_index):
+    """
+    Return the plot tasks of the histograms across columns held by the
+    datasets: a CFAD or histogram per variable and the joint histograms.
+    """
+    tasks = []
+    for var_name in var_index:
+        if any(f"{var_name}__cfad" in ds.data_vars for ds in datasets):
+            tasks.append(("cfad", (var_name,)))
+        elif any(f"{var_name}__histogram" in ds.data_vars for ds in datasets):
+            tasks.append(("histogram", (var_name,)))
+
+    pairs = []
+    for ds in datasets:
+        for name in ds.data_vars:
+            parts = name.split("__")
+            if name.endswith("__joint") and len(parts) == 3 and tuple(parts[:2]) not in pairs:
+                if parts[0] in var_index:
+                    pairs.append(tuple(parts[:2]))
+    tasks.extend(("joint_histogram", pair) for pair in pairs)
+    return tasks
+
+def render_plot_task(task, datasets, opts):
+    """
+    Render a single plot task.
+
+    Parameters:
+        task (tuple): (kind, args) where kind is one of 'profile',
+            'profile_difference', 'timeseries', 'time_height', 'diurnal1d',
+            'diurnal2d', 'cfad', 'histogram' or 'joint_histogram' and args are the
+            task specific leading arguments (variable name, window, ...).
+        datasets (list): Opened xarray datasets.
+        opts (dict): Settings shared by all plot tasks.  In the interactive
+            report mode the tasks of PLOT_PAYLOADS write data payloads instead
+            of images.
+    """
+    kind, args = task
+    if opts["report_mode"] == "interactive" and kind in PLOT_PAYLOADS:
+        return PLOT_PAYLOADS[kind](*args, datasets, opts)
+    if kind == "profile":
+        return plot_profile(*args, datasets, opts)
+    elif kind == "profile_difference":
+        return plot_profile_difference(*args, datasets, opts)
+    elif kind == "timeseries":
+        return plot_timeseries(*args, datasets, opts)
+    elif kind == "time_height":
+        return plot_time_height(*args, datasets, opts, is_diurnal=False)
+    elif kind == "diurnal1d":
+        return plot_diurnal_1d(*args, datasets, opts)
+    elif kind == "diurnal2d":
+        return plot_time_height(*args, datasets, opts, is_diurnal=True)
+    elif kind == "cfad":
+        return plot_cfad(*args, datasets, opts)
+    elif kind == "histogram":
+        return plot_histogram(*args, datasets, opts)
+    elif kind == "joint_histogram":
+        return plot_joint_histogram(*args, datasets, opts)
+    raise ValueError(f"Unknown plot task: {kind}")
+
+# Per-process state for the parallel plotting workers
+_worker_datasets = None
+_worker_opts = None
+
+def _use_synchronous_dask():
+    # A forked worker inherits the dask thread pool of its parent without the
+    #  threads, so a lazy computation on it would wait forever; compute in the
+    #  worker's own thread instead
+    if HAS_DASK:
+        dask.config.set(scheduler="synchronous")
+
+def _init_plot_worker(file_paths, opts):
+    global _worker_datasets, _worker_opts
+    _use_synchronous_dask()
+    _worker_datasets = [
+        load_dataset(fp, opts["lazy_load"], opts["time_chunk"], drop, ensemble)
+        for fp, drop, ensemble in zip(file_paths, opts["drop_variables"], opts["ensemble"])
+    ]
+    _worker_opts = opts
+    if opts.get("profile"):
+        enable_profiling(opts["profile_memory"])
+
+def _timed_render_plot_task(task, datasets, opts):
+    # Returns the result, the wall time and the profile records of the task
+    n_records = len(_profiler["records"]) if _profiler is not None else 0
+    entry = _begin_stage(task[0], task[1][0])
+    result = render_plot_task(task, datasets, opts)
+    elapsed = _end_stage(entry)
+    records = _profiler["records"][n_records:] if _profiler is not None else []
+    return result, elapsed, records
+
+def _render_plot_task_worker(task):
+    result, elapsed, records = _timed_render_plot_task(task, _worker_datasets, _worker_opts)
+    if _profiler is not None:
+        _profiler["records"] = []
+    return result, elapsed, records
+
+def render_plot_tasks(tasks, datasets, file_paths, opts, n_workers=1, timings=None, on_result=None,
+                      close_datasets=True):
+    """
+    Render all plot tasks, either serially or over a pool of worker processes.
+
+    In parallel mode every worker opens its own copy of the input files, so the
+    datasets held by the caller are closed before the pool is started, unless
+    close_datasets is False.  Results are returned in task order, so both modes
+    produce the same output.
+
+    Parameters:
+        tasks (list): Plot tasks, see render_plot_task.
+        datasets (list): Opened xarray datasets.
+        file_paths (list): Paths of the datasets, used to reopen them in the workers.
+        opts (dict): Settings shared by all plot tasks.
+        n_workers (int): Number of worker processes; 1 renders serially.
+        timings (dict, optional): Receives under 'cpu_<kind>' the render time
+            of the plots of each kind, summed over the plots; with several
+            workers this can exceed the wall time.
+        on_result (callable, optional): Called as on_result(task, result) as
+            soon as each task has finished, in task order.
+        close_datasets (bool): Close the datasets (and empty their caches)
+            before starting the workers.  False keeps them open for the
+            caller, i.e. those of a DiagnosticsSession; the workers never
+            use them.
+
+    Returns:
+        list: The result of each task, in task order.
+    """
+    timed = []
+    if n_workers is None or n_workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            timed.append(_timed_render_plot_task(task, datasets, opts))
+            if on_result is not None:
+                on_result(task, timed[-1][0])
+    else:
+        # netCDF/HDF5 handles must not be shared across fork
+        for ds in datasets if close_datasets else []:
+            clear_dataset_caches(ds)
+            ds.close()
+
+        ctx = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                                 initializer=_init_plot_worker,
+                                 initargs=(file_paths, opts)) as executor:
+            for task, item in zip(tasks, executor.map(_render_plot_task_worker, tasks)):
+                timed.append(item)
+                if on_result is not None:
+                    on_result(task, item[0])
+        if _profiler is not None:
+            for _, _, records in timed:
+                _profiler["records"].extend(records)
+
+    if timings is not None:
+        for (kind, _), (_, elapsed, _) in zip(tasks, timed):
+            timings[f"cpu_{kind}"] = timings.get(f"cpu_{kind}", 0.0) + elapsed
+    return [result for result, _, _ in timed]
+
+#################################
+###### Incremental rendering
+
+# Settings that each kind of plot depends on, in addition to its data
+PLOT_TASK_OPTIONS = {
+    "profile": ["height_cord", "max_height_profile", "linewidth", "labelsize", "ticksize", "ensemble_band",
+                "report_mode"],
+    "profile_difference": ["height_cord", "max_height_profile", "linewidth", "labelsize", "ticksize",
+                           "vertical_grid", "reference_index", "report_mode"],
+    "timeseries": ["linewidth", "labelsize", "ticksize", "run_mean_npts", "time_bin_width", "ensemble_band",
+                   "decimate", "report_mode"],
+    "time_height": ["height_cord", "max_height_timeheight", "labelsize", "ticksize", "usercmap",
+                    "time_height_renderer", "decimate", "report_mode"],
+    "diurnal1d": ["linewidth", "labelsize", "ticksize", "diurnal_start_day", "diurnal_end_day", "ensemble_band",
+                  "report_mode"],
+    "diurnal2d": ["height_cord", "max_height_timeheight", "labelsize", "ticksize", "usercmap",
+                  "diurnal_start_day", "diurnal_end_day", "time_height_renderer", "decimate", "report_mode"],
+    "cfad": ["height_cord", "max_height_timeheight", "labelsize", "ticksize", "usercmap"],
+    "histogram": ["linewidth", "labelsize", "ticksize"],
+    "joint_histogram": ["labelsize", "ticksize", "usercmap"],
+}
+
+# Content digests of variables and datasets, keyed by (id(ds), name)
+_digest_cache = {}
+
+def clear_digest_cache(ds=None):
+    """
+    Clear cached content digests.
+
+    Parameters:
+        ds (xarray.Dataset, optional): Only clear the entries of this dataset.
+            If None the whole cache is cleared.
+    """
+    if ds is None:
+        _digest_cache.clear()
+        return
+    for key in [key for key in _digest_cache if key[0] == id(ds)]:
+        del _digest_cache[key]
+
+def _hash_array(h, values):
+    values = np.ascontiguousarray(values)
+    h.update(f"{values.dtype.str}{values.shape}".encode())
+    h.update(values.tobytes())
+
+def variable_digest(ds, var_name):
+    """
+    Return a digest of the dimensions, attributes and values of a variable.
+    """
+    key = (id(ds), var_name)
+    if key not in _digest_cache:
+        h = hashlib.sha1()
+        # Reduced products of the variable (data cube, histograms) are part of its digest
+        names = [var_name]
+        names += sorted(name for name in ds.data_vars if name.startswith(f"{var_name}__"))
+        for name in names:
+            da = ds[name]
+            h.update(repr((name, da.dims, sorted(da.attrs.items()))).encode())
+            _hash_array(h, da.values)
+        _digest_cache[key] = h.hexdigest()
+    return _digest_cache[key]
+
+def dataset_digest(ds):
+    """
+    Return a digest of the time axis, vertical grids and vertical coordinate
+    variables of a dataset, i.e. everything a plot uses besides the variable.
+    """
+    key = (id(ds), None)
+    if key not in _digest_cache:
+        h = hashlib.sha1()
+        if 'time' in ds.variables:
+            h.update(repr(ds['time'].attrs.get('units')).encode())
+        for name in ['time', 'lev', 'ilev']:
+            if name in ds.variables:
+                _hash_array(h, ds[name].values)
+        for name in COORDINATE_VARIABLES:
+            if name in ds.data_vars:
+                h.update(f"{name}:{variable_digest(ds, name)}".encode())
+        _digest_cache[key] = h.hexdigest()
+    return _digest_cache[key]
+
+def _code_digest():
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def plot_task_key(task):
+    """
+    Return the manifest key of a plot task, i.e. 'profile:T_mid:1'.
+    """
+    kind, args = task
+    if kind in ("profile", "profile_difference"):
+        return f"{kind}:{args[0]}:{args[1]+1}"
+    if kind == "joint_histogram":
+        return f"{kind}:{args[0]}:{args[1]}"
+    return f"{kind}:{args[0]}"
+
+def plot_task_hash(task, datasets, opts, code_digest=None):
+    """
+    Hash everything a plot task depends on: the data of the variable and
+    the coordinates in each dataset, the time window indices, the style of
+    each dataset, the relevant settings and the plotting code itself.
+
+    Returns:
+        str: Hex digest of the task inputs.
+    """
+    kind, args = task
+    var_name = args[0]
+    h = hashlib.sha1()
+    h.update((code_digest or _code_digest()).encode())
+    h.update(repr((kind, args)).encode())
+    h.update(repr([(k, opts[k]) for k in PLOT_TASK_OPTIONS[kind]]).encode())
+    if kind == "timeseries" and opts["time_bin_width"]:
+        h.update(repr(opts["time_bin_edges"]).encode())
+
+    for idx in opts["var_index"][var_name]["datasets"]:
+        ds = datasets[idx]
+        style = (
+            opts["short_ids"][idx],
+            opts["line_colors"][idx] if opts["line_colors"] else None,
+            opts["line_styles"][idx] if opts["line_styles"] else None,
+            opts["time_offset"][idx],
+        )
+        h.update(repr(style).encode())
+        h.update(dataset_digest(ds).encode())
+        h.update(variable_digest(ds, var_name).encode())
+
+        if opts["window_table"] is None:
+            # Render-only runs; the windows are part of the reduced products
+            continue
+        windows = opts["window_table"][idx]
+        if kind in ("profile", "profile_difference"):
+            _hash_array(h, windows["profile"][args[1]])
+        elif kind in ("timeseries", "time_height"):
+            _hash_array(h, windows[kind])
+
+    return h.hexdigest()
+
+def _result_to_manifest(result):
+    # Plot paths are stored relative to the plots directory
+    if isinstance(result, tuple):
+        outfile, window = result
+        return [os.path.basename(outfile) if outfile else None,
+                [t.item() if isinstance(t, np.generic) else t for t in window] if window is not None else None]
+    return os.path.basename(result) if result else None
+
+def _result_from_manifest(kind, entry, output_subdir):
+    if kind == "diurnal1d":
+        outfile, window = entry
+        return (os.path.join(output_subdir, outfile) if outfile else None,
+                tuple(window) if window is not None else None)
+    return os.path.join(output_subdir, entry) if entry else None
+
+def load_plot_manifest(manifest_file):
+    """
+    Read the plot manifest of a previous run; an empty manifest if there is none.
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file) as f:
+            return json.load(f).get("plots", {})
+    except (ValueError, OSError):
+        print(f"Warning: Could not read {manifest_file}. All plots will be rendered.")
+        return {}
+
+def write_plot_manifest(manifest_file, plots):
+    with open(manifest_file, "w") as f:
+        json.dump({"plots": plots}, f, indent=1, sort_keys=True)
+
+def render_plot_tasks_incremental(tasks, datasets, file_paths, opts, n_workers, manifest_file, timings=None,
+                                  on_result=None, close_datasets=True):
+    """
+    Render only the plot tasks whose inputs changed since the previous run.
+
+    A task is up to date when its hash matches the manifest entry and its plot
+    file still exists; its result is then taken from the manifest.  The manifest
+    is rewritten with the tasks of this run.  on_result and close_datasets are
+    as for render_plot_tasks; on_result is called for the up to date tasks
+    while they are checked.
+
+    Returns:
+        list: The result of each task, in task order.
+    """
+    stage = _begin_stage("hashing")
+    previous = load_plot_manifest(manifest_file)
+    output_subdir = opts["output_subdir"]
+    code_digest = _code_digest()
+
+    results = [None] * len(tasks)
+    plots = {}
+    stale = []
+    for i, task in enumerate(tasks):
+        key = plot_task_key(task)
+        task_hash = plot_task_hash(task, datasets, opts, code_digest)
+        plots[key] = {"hash": task_hash}
+        entry = previous.get(key)
+        if entry is not None and entry.get("hash") == task_hash:
+            result = _result_from_manifest(task[0], entry["result"], output_subdir)
+            outfile = result[0] if task[0] == "diurnal1d" else result
+            if outfile is None or os.path.exists(outfile):
+                results[i] = result
+                plots[key]["result"] = entry["result"]
+                if on_result is not None:
+                    on_result(task, result)
+                continue
+        stale.append(i)
+
+    _end_stage(stage, timings=timings)
+    print(f"Incremental rendering: {len(tasks) - len(stale)} of {len(tasks)} plots are up to date")
+    rendered = render_plot_tasks([tasks[i] for i in stale], datasets, file_paths, opts, n_workers, timings, on_result,
+                                 close_datasets)
+    for i, result in zip(stale, rendered):
+        results[i] = result
+        plots[plot_task_key(tasks[i])]["result"] = _result_to_manifest(result)
+
+    write_plot_manifest(manifest_file, plots)
+    return results
+
+#################################
+###### Report archive
+
+# The tar file of a report is written while the report is made: each plot is
+#  added as soon as its task finishes, by a background thread that also does
+#  the compression, so the archive is complete shortly after the last plot.
+#  A manifest of the SHA-1 of every member lets incremental runs update the
+#  archive of the previous run: an uncompressed tar is appended to in place with
+#  only the members that changed (tar extracts the last copy of a member), and a
+#  compressed archive is only rewritten (and recompressed) once a member has
+#  changed, so one in which nothing changed is kept as it is.
+
+# File name suffix of each archive compression
+ARCHIVE_SUFFIXES = {None: "", "gz": ".gz", "xz": ".xz", "zst": ".zst"}
+
+def _open_archive_stream(target, compression, append=False):
+    # (compressor stream or None, tarfile) writing to target
+    if compression is None:
+        return None, tarfile.open(target, "a" if append else "w")
+    if compression == "zst":
+        # One compression thread per core
+        stream = zstandard.ZstdCompressor(level=10, threads=-1).stream_writer(open(target, "wb"))
+        return stream, tarfile.open(fileobj=stream, mode="w|")
+    return None, tarfile.open(target, f"w|{compression}")
+
+def _file_sha1(path, block_size=2**20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _write_member(archive, path, arcname):
+    info = archive["tar"].gettarinfo(path, arcname)
+    if info.isfile():
+        with open(path, "rb") as f:
+            archive["tar"].addfile(info, f)
+    else:
+        archive["tar"].addfile(info)
+
+def _start_archive(archive):
+    # Open the compressed archive being updated once a member has changed, and
+    #  write the members seen so far
+    archive["stream"], archive["tar"] = _open_archive_stream(archive["target"], archive["compression"])
+    for arcname, path in archive["paths"].items():
+        _write_member(archive, path, arcname)
+
+def _archive_member(archive, path, arcname):
+    # Add one file or directory entry, unless the archive being updated has it already
+    if arcname in archive["members"]:
+        return
+    is_file = os.path.isfile(path)
+    digest = _file_sha1(path) if is_file else "directory"
+    archive["members"][arcname] = {"sha1": digest, "size": os.path.getsize(path) if is_file else 0}
+    archive["paths"][arcname] = path
+
+    previous = archive["previous"].get(arcname)
+    if previous is not None and previous["sha1"] == digest:
+        if archive["append"] or archive["tar"] is None:
+            return
+    else:
+        archive["changed"] += 1
+        if archive["append"] and previous is not None:
+            archive["stale_bytes"] += previous["size"]
+        if archive["tar"] is None:
+            _start_archive(archive)
+            return
+    _write_member(archive, path, arcname)
+
+def _archive_worker(archive):
+    while True:
+        item = archive["queue"].get()
+        if item is None:
+            return
+        if archive["error"] is None:
+            try:
+                _archive_member(archive, *item)
+            except Exception as e:
+                archive["error"] = e
+
+def open_report_archive(archive_path, compression=None, manifest_file=None, update=False):
+    """
+    Start writing the archive of a report.
+
+    Parameters:
+        archive_path (str): Path of the archive.
+        compression (str): None, 'gz', 'xz' or 'zst' (needs the zstandard package).
+        manifest_file (str, optional): Checksum manifest of the archive members.
+        update (bool): Update the archive of the previous run recorded in the
+            manifest instead of rebuilding it.
+
+    Returns:
+        dict: The archive, for add_to_archive and close_report_archive.
+    """
+    previous = {}
+    if update and manifest_file and os.path.exists(manifest_file) and os.path.exists(archive_path):
+        try:
+            with open(manifest_file) as f:
+                previous = json.load(f)
+        except (ValueError, OSError):
+            print(f"Warning: Could not read {manifest_file}. The archive will be rebuilt.")
+        if previous.get("compression") != compression:
+            previous = {}
+
+    append = bool(previous) and compression is None
+    archive = {
+        "path": archive_path,
+        "compression": compression,
+        "manifest_file": manifest_file,
+        "previous": previous.get("members", {}),
+        "stale_bytes": previous.get("stale_bytes", 0) if append else 0,
+        "append": append,
+        "target": archive_path if append else archive_path + ".partial",
+        "members": {},
+        "paths": {},
+        "changed": 0,
+        "queue": queue.Queue(),
+        "error": None,
+    }
+    if previous and not append:
+        # A compressed archive is only rewritten once a member has changed
+        archive["stream"], archive["tar"] = None, None
+    else:
+        archive["stream"], archive["tar"] = _open_archive_stream(archive["target"], compression, append)
+    archive["thread"] = threading.Thread(target=_archive_worker, args=(archive,), daemon=True)
+    archive["thread"].start()
+    return archive
+
+def add_to_archive(archive, path, arcname):
+    """
+    Queue a file (or the entry of a directory) to be added to the archive.
+    """
+    archive["queue"].put((path, arcname))
+
+def close_report_archive(archive, directories=()):
+    """
+    Finish the archive: add the files of the given directories that were not
+    added yet, wait for the background thread and write the manifest.  An
+    updated tar that has lost members, or holds more replaced than current
+    data, is rebuilt.
+
+    Parameters:
+        archive (dict): Archive returned by open_report_archive.
+        directories (list): (directory, arcname) pairs archived like tar.add.
+
+    Returns:
+        dict: Number of members and of changed members, and how the archive
+            was written ('rebuilt', 'updated' or 'unchanged').
+    """
+    for directory, arcname in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            rel = os.path.relpath(root, directory)
+            prefix = arcname if rel == "." else f"{arcname}/{rel}"
+            add_to_archive(archive, root, prefix)
+            for name in sorted(files):
+                add_to_archive(archive, os.path.join(root, name), f"{prefix}/{name}")
+    archive["queue"].put(None)
+    archive["thread"].join()
+    members = archive["members"]
+    removed = set(archive["previous"]) - set(members)
+    if archive["tar"] is None and removed and archive["error"] is None:
+        _start_archive(archive)
+    if archive["tar"] is not None:
+        archive["tar"].close()
+    if archive["stream"] is not None:
+        archive["stream"].close()
+    if archive["error"] is not None:
+        raise archive["error"]
+
+    live_bytes = sum(m["size"] for m in members.values())
+    if archive["append"] and (removed or archive["stale_bytes"] > live_bytes):
+        stream, tar = _open_archive_stream(archive["path"] + ".partial", archive["compression"])
+        for arcname, path in archive["paths"].items():
+            tar.add(path, arcname=arcname, recursive=False)
+        tar.close()
+        os.replace(archive["path"] + ".partial", archive["path"])
+        archive["stale_bytes"] = 0
+        status = "rebuilt"
+    elif archive["append"]:
+        status = "updated"
+    elif archive["tar"] is None:
+        status = "unchanged"
+    else:
+        os.replace(archive["target"], archive["path"])
+        status = "rebuilt"
+
+    if archive["manifest_file"]:
+        with open(archive["manifest_file"], "w") as f:
+            json.dump({"archive": os.path.basename(archive["path"]), "compression": archive["compression"],
+                       "stale_bytes": archive["stale_bytes"], "members": members}, f, indent=1, sort_keys=True)
+    return {"members": len(members), "changed": archive["changed"], "status": status}
+
+#################################
+###### Main program
+
+def requested_variables(variables, cfad_variables=None, joint_histograms=None, conditional_masks=None,
+                        conditional_variables=None):
+    """
+    Return the variables to plot with those needed by the histograms across
+    columns and the conditional samples added, or None for all variables.
+    """
+    if variables is None:
+        return None
+    extra_vars = list(_histogram_settings(cfad_variables)) + [v for pair in joint_histograms or [] for v in pair]
+    extra_vars += conditional_sample_names(conditional_masks, conditional_variables)
+    return list(variables) + [v for v in extra_vars if v not in variables]
+
+def open_case_datasets(file_paths, ensembles, avg_dir, lazy_load=False, time_chunk=None, variables=None,
+                       horiz_avg_variance=False, cfad_variables=None, joint_histograms=None,
+                       conditional_masks=None, conditional_variables=None):
+    """
+    Open the datasets of a case.  Full-field output is reduced to domain means
+    once, written to avg_dir/dataset{n}.nc, and that file is opened instead.
+
+    Returns:
+        tuple: (datasets, file_paths) with the paths of the files actually opened.
+    """
+    if lazy_load and not HAS_DASK:
+        print("Warning: dask is not available, datasets will be read without chunking.")
+
+    file_paths = list(file_paths)
+    datasets = [load_dataset(fp, lazy_load, time_chunk, ensemble=ensemble)
+                for fp, ensemble in zip(file_paths, ensembles)]
 
-    except ValueError:
-        print("Error: One or both dates are not in the correct 'yyyymmdd' format.")
-        return -999.0  # Error flag
+    # Reduce full-field output to domain means once; all stages use the means
+    for idx, ds in enumerate(datasets):
+        if is_full_field(ds):
+            avg_file = os.path.join(avg_dir, f"dataset{idx + 1}.nc")
+            write_horizontal_average(file_paths[idx], ds, avg_file, time_chunk, horiz_avg_variance, variables,
+                                     cfad_variables, joint_histograms, conditional_masks,
+                                     conditional_variables)
+            ds.close()
+            file_paths[idx] = avg_file
+            datasets[idx] = load_dataset(avg_file, lazy_load, time_chunk)
+    return datasets, file_paths
+
+def dataset_time_offsets(datasets):
+    """
+    Return the offset in days of the start of each dataset to the start of the
+    first one (0 for datasets without a reference date).
+    """
+    start_date_base, start_seconds_base = extract_time_info(datasets[0])
 
-#################################
-###### Main program
+    time_offset = []
+    for ds in datasets:
+        test_date, test_seconds = extract_time_info(ds)
+        offset = compute_date_time_difference(start_date_base, start_seconds_base, test_date, test_seconds) if test_date != -999 else 0.0
+        time_offset.append(offset)
+    return time_offset
 
-def run_diagnostics(
+def select_variables(var_index, variables):
+    """
+    Restrict a variable index to the requested variables (None keeps all),
+    warning about those that are in no dataset.
+    """
+    if variables is None:
+        return var_index
+    for var_name in variables:
+        if var_name not in var_index:
+            print(f"Warning: Variable '{var_name}' was not found in any dataset.")
+    return {k: v for k, v in var_index.items()
+            if k in variables or k.removesuffix("_horiz_variance") in variables}
+
+def _run_diagnostics(
     output_dir,
     general_id,
     datasets,
@@ -381,8 +4068,86 @@ def run_diagnostics(
     run_mean_npts=0,
     usercmap="viridis_r",
     ticksize=14,
-    labelsize=14
+    labelsize=14,
+    n_workers=1,
+    lazy_load=False,
+    time_chunk=None,
+    variables=None,
+    incremental=False,
+    data_cube=False,
+    render_only=False,
+    timings=None,
+    profile=False,
+    profile_memory=False,
+    horiz_avg_variance=False,
+    cfad_variables=None,
+    joint_histograms=None,
+    conditional_masks=None,
+    conditional_variables=None,
+    vertical_grid=None,
+    reference_dataset=None,
+    time_bin_width=None,
+    ensemble_band=(10, 90),
+    time_height_renderer="contourf",
+    decimate=True,
+    report_mode="static",
+    archive_compression=None,
+    session=None
 ):
+    """
+    Make the diagnostics plots, web pages and tar file of one case.  See
+    diagnostics_user_driver.py and README.md for a description of the settings.
+
+    If a dictionary is given as timings, it receives the wall time in seconds
+    of each stage: load (including the reopen without unused variables),
+    classification, data_cube, metrics, hashing, render (all plots, including
+    hashing), html and tar.  The render time of each
+    kind of plot, summed over the plots (and workers), is given under
+    'cpu_<kind>', i.e. 'cpu_profile'; it is not a wall time.
+
+    With profile=True the wall time of each stage, plot and helper (see
+    instrument) is written to profile.json and profile.html in the output
+    directory and hooks registered with add_profile_hook are called.  The peak
+    memory of each stage is added with profile_memory=True.
+
+    If reference_dataset names the short_id of a dataset, the profiles of the
+    other datasets are also plotted as differences from it, after interpolation
+    to vertical_grid (heights in m or pressures in hPa, following height_cord;
+    None for default_vertical_grid).  Their skill metrics against it are
+    written to metrics.csv, metrics.json and a metrics page with Taylor diagrams.
+
+    Time series are compared on a common time axis of bins time_bin_width days
+    wide (None for the coarsest sampling interval of the datasets).  If
+    time_bin_width is given, the time series plots also show the bin means.
+
+    A dataset with "ensemble": True has its files opened as the members of an
+    ensemble (see open_ensemble_dataset).  Its profiles, time series and 1D
+    diurnal composites show the ensemble mean with a band of the spread across
+    members: ensemble_band is a pair of percentiles, "minmax" or "std".
+
+    time_height_renderer selects how the time-height and 2D diurnal panels are
+    drawn, see draw_time_height_panel.
+
+    With decimate, time series with many more samples than the plot has pixel
+    columns are reduced to the minimum and maximum of each column, and
+    time-height data are averaged over blocks of times; False plots every sample.
+
+    report_mode "interactive" writes the data of the profile, time series,
+    time-height and diurnal plots for drawing in the browser instead of
+    images, see PLOT_PAYLOADS.
+
+    The archive {general_id}_diagnostics.tar is written while the plots are
+    made, compressed with archive_compression (None, "gz", "xz" or "zst"), and
+    updated rather than rebuilt by incremental runs, see open_report_archive.
+
+    If a DiagnosticsSession is given as session, its open datasets are used
+    (datasets still gives the short_ids, colors and styles) and left open.
+    """
+    if render_only and session is not None:
+        raise ValueError("render_only reads the data cube and cannot be combined with a session.")
+    if profile:
+        enable_profiling(profile_memory)
+    stage = _begin_stage()
 
     output_subdir = os.path.join(output_dir, general_id, "plots")
     os.makedirs(output_subdir, exist_ok=True)
@@ -392,318 +4157,305 @@ def run_diagnostics(
     os.system('cp logos/asr_logo_final.png ' + output_subdir)
     os.system('cp logos/arm_logo.png ' + output_subdir)
     os.system('cp logos/e3sm_logo.png ' + output_subdir)
+    if report_mode == "interactive":
+        os.system('cp interactive/interactive_plots.js ' + output_subdir)
 
     # Extract information from the input datasets
     filenames = [c["filename"] for c in datasets]
     short_ids = [c["short_id"] for c in datasets]
     line_colors = [c.get("line_color") for c in datasets]
     line_styles = [c.get("line_style") for c in datasets]
+    ensembles = [bool(c.get("ensemble", False)) for c in datasets]
 
     file_paths = filenames
     datasets = []
 
-    for fp in file_paths:
-        ds = xr.open_dataset(fp, decode_times=False)
-
-        # Treatement of PRECT for E3SM
-        if 'PRECC' in ds.data_vars and 'PRECL' in ds.data_vars:
-            ds['PRECT'] = ds['PRECC'] + ds['PRECL']
-            # Add metadata
-            ds['PRECT'].attrs['long_name'] = 'Total Surface Precipitation Rate'
-            ds['PRECT'].attrs['units'] = ds['PRECC'].attrs.get('units', 'm/s')
-
-        datasets.append(ds)
+    # Variables with histograms across columns and conditional samples are always kept
+    variables = requested_variables(variables, cfad_variables, joint_histograms, conditional_masks,
+                                    conditional_variables)
+
+    # Settings the reduced products depend on (see DATA_CUBE_SETTINGS)
+    cube_dir = os.path.join(output_dir, general_id, "data_cube")
+    cube_settings = {
+        "profile_time_s": list(profile_time_s),
+        "profile_time_e": list(profile_time_e),
+        "height_cord": height_cord,
+        "time_series_time_s": time_series_time_s,
+        "time_series_time_e": time_series_time_e,
+        "time_height_time_s": time_height_time_s,
+        "time_height_time_e": time_height_time_e,
+        "do_timeheight": bool(do_timeheight),
+        "do_diurnal_composites": bool(do_diurnal_composites),
+        "diurnal_start_day": diurnal_start_day,
+        "diurnal_end_day": diurnal_end_day,
+        "ensemble_band": list(ensemble_band) if isinstance(ensemble_band, tuple) else ensemble_band,
+    }
+
+    if render_only:
+        # Rebuild the report from the data cube without opening the input files
+        cube_index = read_data_cube_index(cube_dir, cube_settings)
+        file_paths = cube_index["files"]
+        lazy_load = False
+        ensembles = [False] * len(file_paths)
+        for fp in file_paths:
+            datasets.append(load_dataset(fp))
+    elif session is not None:
+        # Datasets kept open by a DiagnosticsSession, see DiagnosticsSession.report
+        file_paths = session.file_paths
+        lazy_load = session.lazy_load
+        time_chunk = session.time_chunk
+        datasets = list(session.datasets)
+    else:
+        datasets, file_paths = open_case_datasets(file_paths, ensembles,
+                                                  os.path.join(output_dir, general_id, "horiz_avg"),
+                                                  lazy_load, time_chunk, variables, horiz_avg_variance,
+                                                  cfad_variables, joint_histograms, conditional_masks,
+                                                  conditional_variables)
 
     if len(datasets) != len(short_ids):
         raise ValueError("The number of casenames must match the number of short_ids.")
+    if report_mode not in REPORT_MODES:
+        raise ValueError(f"Invalid report_mode: {report_mode}. Must be one of {REPORT_MODES}.")
+    if time_height_renderer not in TIME_HEIGHT_RENDERERS:
+        raise ValueError(f"Invalid time_height_renderer: {time_height_renderer}. "
+                         f"Must be one of {TIME_HEIGHT_RENDERERS}.")
+    if reference_dataset is not None and reference_dataset not in short_ids:
+        raise ValueError(f"reference_dataset '{reference_dataset}' is not the short_id of a dataset.")
     if line_colors and len(line_colors) != len(datasets):
         raise ValueError("Length of 'line_colors' must match the number of casenames.")
     if line_styles and len(line_styles) != len(datasets):
         raise ValueError("Length of 'line_styles' must match the number of casenames.")
+    if archive_compression not in ARCHIVE_SUFFIXES:
+        raise ValueError(f"Invalid archive_compression: {archive_compression}. "
+                         f"Must be one of {list(ARCHIVE_SUFFIXES)}.")
+    if archive_compression == "zst" and not HAS_ZSTD:
+        print("Warning: zstandard is not available, the archive will be compressed with gzip.")
+        archive_compression = "gz"
+
+    # Plots are added to the archive as soon as they are made
+    tar_filename = os.path.join(output_dir, f"{general_id}_diagnostics.tar{ARCHIVE_SUFFIXES[archive_compression]}")
+    archive = open_report_archive(tar_filename, archive_compression,
+                                  os.path.join(output_dir, general_id, "archive_manifest.json"), incremental)
+    add_to_archive(archive, output_subdir, "plots")
+
+    def archive_plot(task, result):
+        outfile = result[0] if task[0] == "diurnal1d" else result
+        if outfile:
+            add_to_archive(archive, outfile, f"plots/{os.path.basename(outfile)}")
 
     profile_plots = []
     timeseries_plots = []
     time_height_plots = []
     diurnal1d_plots = []
     diurnal2d_plots = []
-    
+
     # Initialize some variables
     diurnal_start_day_web=0
     diurnal_end_day_web=0
 
-    all_vars = set()
-    for ds in datasets:
-        all_vars.update(ds.data_vars.keys())
-
     print("Starting IOP Diagnostics Package")
 
-    start_date_base, start_seconds_base = extract_time_info(datasets[0])
+    if render_only:
+        time_offset = cube_index["time_offset"]
+    elif session is not None:
+        time_offset = session.time_offset
+    else:
+        time_offset = dataset_time_offsets(datasets)
 
-    time_offset = []
-    for ds in datasets:
-        test_date, test_seconds = extract_time_info(ds)
-        offset = compute_date_time_difference(start_date_base, start_seconds_base, test_date, test_seconds) if test_date != -999 else 0.0
-        time_offset.append(offset)
+    stage = _next_stage(stage, "load", timings)
 
     print("Datasets that will be considered:")
     for ds, sid in zip(datasets, short_ids):
-        print(f" - {ds.encoding.get('source', 'Unknown source')} ({sid})")
+        print(f" - {ds.encoding.get('source', ds.attrs.get('source', 'Unknown source'))} ({sid})")
 
-    print("Generating Profile Plots")
+    drop_variables = [None] * len(datasets)
+    if render_only:
+        window_table = None
+        var_index = cube_index["var_index"]
+    else:
+        # Time windows of every dataset, built once and shared by all stages
+        window_table = [
+            build_time_window_table(ds, time_offset[idx], profile_time_s, profile_time_e,
+                                    time_series_time_s, time_series_time_e,
+                                    time_height_time_s, time_height_time_e)
+            for idx, ds in enumerate(datasets)
+        ]
+
+        # Classify every variable once; each stage then only visits its own variables
+        var_index = session.var_index if session is not None else classify_variables(datasets)
+
+    var_index = select_variables(var_index, variables)
+    profile_vars = variables_of_shape(var_index, 'profile')
+    timeseries_vars = variables_of_shape(var_index, 'timeseries')
+
+    # Reopen the datasets without the variables that will not be used
+    reopen = not render_only and session is None and (lazy_load or variables is not None)
+    if reopen:
+        drop_variables = [select_dataset_variables(ds, var_index) for ds in datasets]
+    stage = _next_stage(stage, "classification", timings)
+
+    if reopen:
+        for idx, fp in enumerate(file_paths):
+            datasets[idx].close()
+            datasets[idx] = load_dataset(fp, lazy_load, time_chunk, drop_variables[idx], ensembles[idx])
+        stage = _next_stage(stage, "load", timings)
+
+    opts = {
+        "short_ids": short_ids,
+        "line_colors": line_colors,
+        "line_styles": line_styles,
+        "time_offset": time_offset,
+        "height_cord": height_cord,
+        "max_height_profile": max_height_profile,
+        "max_height_timeheight": max_height_timeheight,
+        "linewidth": linewidth,
+        "time_series_time_s": time_series_time_s,
+        "time_series_time_e": time_series_time_e,
+        "time_height_time_s": time_height_time_s,
+        "time_height_time_e": time_height_time_e,
+        "diurnal_start_day": diurnal_start_day,
+        "diurnal_end_day": diurnal_end_day,
+        "run_mean_npts": run_mean_npts,
+        "usercmap": usercmap,
+        "ticksize": ticksize,
+        "labelsize": labelsize,
+        "output_subdir": output_subdir,
+        "var_index": var_index,
+        "window_table": window_table,
+        "lazy_load": lazy_load,
+        "time_chunk": time_chunk,
+        "drop_variables": drop_variables,
+        "profile": profile,
+        "profile_memory": profile_memory,
+        "vertical_grid": [float(v) for v in (vertical_grid if vertical_grid is not None
+                                             else default_vertical_grid(height_cord, max_height_profile))],
+        "reference_index": short_ids.index(reference_dataset) if reference_dataset is not None else None,
+        "ensemble": ensembles,
+        "ensemble_band": ensemble_band,
+        "time_height_renderer": time_height_renderer,
+        "decimate": decimate,
+        "report_mode": report_mode,
+    }
+
+    if data_cube and not render_only:
+        # Write the reduced products, then render from them like a render-only run
+        print(f"Writing reduced products to {cube_dir}")
+        file_paths = write_data_cube(cube_dir, datasets, opts, cube_settings)
+        for ds in datasets if session is None else []:
+            clear_dataset_caches(ds)
+            ds.close()
+        datasets = [load_dataset(fp) for fp in file_paths]
+        opts["lazy_load"] = False
+        opts["drop_variables"] = [None] * len(datasets)
+        opts["ensemble"] = [False] * len(datasets)
+        stage = _next_stage(stage, "data_cube", timings)
+
+    # Common time axis for datasets sampled at different cadences
+    opts["time_bin_width"] = time_bin_width
+    opts["time_bin_edges"] = common_time_axis(datasets, opts, time_bin_width)
+
+    # Skill metrics against the reference, before the plot workers take over the datasets
+    metric_rows = []
+    taylor_diagrams = []
+    if reference_dataset is not None:
+        print(f"Computing skill metrics against {reference_dataset}")
+        metric_rows = compute_skill_metrics(datasets, opts)
+        write_skill_metrics(metric_rows, os.path.join(output_dir, general_id))
+        taylor_diagrams = plot_taylor_diagrams(metric_rows, profile_time_s, profile_time_e, opts)
+        for name in ["metrics.csv", "metrics.json"]:
+            add_to_archive(archive, os.path.join(output_dir, general_id, name), name)
+        for _, outfile in taylor_diagrams:
+            add_to_archive(archive, outfile, f"plots/{os.path.basename(outfile)}")
+        stage = _next_stage(stage, "metrics", timings)
+
+    # Each plot is collected as a task so that they can be rendered in parallel
+    tasks = []
 
-    for var_name in all_vars:
-        if any(var_name in ds.data_vars and
-               ds[var_name].ndim in [2, 3] and
-               any(dim in ['lev', 'ilev'] for dim in ds[var_name].dims) and
-               'time' in ds[var_name].dims for ds in datasets):
+    print("Generating Profile Plots")
+    for var_name in profile_vars:
+        for window_idx, (start_time, end_time) in enumerate(zip(profile_time_s, profile_time_e)):
+            tasks.append(("profile", (var_name, window_idx, start_time, end_time)))
 
+    if reference_dataset is not None:
+        print(f"Generating Profile Difference Plots (reference {reference_dataset})")
+        for var_name in profile_vars:
             for window_idx, (start_time, end_time) in enumerate(zip(profile_time_s, profile_time_e)):
-                plt.figure(figsize=(8, 6))
-                valid_plot = False
-
-                for idx, (ds, short_id) in enumerate(zip(datasets, short_ids)):
-                    if var_name not in ds.data_vars:
-                        continue
-
-                    valid_plot = True
-                    time_in_days = ds['time'] - time_offset[idx]
-                    stime = start_time if start_time != "end" else time_in_days[0]
-                    etime = end_time if end_time != "end" else time_in_days[-1]
-                    time_indices = np.where((time_in_days >= stime) & (time_in_days <= etime))[0]
-
-                    time_filtered_data = ds[var_name].isel(time=time_indices).mean(dim="time",skipna=True)
-                    y_coord = compute_y_coord(ds, time_indices, height_cord, var_name)
-
-                    if height_cord == "z":
-                        y_min, y_max = (0, max_height_profile) if max_height_profile else (y_coord.min(), y_coord.max())
-                    else:
-                        y_min, y_max = (max_height_profile, y_coord.max()) if max_height_profile else (y_coord.min(), y_coord.max())
-
-                    valid_indices = np.where((y_coord >= y_min) & (y_coord <= y_max))[0]
-                    filtered_y_coord = y_coord[valid_indices]
-                    filtered_data = time_filtered_data.isel(lev=valid_indices) if "lev" in time_filtered_data.dims else time_filtered_data.isel(ilev=valid_indices)
-
-                    plot_kwargs = {'label': short_id, 'linewidth': linewidth}
-                    if line_colors: plot_kwargs['color'] = line_colors[idx]
-                    if line_styles: plot_kwargs['linestyle'] = line_styles[idx]
-
-                    plt.plot(np.squeeze(filtered_data), filtered_y_coord, **plot_kwargs)
-
-                if valid_plot:
-                    plt.ylim([y_min, y_max])
-                    if height_cord == "p":
-                        plt.gca().invert_yaxis()
-
-                    var_units = next((ds[var_name].attrs.get('units', 'Value') for ds in datasets if var_name in ds.data_vars), 'Value')
-                    var_long_name = next((ds[var_name].attrs.get('long_name', var_name) for ds in datasets if var_name in ds.data_vars), var_name)
-                    if var_long_name == "MISSING": var_long_name = var_name
-
-                    plt.xlabel(var_units, fontsize=labelsize)
-                    ylabel = 'Height (m)' if height_cord == "z" else 'Pressure (hPa)'
-                    plt.ylabel(ylabel, fontsize=labelsize)
-                    plt.title(f"{var_long_name} Profile (Day {start_time} to Day {end_time})", fontsize=16)
-                    plt.legend(fontsize=14)
-                    plt.grid(color='#95a5a6', linestyle='--', linewidth=2, alpha=0.5)
-                    plt.tick_params(labelsize=ticksize)
-
-                    plot_filename = os.path.join(output_subdir, f"{var_name}_profile_window{window_idx+1}.jpg")
-                    plt.savefig(plot_filename, format='jpg')
-                    plt.close()
-                    profile_plots.append((plot_filename, window_idx+1))
-                else:
-                    print(f"Warning: Variable '{var_name}' is not a valid plotting variable. Skipping this variable.")
+                tasks.append(("profile_difference", (var_name, window_idx, start_time, end_time)))
 
     # =================================================================
     # Plot time series
     # =================================================================
 
     print("Generating Time Series Plots")
-    for var_name in all_vars:
-        if any(
-            var_name in ds.data_vars and
-            ds[var_name].ndim in [1, 2] and
-            'time' in ds[var_name].dims and
-            not any(dim in ['lev', 'ilev'] for dim in ds[var_name].dims)
-            for ds in datasets
-        ):
-            plt.figure(figsize=(10, 5))
-            valid_plot = False
-
-            for idx, (ds, short_id) in enumerate(zip(datasets, short_ids)):
-                if var_name not in ds.data_vars:
-                    continue
-
-                time_in_days = ds['time'] - time_offset[idx]
-                stime = time_series_time_s if time_series_time_s is not None else time_in_days[0]
-                etime = time_series_time_e if time_series_time_e is not None else time_in_days[-1]
-                time_indices = np.where((time_in_days >= stime) & (time_in_days <= etime))[0]
-
-                if ds[var_name].ndim == 2 and 'ncol' in ds[var_name].dims:
-                    variable_data = ds[var_name].isel(time=time_indices)[:, 0]
-                elif ds[var_name].ndim == 1 and 'time' in ds[var_name].dims:
-                    variable_data = ds[var_name].isel(time=time_indices)
-                else:
-                    continue
-
-                # Apply running mean if requested
-                if run_mean_npts > 0 and variable_data.size >= run_mean_npts:
-                    variable_data = variable_data.rolling(time=run_mean_npts, center=True).mean(skipna=True)
-                    time_plot = time_in_days[time_indices]
-                else:
-                    time_plot = time_in_days[time_indices]
-
-                plot_kwargs = {'label': short_id, 'linewidth': linewidth}
-                if line_colors: plot_kwargs['color'] = line_colors[idx]
-                if line_styles: plot_kwargs['linestyle'] = line_styles[idx]
-
-                plt.plot(time_plot, variable_data, **plot_kwargs)
-                valid_plot = True
-
-            if valid_plot:
-                var_units = next((ds[var_name].attrs.get('units', 'Value') for ds in datasets if var_name in ds.data_vars), 'Value')
-                var_long_name = next((ds[var_name].attrs.get('long_name', var_name) for ds in datasets if var_name in ds.data_vars), var_name)
-                if var_long_name == "MISSING":
-                    var_long_name = var_name
-
-                plt.xlabel("Time (days)", fontsize=labelsize)
-                plt.ylabel(var_units, fontsize=labelsize)
-                plt.title(f"{var_long_name} Time Series", fontsize=16)
-                plt.legend(fontsize=14)
-                plt.grid(color='#95a5a6', linestyle='--', linewidth=2, alpha=0.5)
-                plt.tick_params(labelsize=ticksize)
-
-                plot_filename = os.path.join(output_subdir, f"{var_name}_timeseries.jpg")
-                plt.savefig(plot_filename, format='jpg')
-                plt.close()
-                timeseries_plots.append(plot_filename)
-            else:
-                print(f"Warning: Variable '{var_name}' is not a valid plotting variable. Skipping this variable.")
-
-
+    for var_name in timeseries_vars:
+        tasks.append(("timeseries", (var_name,)))
 
     #############################################################################################################
     # Plot time-height variables (two or three dimensions: time, ncol, lev or ilev)
     if do_timeheight:
         print("Generating Time Time-Height Plots")
-        for var_name in all_vars:
-            if any(
-                var_name in ds.data_vars and
-                ds[var_name].ndim in [2, 3] and
-                any(dim in ['lev', 'ilev'] for dim in ds[var_name].dims) and
-                'time' in ds[var_name].dims
-                for ds in datasets
-            ):
-                outfile = plot_time_height_panel_grid(
-                    var_name,
-                    datasets,
-                    short_ids,
-                    time_offset,
-                    height_cord,
-                    output_subdir,
-                    labelsize,
-                    ticksize,
-                    usercmap,
-                    time_height_time_s,
-                    time_height_time_e,
-                    max_height_timeheight,
-                    is_diurnal=False
-                )
-                if outfile:
-                    time_height_plots.append(outfile)
+        for var_name in profile_vars:
+            tasks.append(("time_height", (var_name,)))
 
     #############################################################################################################
     # Diurnal Composite diagnostics 1-D
 
     if do_diurnal_composites:
         print("Generating 1D Diurnal Composite Plots")
-        diurnal1d_plots = []
-        for var_name in all_vars:
-            # Initialize figure
-            plt.figure(figsize=(10, 5))
-            valid_plot = False
-            prect_treatment = False
-
-            for idx, (ds, short_id) in enumerate(zip(datasets, short_ids)):
-                if var_name not in ds:
-                    continue
-
-                allowed_dims = {'time', 'ncol', 'lev', 'ilev'}
-                var_dims = set(ds[var_name].dims)
-
-                # Must include 'time', and all dims must be in the allowed list
-                if 'time' not in var_dims or not var_dims.issubset(allowed_dims):
-                    continue
-
-                if ds[var_name].dtype.kind in {'S', 'U'}:
-                    continue
-
-                composite, hour_labels, success, ndim, stime, etime = compute_diurnal_composite(
-                    ds, var_name, idx, time_offset, diurnal_start_day, diurnal_end_day)
-                if not success or ndim !=1:
-                    continue
-
-                if success:
-                    diurnal_start_day_web = stime
-                    diurnal_end_day_web = etime
-
-                plot_kwargs = {'label': short_id, 'linewidth': linewidth}
-                if line_colors: plot_kwargs['color'] = line_colors[idx]
-                if line_styles: plot_kwargs['linestyle'] = line_styles[idx]
-                plt.plot(hour_labels, composite, **plot_kwargs)
-                valid_plot = True
-
-            if valid_plot:
-                plt.xlabel("Time (hour - UTC)", fontsize=labelsize)
-                var_units = next((ds[var_name].attrs.get('units', 'Value') for ds in datasets if var_name in ds.data_vars), 'Value')
-                var_long_name = next((ds[var_name].attrs.get('long_name', var_name) for ds in datasets if var_name in ds.data_vars), var_name)
-                if var_long_name == "MISSING": var_long_name = var_name
-
-                plt.ylabel(var_units, fontsize=labelsize)
-                plt.title(f"{var_long_name} Diurnal Composite", fontsize=16)
-                plt.legend(fontsize=14)
-                plt.grid(color='#95a5a6', linestyle='--', linewidth=2, alpha=0.5)
-                plt.tick_params(labelsize=ticksize)
-
-                plot_filename = os.path.join(output_subdir, f"{var_name}_diurnal1d.jpg")
-                plt.savefig(plot_filename, format='jpg')
-                plt.close()
-                diurnal1d_plots.append(plot_filename)
-
-            plt.close()
+        for var_name in timeseries_vars:
+            tasks.append(("diurnal1d", (var_name,)))
 
     #############################################################################################################
     # 2D diurnal composite plots (two or three dimensions: time, ncol, lev or ilev)
     if do_diurnal_composites:
         print("Generating 2D Diurnal Composite Plots")
-        for var_name in all_vars:
-            if any(
-                var_name in ds.data_vars and
-                ds[var_name].ndim in [2, 3] and
-                any(dim in ['lev', 'ilev'] for dim in ds[var_name].dims) and
-                'time' in ds[var_name].dims
-                for ds in datasets
-            ):
-                outfile = plot_time_height_panel_grid(
-                    var_name,
-                    datasets,
-                    short_ids,
-                    time_offset,
-                    height_cord,
-                    output_subdir,
-                    labelsize,
-                    ticksize,
-                    usercmap,
-                    diurnal_start_day,
-                    diurnal_end_day,
-                    max_height_timeheight,
-                    is_diurnal=True
-                )
-                if outfile:
-                    diurnal2d_plots.append(outfile)
-
-    # Close datasets
-    for ds in datasets:
-        ds.close()
+        for var_name in profile_vars:
+            tasks.append(("diurnal2d", (var_name,)))
+
+    # CFADs and histograms across the columns of full-field datasets
+    histogram_tasks = histogram_plot_tasks(datasets, var_index)
+    if histogram_tasks:
+        print("Generating CFAD and Histogram Plots")
+        tasks.extend(histogram_tasks)
+
+    # The datasets of a session stay open for its later plots; the data cube
+    #  datasets opened above are ours to close
+    close_datasets = session is None or data_cube
+    if n_workers > 1:
+        print(f"Rendering {len(tasks)} plots with {n_workers} worker processes")
+    if incremental:
+        manifest_file = os.path.join(output_dir, general_id, "plot_manifest.json")
+        results = render_plot_tasks_incremental(tasks, datasets, file_paths, opts, n_workers, manifest_file, timings,
+                                                archive_plot, close_datasets)
+    else:
+        results = render_plot_tasks(tasks, datasets, file_paths, opts, n_workers, timings, archive_plot,
+                                    close_datasets)
+
+    # Sort the rendered plots into their pages.  The HTML/tar stage below only
+    # starts once every task has finished.
+    for (kind, args), result in zip(tasks, results):
+        if kind == "diurnal1d":
+            result, diurnal_window = result
+            if diurnal_window is not None:
+                diurnal_start_day_web, diurnal_end_day_web = diurnal_window
+        if not result:
+            continue
+        if kind in ("profile", "profile_difference"):
+            profile_plots.append((result, args[1]+1))
+        elif kind == "timeseries":
+            timeseries_plots.append(result)
+        elif kind in ("time_height", "cfad", "histogram", "joint_histogram"):
+            time_height_plots.append(result)
+        elif kind == "diurnal1d":
+            diurnal1d_plots.append(result)
+        elif kind == "diurnal2d":
+            diurnal2d_plots.append(result)
+
+    # Close datasets; those of a session stay open with their caches
+    if close_datasets:
+        for ds in datasets:
+            clear_dataset_caches(ds)
+            ds.close()
 
     #############################################################################################################
     # End of diagnostics generation, rest of program makes web interface
@@ -894,12 +4646,124 @@ def run_diagnostics(
     </html>
     """
 
+    metrics_html_template = """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <title>{{ title }}</title>
+        <style>
+            table { border-collapse: collapse; margin-bottom: 30px; }
+            th, td { border: 1px solid #ccc; padding: 4px 10px; text-align: right; }
+            th:nth-child(-n+4), td:nth-child(-n+4) { text-align: left; }
+            .grid-container {
+                display: grid;
+                grid-template-columns: 1fr 1fr;
+                gap: 20px;
+                padding: 10px;
+            }
+            .grid-item {
+                text-align: center;
+            }
+            img {
+                width: 100%;  /* Taylor diagram width */
+                max-width: 600px;  /* Taylor diagram max width */
+                height: auto;
+            }
+        </style>
+    </head>
+    <body>
+        <h1>{{ title }}</h1>
+        <p>Download: <a href="metrics.csv">metrics.csv</a>, <a href="metrics.json">metrics.json</a></p>
+        <div class="grid-container">
+        {% for diagram_title, img in diagrams %}
+            <div class="grid-item">
+                <h3>{{ diagram_title }}</h3>
+                <img src="plots/{{ img }}" alt="{{ img }}">
+            </div>
+        {% endfor %}
+        </div>
+        <table>
+            <tr><th>Variable</th><th>Window</th><th>Dataset</th><th>Reference</th>
+                <th>Bias</th><th>RMSE</th><th>Correlation</th><th>Std. ratio</th><th>N</th></tr>
+            {% for row in rows %}
+            <tr><td>{{ row.variable }}</td><td>{{ row.window if row.window else "time series" }}</td>
+                <td>{{ row.dataset }}</td><td>{{ row.reference }}</td>
+                {% for metric in ["bias", "rmse", "correlation", "std_ratio"] %}
+                <td>{% if row[metric] is not none %}{{ "%.4g" | format(row[metric]) }}{% endif %}</td>
+                {% endfor %}
+                <td>{{ row.n }}</td></tr>
+            {% endfor %}
+        </table>
+    </body>
+    </html>
+    """
+
+    # Pages of the interactive report mode: the plots are drawn in the browser
+    #  from their data payloads (plots/<plot>.js); other plots stay images.
+    interactive_html_template = """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <title>{{ title }}</title>
+        <style>
+            .grid-container {
+                display: grid;
+                grid-template-columns: {{ columns }};
+                gap: 20px;
+                padding: 10px;
+            }
+            .grid-item {
+                text-align: center;
+                overflow-x: auto;
+            }
+            .diagnostics-legend {
+                font-size: 14px;
+                margin: 4px 0;
+            }
+            img {
+                width: 100%;
+                max-width: 900px;
+                height: auto;
+            }
+        </style>
+        <script src="plots/interactive_plots.js"></script>
+        {% for item in images if item.endswith(".js") %}
+        <script src="plots/{{ item }}"></script>
+        {% endfor %}
+    </head>
+    <body>
+        <h1>{{ title }}</h1>
+        <p>Drag a rectangle over a plot to zoom and double click to reset; the check boxes show or hide each dataset.</p>
+        <div class="grid-container">
+        {% for item in images %}
+            <div class="grid-item">
+                <h3>{{ item }}</h3>
+                {% if item.endswith(".js") %}
+                <div class="diagnostics-plot" data-payload="{{ item[:-3] }}"></div>
+                {% else %}
+                <img src="plots/{{ item }}" alt="{{ item }}">
+                {% endif %}
+            </div>
+        {% endfor %}
+        </div>
+    </body>
+    </html>
+    """
+    if report_mode == "interactive":
+        profile_html_template = timeseries_html_template = diurnal1d_html_template = interactive_html_template
+        time_height_html_template = diurnal2d_html_template = interactive_html_template
+
+    stage = _next_stage(stage, "render", timings)
+
     # Generate profile HTML files for each averaging window
     for window_idx, (start_time, end_time) in enumerate(zip(profile_time_s, profile_time_e)):
         sorted_images = sorted([os.path.basename(p[0]) for p in profile_plots if p[1] == window_idx+1],key=str.lower)
         profile_html_content = Template(profile_html_template).render(
             title=f"Profile Plots (Averaging Window: Day {start_time} to Day {end_time})",
-            images=sorted_images
+            images=sorted_images,
+            columns="1fr 1fr"
         )
         html_filename = os.path.join(output_dir, general_id, f"profile_plots_window{window_idx+1}.html")
         with open(html_filename, "w") as f:
@@ -909,7 +4773,8 @@ def run_diagnostics(
     sorted_timeseries_images = sorted([os.path.basename(t) for t in timeseries_plots],key=str.lower)
     timeseries_html_content = Template(timeseries_html_template).render(
         title="Time Series Plots (1D)",
-        images=sorted_timeseries_images
+        images=sorted_timeseries_images,
+        columns="1fr 1fr"
     )
     with open(os.path.join(output_dir, general_id, "timeseries_plots.html"), "w") as f:
         f.write(timeseries_html_content)
@@ -918,7 +4783,8 @@ def run_diagnostics(
     sorted_time_height_images = sorted([os.path.basename(p) for p in time_height_plots],key=str.lower)
     time_height_html_content = Template(time_height_html_template).render(
         title="Time-Height Plots (2D)",
-        images=sorted_time_height_images
+        images=sorted_time_height_images,
+        columns="1fr"
     )
     with open(os.path.join(output_dir, general_id, "time_height_plots.html"), "w") as f:
         f.write(time_height_html_content)
@@ -927,7 +4793,8 @@ def run_diagnostics(
     sorted_diurnal1d_images = sorted([os.path.basename(t) for t in diurnal1d_plots],key=str.lower)
     diurnal1d_html_content = Template(diurnal1d_html_template).render(
         title=f"Diurnal Cycle 1D Composite Plots: Day {diurnal_start_day_web} to {diurnal_end_day_web}",
-        images=sorted_diurnal1d_images
+        images=sorted_diurnal1d_images,
+        columns="1fr 1fr"
     )
     with open(os.path.join(output_dir, general_id, "diurnal1d_plots.html"), "w") as f:
         f.write(diurnal1d_html_content)
@@ -936,11 +4803,22 @@ def run_diagnostics(
     sorted_diurnal2d_images = sorted([os.path.basename(t) for t in diurnal2d_plots],key=str.lower)
     diurnal2d_html_content = Template(diurnal2d_html_template).render(
         title=f"Diurnal Cycle 2D Composite Plots: Day {diurnal_start_day_web} to {diurnal_end_day_web}",
-        images=sorted_diurnal2d_images
+        images=sorted_diurnal2d_images,
+        columns="1fr"
     )
     with open(os.path.join(output_dir, general_id, "diurnal2d_plots.html"), "w") as f:
         f.write(diurnal2d_html_content)
 
+    # Generate skill metrics HTML file
+    if metric_rows:
+        metrics_html_content = Template(metrics_html_template).render(
+            title=f"Skill Metrics (Reference: {reference_dataset})",
+            diagrams=[(diagram_title, os.path.basename(p)) for diagram_title, p in taylor_diagrams],
+            rows=sorted(metric_rows, key=lambda r: (r["variable"].lower(), r["window"] or 0, r["dataset"]))
+        )
+        with open(os.path.join(output_dir, general_id, "metrics.html"), "w") as f:
+            f.write(metrics_html_content)
+
     # Main HTML page with links to profile, timeseries, and time-height pages
     main_html_template = Template("""
     <!DOCTYPE html>
@@ -1015,6 +4893,13 @@ def run_diagnostics(
             <li><a href="diurnal2d_plots.html">Diurnal Cycle 2D: Day {{ "%.1f" | format(diurnal_start_day_web) }} to Day {{ "%.1f" | format(diurnal_end_day_web) }}</a></li>
         </ul>
         {% endif %}
+
+        {% if do_metrics %}
+        <div class="section-header">Skill Metrics</div>
+        <ul class="indented-links">
+            <li><a href="metrics.html">Skill Metrics and Taylor Diagrams (Reference: {{ reference_dataset }})</a></li>
+        </ul>
+        {% endif %}
     </body>
     </html>
     """).render(
@@ -1022,26 +4907,738 @@ def run_diagnostics(
         profile_windows=list(enumerate(zip(profile_time_s, profile_time_e))),
         diurnal_start_day_web=diurnal_start_day_web,
         diurnal_end_day_web=diurnal_end_day_web,
-        do_timeheight=bool(do_timeheight),
-        do_diurnal_composites=bool(do_diurnal_composites)
+        do_timeheight=bool(do_timeheight or histogram_tasks),
+        do_diurnal_composites=bool(do_diurnal_composites),
+        do_metrics=bool(metric_rows),
+        reference_dataset=reference_dataset
     )
 
 
     with open(os.path.join(output_dir, general_id, "index.html"), "w") as f:
         f.write(main_html_template)
 
-    # Tar all the plots and HTML files
-    tar_filename = os.path.join(output_dir, f"{general_id}_diagnostics.tar")
-    with tarfile.open(tar_filename, "w") as tar:
-        tar.add(os.path.join(output_dir, general_id, "index.html"), arcname="index.html")
-        for window_idx in range(len(profile_time_s)):
-            tar.add(os.path.join(output_dir, general_id, f"profile_plots_window{window_idx+1}.html"), arcname=f"profile_plots_window{window_idx+1}.html")
-        tar.add(os.path.join(output_dir, general_id, "timeseries_plots.html"), arcname="timeseries_plots.html")
-        tar.add(os.path.join(output_dir, general_id, "time_height_plots.html"), arcname="time_height_plots.html")
-        tar.add(os.path.join(output_dir, general_id, "diurnal1d_plots.html"), arcname="diurnal1d_plots.html")
-        tar.add(os.path.join(output_dir, general_id, "diurnal2d_plots.html"), arcname="diurnal2d_plots.html")
-        tar.add(output_subdir, arcname="plots")
-
-    print(f"Created archive {tar_filename} containing all plots and HTML files.")
+    stage = _next_stage(stage, "html", timings)
+
+    # Add the HTML files and any other files of the plots directory, then finish the archive
+    pages = ["index.html"] + [f"profile_plots_window{window_idx+1}.html" for window_idx in range(len(profile_time_s))]
+    pages += ["timeseries_plots.html", "time_height_plots.html", "diurnal1d_plots.html", "diurnal2d_plots.html"]
+    if metric_rows:
+        pages.append("metrics.html")
+    for name in pages:
+        add_to_archive(archive, os.path.join(output_dir, general_id, name), name)
+    archive_summary = close_report_archive(archive, [(output_subdir, "plots")])
+
+    _end_stage(stage, "tar", timings)
+
+    if archive_summary["status"] == "rebuilt":
+        print(f"Created archive {tar_filename} containing all plots and HTML files.")
+    else:
+        print(f"Archive {tar_filename} {archive_summary['status']}: {archive_summary['changed']} of "
+              f"{archive_summary['members']} files changed.")
+    if profile:
+        write_profile_report(disable_profiling(), os.path.join(output_dir, general_id))
+        print(f"Wrote profile report to {os.path.join(output_dir, general_id, 'profile.html')}")
     print("Successful completion of IOP Diagnostics Package")
 
+@functools.wraps(_run_diagnostics)
+def run_diagnostics(*args, **kwargs):
+    profiling = _profiler is not None
+    try:
+        return _run_diagnostics(*args, **kwargs)
+    finally:
+        # A failed run must not leave profiling (and tracemalloc) on for later runs
+        if not profiling and _profiler is not None:
+            disable_profiling()
+
+
+#################################
+###### Sessions
+
+# Plot settings of a DiagnosticsSession and their defaults, named as the
+#  arguments of run_diagnostics.  None for the profile windows is one window
+#  over the whole time range.
+SESSION_SETTINGS = {
+    "profile_time_s": None,
+    "profile_time_e": None,
+    "do_timeheight": True,
+    "height_cord": "z",
+    "max_height_profile": None,
+    "max_height_timeheight": None,
+    "linewidth": 2,
+    "time_series_time_s": None,
+    "time_series_time_e": None,
+    "time_height_time_s": None,
+    "time_height_time_e": None,
+    "do_diurnal_composites": False,
+    "diurnal_start_day": 0,
+    "diurnal_end_day": 9999,
+    "run_mean_npts": 0,
+    "usercmap": "viridis_r",
+    "ticksize": 14,
+    "labelsize": 14,
+    "vertical_grid": None,
+    "reference_dataset": None,
+    "time_bin_width": None,
+    "ensemble_band": (10, 90),
+    "time_height_renderer": "contourf",
+    "decimate": True,
+    "report_mode": "static",
+}
+
+class DiagnosticsSession:
+    """
+    The datasets of a case kept open for repeated plotting, e.g. from a
+    notebook.
+
+    The files are opened (and full-field output reduced) once; the time
+    offsets and variable index are computed once, and the coordinate, window
+    mean, diurnal and time bin caches stay filled between calls.  Every plot
+    method takes any of SESSION_SETTINGS as keyword arguments to override the
+    session settings for that plot only, so a plot can be redrawn with other
+    windows, height_cord or limits without reading the files again.
+
+    Example:
+        session = DiagnosticsSession(datasets, "/tmp/diags", "MAGIC", height_cord="p")
+        session.profile("T", window=(1.0, 2.0), max_height_profile=500)
+        session.time_height("CLOUD", time_height_time_s=0.5, time_height_time_e=1.5)
+        session.report(profile_time_s=[0, 1], profile_time_e=[1, 2])
+        session.close()
+    """
+
+    def __init__(self, datasets, output_dir, general_id, lazy_load=False, time_chunk=None, variables=None,
+                 horiz_avg_variance=False, cfad_variables=None, joint_histograms=None, conditional_masks=None,
+                 conditional_variables=None, **settings):
+        """
+        Open the datasets of a case.
+
+        Parameters:
+            datasets (list): Dataset dictionaries as for run_diagnostics.
+            output_dir (str): Directory of the output.
+            general_id (str): Case ID; plots go to output_dir/general_id/plots.
+            lazy_load, time_chunk, variables, horiz_avg_variance, cfad_variables,
+                joint_histograms, conditional_masks, conditional_variables:
+                As for run_diagnostics.
+            **settings: Plot settings, see SESSION_SETTINGS.
+        """
+        self.output_dir = output_dir
+        self.general_id = general_id
+        self.configs = [dict(c) for c in datasets]
+        self.short_ids = [c["short_id"] for c in datasets]
+        self.line_colors = [c.get("line_color") for c in datasets]
+        self.line_styles = [c.get("line_style") for c in datasets]
+        self.ensembles = [bool(c.get("ensemble", False)) for c in datasets]
+        self.lazy_load = lazy_load
+        self.time_chunk = time_chunk
+        self.run_options = {
+            "horiz_avg_variance": horiz_avg_variance,
+            "cfad_variables": cfad_variables,
+            "joint_histograms": joint_histograms,
+            "conditional_masks": conditional_masks,
+            "conditional_variables": conditional_variables,
+        }
+        self.settings = self._settings(dict(SESSION_SETTINGS), settings)
+        self.output_subdir = os.path.join(output_dir, general_id, "plots")
+        os.makedirs(self.output_subdir, exist_ok=True)
+
+        variables = requested_variables(variables, cfad_variables, joint_histograms, conditional_masks,
+                                        conditional_variables)
+        self.datasets, self.file_paths = open_case_datasets(
+            [c["filename"] for c in datasets], self.ensembles, os.path.join(output_dir, general_id, "horiz_avg"),
+            lazy_load, time_chunk, variables, **self.run_options)
+        self.time_offset = dataset_time_offsets(self.datasets)
+        self.var_index = select_variables(classify_variables(self.datasets), variables)
+
+        if self.settings["profile_time_s"] is None:
+            time_in_days = self.datasets[0]['time'].values
+            self.settings["profile_time_s"] = [float(time_in_days.min())]
+            self.settings["profile_time_e"] = [float(time_in_days.max())]
+
+    def _settings(self, settings, overrides):
+        # Session settings updated with overrides, checked like run_diagnostics does
+        for key, value in overrides.items():
+            if key not in SESSION_SETTINGS:
+                raise ValueError(f"Unknown setting: {key}. Must be one of {list(SESSION_SETTINGS)}.")
+            settings[key] = value
+        if settings["report_mode"] not in REPORT_MODES:
+            raise ValueError(f"Invalid report_mode: {settings['report_mode']}. Must be one of {REPORT_MODES}.")
+        if settings["time_height_renderer"] not in TIME_HEIGHT_RENDERERS:
+            raise ValueError(f"Invalid time_height_renderer: {settings['time_height_renderer']}. "
+                             f"Must be one of {TIME_HEIGHT_RENDERERS}.")
+        if settings["reference_dataset"] is not None and settings["reference_dataset"] not in self.short_ids:
+            raise ValueError(f"reference_dataset '{settings['reference_dataset']}' is not the short_id of a dataset.")
+        return settings
+
+    def options(self, **overrides):
+        """
+        Return the plot settings (see render_plot_task) with overrides applied.
+        The time window tables are rebuilt from the datasets already open.
+        """
+        settings = self._settings(dict(self.settings), overrides)
+        window_table = [
+            build_time_window_table(ds, self.time_offset[idx], settings["profile_time_s"],
+                                    settings["profile_time_e"], settings["time_series_time_s"],
+                                    settings["time_series_time_e"], settings["time_height_time_s"],
+                                    settings["time_height_time_e"])
+            for idx, ds in enumerate(self.datasets)
+        ]
+        vertical_grid = settings["vertical_grid"]
+        if vertical_grid is None:
+            vertical_grid = default_vertical_grid(settings["height_cord"], settings["max_height_profile"])
+        reference_dataset = settings["reference_dataset"]
+
+        opts = {
+            "short_ids": self.short_ids,
+            "line_colors": self.line_colors,
+            "line_styles": self.line_styles,
+            "time_offset": self.time_offset,
+            "output_subdir": self.output_subdir,
+            "var_index": self.var_index,
+            "window_table": window_table,
+            "lazy_load": self.lazy_load,
+            "time_chunk": self.time_chunk,
+            "drop_variables": [None] * len(self.datasets),
+            "profile": False,
+            "profile_memory": False,
+            "vertical_grid": [float(v) for v in vertical_grid],
+            "reference_index": self.short_ids.index(reference_dataset) if reference_dataset is not None else None,
+            "ensemble": self.ensembles,
+        }
+        for key in ["height_cord", "max_height_profile", "max_height_timeheight", "linewidth",
+                    "time_series_time_s", "time_series_time_e", "time_height_time_s", "time_height_time_e",
+                    "diurnal_start_day", "diurnal_end_day", "run_mean_npts", "usercmap", "ticksize",
+                    "labelsize", "ensemble_band", "time_height_renderer", "decimate", "report_mode",
+                    "time_bin_width"]:
+            opts[key] = settings[key]
+        opts["time_bin_edges"] = common_time_axis(self.datasets, opts, settings["time_bin_width"])
+        return opts
+
+    def _variable(self, var_name, shape=None):
+        entry = self.var_index.get(var_name)
+        if entry is None or (shape is not None and entry['shape'] != shape):
+            kind = f"{shape} variable" if shape is not None else "variable"
+            raise ValueError(f"'{var_name}' is not a {kind} of the session datasets.")
+        return entry
+
+    def _render(self, task, opts):
+        if opts["report_mode"] == "interactive":
+            os.system('cp interactive/interactive_plots.js ' + self.output_subdir)
+        return render_plot_task(task, self.datasets, opts)
+
+    def profile(self, var_name, window=0, difference=False, **overrides):
+        """
+        Plot the profile of a variable averaged over a window.
+
+        Parameters:
+            var_name (str): Profile variable.
+            window (int or tuple): Index of a profile window of the session
+                settings, or a (start day, end day) pair.
+            difference (bool): Plot the difference from reference_dataset.
+            **overrides: Settings for this plot, see SESSION_SETTINGS.
+
+        Returns:
+            str or None: Path of the plot.
+        """
+        self._variable(var_name, 'profile')
+        if not isinstance(window, int):
+            overrides["profile_time_s"], overrides["profile_time_e"] = [window[0]], [window[1]]
+            window = 0
+        profile_time_s = overrides.get("profile_time_s", self.settings["profile_time_s"])
+        profile_time_e = overrides.get("profile_time_e", self.settings["profile_time_e"])
+        if not 0 <= window < len(profile_time_s):
+            raise ValueError(f"Invalid profile window {window}: the settings have {len(profile_time_s)} windows.")
+        opts = self.options(**overrides)
+        if difference and opts["reference_index"] is None:
+            raise ValueError("A reference_dataset is needed for profile differences.")
+        task = ("profile_difference" if difference else "profile",
+                (var_name, window, profile_time_s[window], profile_time_e[window]))
+        return self._render(task, opts)
+
+    def timeseries(self, var_name, **overrides):
+        """
+        Plot the time series of a variable; see profile for overrides.
+        """
+        self._variable(var_name, 'timeseries')
+        return self._render(("timeseries", (var_name,)), self.options(**overrides))
+
+    def time_height(self, var_name, **overrides):
+        """
+        Plot the time-height panels of a profile variable; see profile for overrides.
+        """
+        self._variable(var_name, 'profile')
+        return self._render(("time_height", (var_name,)), self.options(**overrides))
+
+    def diurnal(self, var_name, **overrides):
+        """
+        Plot the diurnal composite of a variable, 1D for time series variables
+        and 2D for profile variables; see profile for overrides.
+        """
+        if self._variable(var_name)['shape'] == 'timeseries':
+            return self._render(("diurnal1d", (var_name,)), self.options(**overrides))[0]
+        self._variable(var_name, 'profile')
+        return self._render(("diurnal2d", (var_name,)), self.options(**overrides))
+
+    def report(self, output_dir=None, general_id=None, **kwargs):
+        """
+        Make the full report (web pages and archive) from the open datasets.
+
+        Parameters:
+            output_dir, general_id (str): Defaults to those of the session.
+            **kwargs: Settings (see SESSION_SETTINGS) and other run_diagnostics
+                arguments such as incremental or archive_compression.  With
+                n_workers > 1 the workers open their own copy of the files;
+                the session datasets stay open with their caches.
+        """
+        settings = dict(self.settings)
+        for key in list(kwargs):
+            if key in SESSION_SETTINGS:
+                settings[key] = kwargs.pop(key)
+        for key, value in self.run_options.items():
+            kwargs.setdefault(key, value)
+
+        positional = [settings.pop(key) for key in [
+            "profile_time_s", "profile_time_e", "do_timeheight", "height_cord", "max_height_profile",
+            "max_height_timeheight", "linewidth", "time_series_time_s", "time_series_time_e",
+            "time_height_time_s", "time_height_time_e"]]
+        run_diagnostics(output_dir or self.output_dir, general_id or self.general_id, self.configs, *positional,
+                        session=self, **settings, **kwargs)
+
+    def close(self):
+        """
+        Empty the caches of the datasets and close them.
+        """
+        for ds in self.datasets:
+            clear_dataset_caches(ds)
+            ds.close()
+        self.datasets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#################################
+###### Campaigns
+
+# Datasets held in memory for every case of a campaign, keyed by the absolute
+#  paths of their files; load_dataset returns a copy instead of opening them.
+_shared_datasets = {}
+
+def _dataset_files(fp):
+    # Absolute paths of the files of a dataset; none if they cannot be found
+    try:
+        return tuple(os.path.abspath(f) for f in expand_filenames(fp) if os.path.exists(f))
+    except ValueError:
+        return ()
+
+def _case_reduction_signature(case, fp):
+    # Settings the domain means of a full-field file depend on in a case
+    variables = requested_variables(case.get("variables"), case.get("cfad_variables"),
+                                    case.get("joint_histograms"), case.get("conditional_masks"),
+                                    case.get("conditional_variables"))
+    return _horizontal_average_signature(fp, variables, case.get("horiz_avg_variance", False),
+                                         case.get("cfad_variables"), case.get("joint_histograms"),
+                                         case.get("conditional_masks"), case.get("conditional_variables"))
+
+def share_datasets(cases, cache_dir, obs_dir=None):
+    """
+    Load the datasets used by several cases of a campaign, and those in
+    obs_dir, into memory once.  Full-field files are reduced to domain means
+    in cache_dir/horiz_avg first, if every case using them asks for the same
+    means.  The shared datasets are inherited by the case processes.
+
+    Parameters:
+        cases (list): Case dictionaries, see run_campaign.
+        cache_dir (str): Directory for the domain means of shared files.
+        obs_dir (str, optional): Directory of the OBS/LES library.
+
+    Returns:
+        list: The filenames (as given in the cases) of the shared datasets.
+    """
+    users = {}
+    for case in cases:
+        for config in case["datasets"]:
+            if config.get("ensemble") or config.get("filename") is None:
+                continue
+            files = _dataset_files(config["filename"])
+            if files:
+                users.setdefault(files, (config["filename"], []))[1].append(case)
+
+    obs_dir = os.path.abspath(obs_dir) + os.sep if obs_dir is not None else None
+    shared = []
+    for files, (fp, fp_cases) in users.items():
+        in_obs_dir = obs_dir is not None and all(f.startswith(obs_dir) for f in files)
+        if files in _shared_datasets or (len(fp_cases) < 2 and not in_obs_dir):
+            continue
+
+        ds = load_dataset(fp)
+        if is_full_field(ds):
+            signatures = {_case_reduction_signature(case, fp) for case in fp_cases}
+            if len(signatures) > 1:
+                ds.close()
+                continue
+            case = fp_cases[0]
+            name = hashlib.sha1(signatures.pop().encode()).hexdigest()[:16]
+            avg_file = write_horizontal_average(
+                fp, ds, os.path.join(cache_dir, "horiz_avg", f"{name}.nc"), case.get("time_chunk"),
+                case.get("horiz_avg_variance", False),
+                requested_variables(case.get("variables"), case.get("cfad_variables"), case.get("joint_histograms"),
+                                    case.get("conditional_masks"), case.get("conditional_variables")),
+                case.get("cfad_variables"), case.get("joint_histograms"), case.get("conditional_masks"),
+                case.get("conditional_variables"))
+            ds.close()
+            ds = load_dataset(avg_file)
+
+        ds.load()
+        ds.close()
+        _shared_datasets[files] = ds
+        shared.append(fp)
+    return shared
+
+def release_shared_datasets():
+    """
+    Drop the datasets shared by share_datasets.
+    """
+    for ds in _shared_datasets.values():
+        clear_dataset_caches(ds)
+    _shared_datasets.clear()
+
+def _case_cost(case):
+    # Size in bytes of the input files of a case, to start the largest cases first
+    return sum(os.path.getsize(f) for config in case["datasets"] for f in _dataset_files(config["filename"]))
+
+def _run_campaign_case(case, output_dir):
+    # Run one case; failures are reported in the result rather than raised
+    case = dict(case)
+    general_id = case.pop("general_id")
+    timings = case.setdefault("timings", {})
+    start = time.perf_counter()
+    try:
+        run_diagnostics(output_dir, general_id, **case)
+        status, error = "done", None
+    except Exception as exc:
+        status, error = "failed", f"{type(exc).__name__}: {exc}"
+        print(f"Case {general_id} failed: {error}")
+    return {
+        "general_id": general_id,
+        "status": status,
+        "error": error,
+        "elapsed": time.perf_counter() - start,
+        "timings": timings,
+        "archive": f"{general_id}_diagnostics.tar{ARCHIVE_SUFFIXES.get(case.get('archive_compression'), '')}",
+    }
+
+def write_campaign_index(results, output_dir, title, elapsed):
+    """
+    Write the top-level index.html linking the report of every case, and
+    campaign.json with the status and run time of each case.
+    """
+    with open(os.path.join(output_dir, "campaign.json"), "w") as f:
+        json.dump({"title": title, "elapsed": elapsed, "cases": results}, f, indent=1)
+
+    campaign_html_template = Template("""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <title>{{ title }}</title>
+        <style>
+            body {
+                font-family: Arial, sans-serif;
+                margin: 20px;
+            }
+            .logo-container {
+                display: flex;
+                gap: 20px;
+                align-items: center;
+            }
+            .logo-container img {
+                width: 150px;
+                height: auto;
+            }
+            table {
+                border-collapse: collapse;
+                margin-top: 20px;
+            }
+            th, td {
+                padding: 6px 14px;
+                border-bottom: 1px solid #ddd;
+                text-align: left;
+            }
+            .failed {
+                color: #c0392b;
+            }
+        </style>
+    </head>
+    <body>
+        <header>
+            <div class="logo-container">
+                <img src="logos/thread_logo.png" alt="Thread Logo">
+                <img src="logos/asr_logo_final.png" alt="Logo 1">
+                <img src="logos/arm_logo.png" alt="Logo 2">
+                <img src="logos/e3sm_logo.png" alt="Logo 3">
+            </div>
+            <h1>{{ title }}</h1>
+            <h2>{{ results | length }} cases in {{ "%.0f" | format(elapsed) }} s</h2>
+        </header>
+        <table>
+            <tr><th>Case</th><th>Status</th><th>Run time (s)</th><th>Archive</th></tr>
+            {% for case in results %}
+            <tr>
+                <td>{% if case.status == "done" %}<a href="{{ case.general_id }}/index.html">{{ case.general_id }}</a>{% else %}{{ case.general_id }}{% endif %}</td>
+                <td{% if case.status != "done" %} class="failed" title="{{ case.error }}"{% endif %}>{{ case.status }}</td>
+                <td>{{ "%.1f" | format(case.elapsed) }}</td>
+                <td>{% if case.status == "done" %}<a href="{{ case.archive }}">{{ case.archive }}</a>{% endif %}</td>
+            </tr>
+            {% endfor %}
+        </table>
+    </body>
+    </html>
+    """).render(title=title, results=results, elapsed=elapsed)
+
+    os.makedirs(os.path.join(output_dir, "logos"), exist_ok=True)
+    os.system('cp logos/*.png ' + os.path.join(output_dir, "logos"))
+    with open(os.path.join(output_dir, "index.html"), "w") as f:
+        f.write(campaign_html_template)
+
+def run_campaign(cases, output_dir, n_workers=None, obs_dir=None, title="IOP Diagnostics Campaign"):
+    """
+    Run the diagnostics of many cases (i.e. every IOP for one model version)
+    at once and link their reports from output_dir/index.html.
+
+    The datasets used by more than one case, and those in obs_dir, are opened
+    (and full-field output reduced) once by share_datasets and kept in memory
+    for all cases.  The cases then run in worker processes, largest input
+    first, so the campaign takes about as long as its slowest case when there
+    are enough cores.  Cores left over when there are fewer cases than workers
+    render the plots of the cases in parallel.
+
+    Parameters:
+        cases (list): One dictionary of run_diagnostics arguments per case,
+            with at least general_id, datasets and the other required
+            arguments (profile_time_s, ..., time_height_time_e).  Each case
+            is written to output_dir/general_id.
+        output_dir (str): Output directory of the campaign.
+        n_workers (int): Number of cases run at once, None for the number of cores.
+        obs_dir (str, optional): Directory of the OBS/LES library.
+        title (str): Title of the index page.
+
+    Returns:
+        list: Per case, a dictionary with general_id, status ("done" or
+            "failed"), error, elapsed (s), timings (see run_diagnostics) and archive.
+    """
+    general_ids = [case["general_id"] for case in cases]
+    if len(set(general_ids)) != len(general_ids):
+        raise ValueError("The general_id of every case of a campaign must be unique.")
+    n_workers = n_workers or os.cpu_count() or 1
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+
+    shared = share_datasets(cases, os.path.join(output_dir, "shared"), obs_dir)
+    print(f"Sharing {len(shared)} datasets across {len(cases)} cases")
+
+    # Largest cases first; spare cores go to the plots of each case
+    order = sorted(range(len(cases)), key=lambda i: _case_cost(cases[i]), reverse=True)
+    plot_workers = max(1, n_workers // max(1, len(cases)))
+    cases = [dict(case) for case in cases]
+    for case in cases:
+        case.setdefault("n_workers", plot_workers)
+
+    results = [None] * len(cases)
+    try:
+        if n_workers <= 1 or len(cases) <= 1:
+            for i in order:
+                results[i] = _run_campaign_case(cases[i], output_dir)
+        else:
+            ctx = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=min(n_workers, len(cases)), mp_context=ctx,
+                                     initializer=_use_synchronous_dask) as executor:
+                futures = {i: executor.submit(_run_campaign_case, cases[i], output_dir) for i in order}
+                for i, future in futures.items():
+                    results[i] = future.result()
+    finally:
+        release_shared_datasets()
+
+    elapsed = time.perf_counter() - start
+    write_campaign_index(results, output_dir, title, elapsed)
+    n_failed = sum(result["status"] != "done" for result in results)
+    print(f"Campaign of {len(cases)} cases finished in {elapsed:.1f} s ({n_failed} failed); "
+          f"see {os.path.join(output_dir, 'index.html')}")
+    return results
+
+#################################
+###### OBS/LES catalog
+
+# The OBS/LES library holds files named <CASE>.<obs|les>.<source>.<format>.nc,
+#  i.e. MAGIC.les.SAM.dpxx_format.nc.  The catalog records what each file holds,
+#  read from its header, so the files of a case can be found without opening
+#  the others.
+
+OBS_CATALOG_FORMATS = ["dpxx_format", "e3sm_format"]
+
+# Variables giving the vertical coordinate for each height_cord (see compute_y_coord)
+CATALOG_VERTICAL_VARIABLES = {
+    "z": ["z_mid", "z_mid_horiz_avg", "Z3"],
+    "p": ["p_mid_obs", "p_mid_les", "PS", "ps", "ps_horiz_avg"],
+}
+
+TIME_UNIT_DAYS = {"days": 1.0, "day": 1.0, "hours": 1.0 / 24, "hour": 1.0 / 24,
+                  "minutes": 1.0 / 1440, "minute": 1.0 / 1440, "seconds": 1.0 / 86400, "second": 1.0 / 86400}
+
+def decode_time_units(units):
+    """
+    Decode a CF time:units attribute such as 'days since 2013-07-21 00:00:00'.
+
+    Returns:
+        tuple or None: (days per unit, reference datetime), or None if the
+            units are not understood.
+    """
+    try:
+        unit, ref_str = units.split("since", 1)
+        tokens = ref_str.split()
+        reference = datetime.strptime(" ".join(tokens[:2]) if len(tokens) > 1 else tokens[0],
+                                      "%Y-%m-%d %H:%M:%S" if len(tokens) > 1 else "%Y-%m-%d")
+        return TIME_UNIT_DAYS[unit.strip().lower()], reference
+    except (ValueError, KeyError, IndexError, AttributeError):
+        return None
+
+def _read_file_header(path):
+    # Variables (name -> dims), time units and first/last time value of a netCDF
+    #  file.  With netCDF4 only the header and two time values are read.
+    if HAS_NETCDF4:
+        with netCDF4.Dataset(path) as nc:
+            variables = {name: list(var.dimensions) for name, var in nc.variables.items()}
+            time_var = nc.variables.get('time')
+            units = getattr(time_var, 'units', None) if time_var is not None else None
+            times = (float(time_var[0]), float(time_var[-1])) if time_var is not None and time_var.size else None
+    else:
+        with xr.open_dataset(path, decode_times=False) as ds:
+            variables = {name: list(ds[name].dims) for name in ds.variables}
+            units = ds['time'].attrs.get('units') if 'time' in ds.variables else None
+            times = (float(ds['time'][0]), float(ds['time'][-1])) if 'time' in ds.variables and ds.sizes['time'] else None
+    return variables, units, times
+
+def catalog_entry(path):
+    """
+    Describe one OBS/LES file from its name and header.
+
+    Returns:
+        dict: case, type ('obs' or 'les'), source, format, variables (those
+            with a time dimension), time_units, time_start and time_end (ISO
+            dates, None if time:units is not understood), vertical (height_cord
+            -> variable of the vertical coordinate; empty for files without
+            levels), size, mtime and sha1.
+    """
+    parts = os.path.basename(path)[:-len(".nc")].split(".")
+    variables, units, times = _read_file_header(path)
+
+    decoded = decode_time_units(units) if units else None
+    time_start = time_end = None
+    if decoded is not None and times is not None:
+        factor, reference = decoded
+        time_start = (reference + timedelta(days=times[0] * factor)).isoformat()
+        time_end = (reference + timedelta(days=times[1] * factor)).isoformat()
+
+    vertical = {}
+    if any('lev' in dims or 'ilev' in dims for dims in variables.values()):
+        for height_cord, candidates in CATALOG_VERTICAL_VARIABLES.items():
+            found = [v for v in candidates if v in variables]
+            if found:
+                vertical[height_cord] = found[0]
+
+    return {
+        "case": parts[0],
+        "type": parts[1].lower() if len(parts) > 2 else None,
+        "source": ".".join(parts[2:-1]),
+        "format": parts[-1],
+        "variables": sorted(v for v, dims in variables.items() if 'time' in dims and v != 'time'),
+        "time_units": units,
+        "time_start": time_start,
+        "time_end": time_end,
+        "vertical": vertical,
+        "size": os.path.getsize(path),
+        "mtime": os.path.getmtime(path),
+        "sha1": _file_sha1(path),
+    }
+
+def build_obs_catalog(obs_dir, catalog_file):
+    """
+    Scan obs_dir (and its subdirectories) for *.dpxx_format.nc and
+    *.e3sm_format.nc files and write their catalog entries to catalog_file
+    (JSON).  Entries of files whose size and modification time are unchanged
+    are kept from the previous catalog, so only new or changed files are read.
+
+    Returns:
+        dict: The catalog: obs_dir and files (path relative to obs_dir -> entry,
+            see catalog_entry).
+    """
+    previous = load_obs_catalog(catalog_file) if os.path.exists(catalog_file) else {"files": {}}
+    if previous.get("obs_dir") != os.path.abspath(obs_dir):
+        previous = {"files": {}}
+
+    files = {}
+    n_read = 0
+    for fmt in OBS_CATALOG_FORMATS:
+        for path in sorted(glob.glob(os.path.join(obs_dir, "**", f"*.{fmt}.nc"), recursive=True)):
+            rel_path = os.path.relpath(path, obs_dir)
+            entry = previous["files"].get(rel_path)
+            if entry is None or entry["size"] != os.path.getsize(path) or entry["mtime"] != os.path.getmtime(path):
+                try:
+                    entry = catalog_entry(path)
+                except (OSError, ValueError) as exc:
+                    print(f"Warning: could not read {path}: {exc}")
+                    continue
+                n_read += 1
+            files[rel_path] = entry
+
+    catalog = {"obs_dir": os.path.abspath(obs_dir), "files": dict(sorted(files.items()))}
+    os.makedirs(os.path.dirname(os.path.abspath(catalog_file)), exist_ok=True)
+    with open(catalog_file, "w") as f:
+        json.dump(catalog, f, indent=1)
+    print(f"OBS/LES catalog {catalog_file}: {len(files)} files ({n_read} read)")
+    return catalog
+
+def load_obs_catalog(catalog_file):
+    """
+    Read a catalog written by build_obs_catalog.
+    """
+    with open(catalog_file) as f:
+        return json.load(f)
+
+def catalog_reference_datasets(catalog, case, file_format="dpxx_format", height_cord=None, variables=None,
+                               types=("obs", "les")):
+    """
+    Return the dataset dictionaries (as in the driver) of the OBS/LES files
+    of a case, selected from the catalog without opening any file.
+
+    Parameters:
+        catalog (dict): Catalog from build_obs_catalog or load_obs_catalog.
+        case (str): Case name, i.e. "MAGIC" (case insensitive).
+        file_format (str): "dpxx_format" or "e3sm_format", following the model output.
+        height_cord (str, optional): Leave out files with levels but no vertical
+            coordinate for this height_cord.
+        variables (list, optional): Leave out files holding none of these variables.
+        types (tuple): Types of files to attach.
+
+    Returns:
+        list: Dataset dictionaries, LES first, with short_ids such as "SAM-LES"
+            and "OBS-sounding".
+    """
+    datasets = []
+    for rel_path, entry in catalog["files"].items():
+        if entry["case"].lower() != case.lower() or entry["format"] != file_format or entry["type"] not in types:
+            continue
+        if height_cord is not None and entry["vertical"] and height_cord not in entry["vertical"]:
+            print(f"Note: {rel_path} has no '{height_cord}' vertical coordinate and is not attached.")
+            continue
+        if variables is not None and not set(variables) & set(entry["variables"]):
+            continue
+        is_les = entry["type"] == "les"
+        source = entry["source"] or entry["type"].upper()
+        datasets.append({
+            "filename": os.path.join(catalog["obs_dir"], rel_path),
+            "short_id": f"{source}-LES" if is_les else f"OBS-{source}",
+            "line_color": "black" if is_les else "gray",
+            "line_style": "-" if is_les else "--",
+        })
+    return sorted(datasets, key=lambda config: not config["short_id"].endswith("-LES"))
@@ -0,0 +1,99 @@
+from diagnostics import run_campaign, build_obs_catalog, catalog_reference_datasets
+import os
+
+##########################################################
+# ARM/ASR diagnostics package for E3SM Single Column Model (SCM)
+#  or doubly-periodic EAMxx (DP-EAMxx).
+
+# Campaign driver: run the diagnostics of many IOP cases (i.e. the whole case
+#  library for one model version) in one go.  The cases run at the same time on
+#  the available cores, the OBS/LES datasets are opened once and shared by all
+#  cases, and an index page linking the report of every case is written to
+#  output_dir/index.html.
+
+# Please make a copy of this driver file and modify it for your cases.  Each
+#  case takes the same settings as diagnostics_user_driver.py, which documents
+#  them in detail.
+
+##########################################################
+##########################################################
+# BEGIN: USER DEFINED SETTINGS
+
+# Where do you want output diagnostics to be placed?  Each case is written to
+#  output_dir/general_id.
+output_dir = "/global/cfs/cdirs/e3sm/www/bogensch/IOP_Library_Diags"
+
+# Title of the index page
+title = "DP-EAMxx IOP Library"
+
+# Number of cases run at once, None for the number of cores.  When there are more
+#  cores than cases the remaining cores render the plots of each case.
+n_workers = None
+
+# Model output and the OBS/LES library.  Every dataset in obs_dir is read once and
+#  shared by all cases that use it.
+simulation_dir = "/pscratch/sd/b/bogensch/dp_screamxx"
+caseappend = ".horiz_avg.AVERAGE.nmins_x15.nc"
+model_version = "prefix.001a"
+obs_dir = "/global/cfs/cdirs/e3sm/diagnostics/observations/Atm/scm_dpxx_datasets/DP_EAMxx"
+
+# Settings shared by every case (see diagnostics_user_driver.py)
+common_settings = {
+    "do_timeheight": True,
+    "height_cord": "z",
+    "max_height_profile": 3000,
+    "max_height_timeheight": 3000,
+    "linewidth": 4,
+    "time_series_time_s": None,
+    "time_series_time_e": None,
+    "time_height_time_s": None,
+    "time_height_time_e": None,
+    "do_diurnal_composites": True,
+    "usercmap": "viridis_r",
+    "ticksize": 14,
+    "labelsize": 14,
+    "incremental": True,
+}
+
+# Catalog of obs_dir, used to attach the OBS/LES files of the cases that do not list them
+obs_catalog = build_obs_catalog(obs_dir, os.path.join(output_dir, "obs_catalog.json"))
+
+def case(name, obs_files, profile_time_s, profile_time_e, **settings):
+    # One case: the model simulation of the IOP name plus its OBS/LES files, or every
+    #  OBS/LES file of the case in the catalog if obs_files is None
+    casename = f"scream_dpxx_{name}.{model_version}"
+    datasets = [{
+        "filename": os.path.join(simulation_dir, casename, "run", f"{casename}{caseappend}"),
+        "short_id": "EAMxx",
+        "line_color": "blue",
+        "line_style": "-"
+    }]
+    if obs_files is None:
+        datasets += catalog_reference_datasets(obs_catalog, name, "dpxx_format",
+                                               settings.get("height_cord", common_settings["height_cord"]))
+    for short_id, filename, line_color in obs_files or []:
+        datasets.append({
+            "filename": os.path.join(obs_dir, filename),
+            "short_id": short_id,
+            "line_color": line_color,
+            "line_style": "--"
+        })
+    return dict(common_settings, general_id=f"{name}_{model_version}", datasets=datasets,
+                profile_time_s=profile_time_s, profile_time_e=profile_time_e, **settings)
+
+cases = [
+    case("MAGIC", [("SAM-LES", "MAGIC.les.SAM.dpxx_format.nc", "black"),
+                   ("OBS", "MAGIC.obs.1dvars.dpxx_format.nc", "gray")],
+         [0.0, 1.0, 2.0], [1.0, 2.0, 3.0]),
+    case("RICO", None, [0.0, 0.5], [0.5, 1.0]),
+    case("BOMEX", [("LES", "BOMEX.les.dpxx_format.nc", "black")],
+         [0.0], [0.25], do_diurnal_composites=False),
+    case("GOAMAZON", [("OBS", "GOAMAZON.obs.1dvars.dpxx_format.nc", "gray")],
+         [0.0, 5.0], [5.0, 10.0], height_cord="p", max_height_profile=200, max_height_timeheight=200),
+]
+
+# END: USER DEFINED SETTINGS
+##########################################################
+##########################################################
+
+run_campaign(cases, output_dir, n_workers=n_workers, obs_dir=obs_dir, title=title)
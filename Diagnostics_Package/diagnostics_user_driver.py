@@ -1,4 +1,4 @@
-from diagnostics import run_diagnostics
+from diagnostics import run_diagnostics, build_obs_catalog, catalog_reference_datasets
 import os
 
 ##########################################################
@@ -30,9 +30,14 @@ datasets=[]
 
 # Define each dataset and its associated metadata.
 # - REQUIRED Input:
-#   1) filename = the path and filename of the output dataset to be considered.
+#   1) filename = the path and filename of the output dataset to be considered.  For runs
+#       with many history files this can be a glob pattern (i.e. "run/case.*.nc") or a
+#       list of files, which are concatenated in time.
 #   2) short_id = ID used in the diagnostics package for legends etc.
 #   3) line_color and line_style: used for profile and 1D time series plots.
+# - OPTIONAL Input:
+#   4) ensemble = True: the files given by filename (a glob pattern or list) are the members of
+#       an ensemble, plotted as the ensemble mean with a shaded band of the spread (see ensemble_band).
 
 # below stuff useful to define if recycled by many datasets, but not required as it is just used
 #  to define the filename metadata for E3SM/DP-SCREAM output (i.e. you can explicity just declare path
@@ -96,6 +101,24 @@ datasets.append({
 "line_style": "--"
 })
 
+# Perturbed initial condition ensemble, one file per member (uncomment to use)
+#datasets.append({
+#"filename": os.path.join(simulation_dir, "scream_dpxx_MAGIC.ens*", "run", f"*{caseappend}"),
+#"short_id": "EAMxx Ensemble",
+#"line_color": "purple",
+#"line_style": "-",
+#"ensemble": True
+#})
+
+# Optional: instead of (or in addition to) listing OBS/LES files above, attach every OBS/LES
+#  file of a case in obs_dir.  A catalog of obs_dir (case, variables, time span and vertical
+#  coordinate of each file) is built from the file headers and kept in obs_catalog_file; later
+#  runs only read new or changed files.  Files in obs_catalog_format, with the vertical
+#  coordinate height_cord and holding any of the selected variables are attached.
+obs_catalog_case = None  # i.e. "MAGIC"; None attaches nothing
+obs_catalog_format = "dpxx_format"  # "dpxx_format" for DP-EAMxx, "e3sm_format" for E3SM SCM
+obs_catalog_file = os.path.join(output_dir, "obs_catalog.json")
+
 # End add datasets.
 
 ######## End manage input datasets
@@ -151,14 +174,113 @@ diurnal_end_day = 3.0    # Ending day for diurnal composite stats, None for defa
 # Define the colormap for time height contourf plots.  Default is "viridis_r".
 time_height_cmap = "viridis_r"
 
+# How the time-height and diurnal 2D panels are drawn: "contourf" (filled contours), "pcolormesh"
+#  (one cell per output value) or "image" (a raster image, much faster for long or high-rate
+#  datasets).  All use the same color levels and colorbar.
+time_height_renderer = "contourf"
+
+# Reduce long time series and time-height data to the resolution of the saved plots before
+#  drawing them (the minimum and maximum of each pixel column of a time series, block averages
+#  of times for time-height plots).  Set to False to plot every sample.
+decimate = True
+
+# "static" writes every plot as a JPEG.  "interactive" instead writes the data of the profile,
+#  time series, time-height and diurnal plots to small files that the report pages draw in the
+#  browser, with zoom and check boxes to show or hide each dataset.  Much faster to make and a
+#  much smaller tar file; the pages need JavaScript to view.
+report_mode = "static"
+
+# Compression of the {general_id}_diagnostics.tar archive of the report: None, "gz", "xz" or "zst"
+#  (needs the zstandard package).  Plots are added to the archive as soon as they are made.
+archive_compression = None
+
 # Optional arguments to define tick size and label size for plots.  Default is 14.
 ticksize=14
 labelsize=14
 
+# Optional: short_id of a reference dataset (i.e. "LES").  Profiles of the other datasets are
+#  then also plotted as differences from it, after interpolation to a common vertical grid, and
+#  skill metrics (bias, RMSE, correlation, std ratio) and Taylor diagrams are made against it.
+#  vertical_grid gives that grid (m for height_cord "z", hPa for "p"), i.e. np.arange(0, 5001, 50);
+#  None uses 100 levels up to max_height_profile.
+reference_dataset = None
+vertical_grid = None
+
+# Optional: width in days of the bins of a common time axis, i.e. 1./24. for hourly bins.  Each
+#  dataset is averaged into these bins, so that high-rate OBS (KAZR, lidar), soundings and model
+#  output can be compared on the same times; the time series plots then show the bin means.
+#  None plots the raw time series (metrics then use bins of the coarsest output interval).
+time_bin_width = None
+
+# Spread of ensemble datasets drawn as a band around the ensemble mean: a pair of percentiles
+#  across members, "minmax" or "std" (mean plus/minus one standard deviation).
+ensemble_band = (10, 90)
+
+# Number of worker processes used to render the plots.  Set to 1 to make the plots
+#  one after another in a single process.  On a compute node this can be set up to
+#  the number of available cores.
+n_workers = 1
+
+# Lazy loading for large files (i.e. full-field DP-EAMxx or multi-month SCM output).
+#  Files are read in chunks of time_chunk time steps (requires dask; None lets dask
+#  choose) and only the variables that will be plotted are read.
+lazy_load = False
+time_chunk = None
+
+# Full-field output (with every column in an 'ncol' dimension) is reduced to domain means
+#  in one pass before plotting.  Set to True to also plot the variance across the columns.
+horiz_avg_variance = False
+
+# CFADs / histograms across the columns of full-field output, built in the same pass.  Give a
+#  list of variables, or a dict of variable -> bin edges (None for automatic edges spanning the
+#  whole run, which reads those variables once more), i.e.
+#  cfad_variables = {"omega": None, "qc": np.linspace(0, 1e-3, 41)}.  Values outside given edges
+#  are not counted (the fraction left out is reported).  joint_histograms is a
+#  list of variable pairs, i.e. [("omega", "qc")].  Shown on the time-height page.
+cfad_variables = None
+joint_histograms = None
+
+# Conditional sampling of full-field output, also in the same pass.  Give a dict of mask name ->
+#  expression of variables, i.e. {"core": "qc > 1e-5 and omega < 0"}.  Each mask adds
+#  <mask>_fraction, <mask>_mass_flux (if omega is output) and <variable>_<mask> for the
+#  variables in conditional_variables (None: the variables used in the mask).
+conditional_masks = None
+conditional_variables = None
+
+# Optional: list of variables to plot, i.e. ["T_mid_horiz_avg", "precip_total_surf_mass_flux_horiz_avg"].
+#  None plots every valid variable.
+variables = None
+
+# Incremental rendering: only re-render the plots whose data or settings changed since
+#  the last run into the same output directory (i.e. after adding one dataset).
+incremental = False
+
+# Data cube: write the reduced data used by the plots (profiles, time series, time-height
+#  and diurnal composites) to a data_cube folder in the output directory.  A later run with
+#  render_only = True rebuilds all plots and web pages from the data cube without opening the
+#  input files, which is useful to change colors, colormaps, tick sizes or maximum heights.
+#  The averaging windows, time ranges and height_cord must be the same as when it was written.
+data_cube = False
+render_only = False
+
+# Profiling: write the wall time of each stage, plot and variable to profile.json and
+#  profile.html in the output directory.  profile_memory = True adds the peak memory of
+#  each stage, but makes the package several times slower.
+profile = False
+profile_memory = False
+
 # END: OPTIONAL user defined settings
 ##########################################################
 ##########################################################
 
+# Attach the OBS/LES datasets of the case from the catalog, skipping those listed above
+if obs_catalog_case is not None:
+    obs_catalog = build_obs_catalog(obs_dir, obs_catalog_file)
+    listed = [os.path.abspath(d["filename"]) for d in datasets if isinstance(d["filename"], str)]
+    datasets += [d for d in catalog_reference_datasets(obs_catalog, obs_catalog_case, obs_catalog_format,
+                                                       height_cord, variables)
+                 if d["filename"] not in listed]
+
 # Call the diagnostics function with user-defined settings
 run_diagnostics(
     output_dir,
@@ -180,6 +302,28 @@ run_diagnostics(
     diurnal_end_day=diurnal_end_day,
     usercmap=time_height_cmap,
     ticksize=ticksize,
-    labelsize=labelsize
+    labelsize=labelsize,
+    n_workers=n_workers,
+    lazy_load=lazy_load,
+    time_chunk=time_chunk,
+    variables=variables,
+    incremental=incremental,
+    data_cube=data_cube,
+    render_only=render_only,
+    profile=profile,
+    profile_memory=profile_memory,
+    horiz_avg_variance=horiz_avg_variance,
+    cfad_variables=cfad_variables,
+    joint_histograms=joint_histograms,
+    conditional_masks=conditional_masks,
+    conditional_variables=conditional_variables,
+    vertical_grid=vertical_grid,
+    reference_dataset=reference_dataset,
+    time_bin_width=time_bin_width,
+    ensemble_band=ensemble_band,
+    time_height_renderer=time_height_renderer,
+    decimate=decimate,
+    report_mode=report_mode,
+    archive_compression=archive_compression
 )
 
@@ -0,0 +1,365 @@
+// Viewer of the interactive reports of the ARM/ASR diagnostics package.
+//
+// Every plot of an interactive report is a data file (plots/<plot>.js) that
+//  calls diagnosticsPayload() with the reduced data of the plot: lines
+//  (profiles, time series, diurnal composites) or fields (time-height and 2D
+//  diurnal composites).  Arrays are stored as base64 encoded little-endian
+//  float32.  The pages load this file and the data files, then draw each plot
+//  into its <div class="diagnostics-plot" data-payload="<plot>"> on a canvas.
+//
+// Drag a rectangle to zoom, double click to reset; the check boxes show or
+//  hide the datasets.
+
+var diagnosticsPayloads = {};
+
+function diagnosticsPayload(payload) {
+    diagnosticsPayloads[payload.name] = payload;
+}
+
+(function () {
+    "use strict";
+
+    var MARGIN = {left: 70, right: 20, top: 35, bottom: 50};
+    var FONT = "13px sans-serif";
+
+    function decode(values) {
+        if (values === null || values === undefined) return null;
+        if (values.f32 === undefined) return values;
+        var raw = atob(values.f32);
+        var bytes = new Uint8Array(raw.length);
+        for (var i = 0; i < raw.length; i++) bytes[i] = raw.charCodeAt(i);
+        return new Float32Array(bytes.buffer);
+    }
+
+    function finiteRange(arrays) {
+        var lo = Infinity, hi = -Infinity;
+        arrays.forEach(function (a) {
+            if (!a) return;
+            for (var i = 0; i < a.length; i++) {
+                if (isFinite(a[i])) { if (a[i] < lo) lo = a[i]; if (a[i] > hi) hi = a[i]; }
+            }
+        });
+        if (!isFinite(lo)) return [0, 1];
+        if (lo === hi) { var pad = lo !== 0 ? 0.01 * Math.abs(lo) : 0.01; return [lo - pad, hi + pad]; }
+        return [lo, hi];
+    }
+
+    function niceTicks(lo, hi, n) {
+        var span = hi - lo, step = Math.pow(10, Math.floor(Math.log10(span / n)));
+        [1, 2, 2.5, 5, 10].some(function (m) { if (span / (step * m) <= n) { step *= m; return true; } return false; });
+        var ticks = [];
+        for (var t = Math.ceil(lo / step) * step; t <= hi + 1e-9 * span; t += step) ticks.push(t);
+        return ticks;
+    }
+
+    function formatTick(t) {
+        var a = Math.abs(t);
+        return (a !== 0 && (a >= 1e5 || a < 1e-3)) ? t.toExponential(1) : String(+t.toPrecision(6));
+    }
+
+    function dashPattern(style) {
+        return {"--": [8, 5], ":": [2, 4], "-.": [8, 4, 2, 4]}[style] || [];
+    }
+
+    // Axes of one panel: data to pixel transforms and drawing of the frame
+    function Axes(ctx, box, view, invertY) {
+        this.ctx = ctx; this.box = box; this.view = view; this.invertY = invertY;
+    }
+    Axes.prototype.px = function (x) {
+        return this.box.x + (x - this.view.x[0]) / (this.view.x[1] - this.view.x[0]) * this.box.w;
+    };
+    Axes.prototype.py = function (y) {
+        var f = (y - this.view.y[0]) / (this.view.y[1] - this.view.y[0]);
+        return this.invertY ? this.box.y + f * this.box.h : this.box.y + (1 - f) * this.box.h;
+    };
+    Axes.prototype.dataX = function (px) {
+        return this.view.x[0] + (px - this.box.x) / this.box.w * (this.view.x[1] - this.view.x[0]);
+    };
+    Axes.prototype.dataY = function (py) {
+        var f = (py - this.box.y) / this.box.h;
+        return this.view.y[0] + (this.invertY ? f : 1 - f) * (this.view.y[1] - this.view.y[0]);
+    };
+    Axes.prototype.clip = function () {
+        this.ctx.save();
+        this.ctx.beginPath();
+        this.ctx.rect(this.box.x, this.box.y, this.box.w, this.box.h);
+        this.ctx.clip();
+    };
+    Axes.prototype.frame = function (title, xlabel, ylabel) {
+        var ctx = this.ctx, box = this.box, self = this;
+        ctx.strokeStyle = "#000"; ctx.lineWidth = 1; ctx.setLineDash([]);
+        ctx.strokeRect(box.x, box.y, box.w, box.h);
+        ctx.font = FONT; ctx.fillStyle = "#000";
+        ctx.textAlign = "center"; ctx.textBaseline = "top";
+        niceTicks(this.view.x[0], this.view.x[1], 6).forEach(function (t) {
+            var x = self.px(t);
+            ctx.fillText(formatTick(t), x, box.y + box.h + 5);
+            ctx.strokeStyle = "rgba(149,165,166,0.5)"; ctx.setLineDash([4, 4]);
+            ctx.beginPath(); ctx.moveTo(x, box.y); ctx.lineTo(x, box.y + box.h); ctx.stroke();
+        });
+        ctx.textAlign = "right"; ctx.textBaseline = "middle";
+        niceTicks(this.view.y[0], this.view.y[1], 6).forEach(function (t) {
+            var y = self.py(t);
+            ctx.fillText(formatTick(t), box.x - 5, y);
+            ctx.strokeStyle = "rgba(149,165,166,0.5)"; ctx.setLineDash([4, 4]);
+            ctx.beginPath(); ctx.moveTo(box.x, y); ctx.lineTo(box.x + box.w, y); ctx.stroke();
+        });
+        ctx.setLineDash([]);
+        ctx.textAlign = "center"; ctx.textBaseline = "bottom";
+        ctx.font = "bold 14px sans-serif";
+        ctx.fillText(title, box.x + box.w / 2, box.y - 8);
+        ctx.font = FONT; ctx.textBaseline = "top";
+        ctx.fillText(xlabel, box.x + box.w / 2, box.y + box.h + 25);
+        ctx.save();
+        ctx.translate(box.x - 55, box.y + box.h / 2); ctx.rotate(-Math.PI / 2);
+        ctx.textBaseline = "bottom"; ctx.fillText(ylabel, 0, 0);
+        ctx.restore();
+    };
+
+    // Drag to zoom and double click to reset on a canvas; onZoom(axes, x0, x1, y0, y1)
+    function addZoom(canvas, axesAt, onZoom, onReset) {
+        var start = null, overlay = null;
+        canvas.addEventListener("mousedown", function (e) {
+            var axes = axesAt(e.offsetX, e.offsetY);
+            if (!axes) return;
+            start = {x: e.offsetX, y: e.offsetY, axes: axes};
+            overlay = canvas.getContext("2d").getImageData(0, 0, canvas.width, canvas.height);
+        });
+        canvas.addEventListener("mousemove", function (e) {
+            if (!start) return;
+            var ctx = canvas.getContext("2d");
+            ctx.putImageData(overlay, 0, 0);
+            ctx.strokeStyle = "#333"; ctx.setLineDash([3, 3]); ctx.lineWidth = 1;
+            ctx.strokeRect(start.x, start.y, e.offsetX - start.x, e.offsetY - start.y);
+            ctx.setLineDash([]);
+        });
+        canvas.addEventListener("mouseup", function (e) {
+            if (!start) return;
+            var s = start, axes = s.axes;
+            start = null;
+            if (Math.abs(e.offsetX - s.x) < 5 || Math.abs(e.offsetY - s.y) < 5) {
+                canvas.getContext("2d").putImageData(overlay, 0, 0);
+                return;
+            }
+            var x0 = axes.dataX(Math.min(s.x, e.offsetX)), x1 = axes.dataX(Math.max(s.x, e.offsetX));
+            var ya = axes.dataY(s.y), yb = axes.dataY(e.offsetY);
+            onZoom(x0, x1, Math.min(ya, yb), Math.max(ya, yb));
+        });
+        canvas.addEventListener("dblclick", onReset);
+    }
+
+    function addToggles(container, items, onChange) {
+        var legend = document.createElement("div");
+        legend.className = "diagnostics-legend";
+        items.forEach(function (item, i) {
+            var label = document.createElement("label");
+            label.style.marginRight = "12px";
+            var box = document.createElement("input");
+            box.type = "checkbox"; box.checked = true;
+            box.addEventListener("change", function () { onChange(i, box.checked); });
+            var swatch = document.createElement("span");
+            swatch.textContent = item.color ? " ▬ " : " ";
+            swatch.style.color = item.color || "#000";
+            label.appendChild(box); label.appendChild(swatch);
+            label.appendChild(document.createTextNode(item.label));
+            legend.appendChild(label);
+        });
+        container.appendChild(legend);
+    }
+
+    // Profiles, time series and diurnal composites
+    function drawLinePlot(container, p) {
+        var lines = p.lines.map(function (l) {
+            return {label: l.label, color: l.color, style: l.style, visible: true,
+                    x: decode(l.x), y: decode(l.y), band: l.band ? l.band.map(decode) : null};
+        });
+        var bandX = p.band_axis === "x";
+        function fullView() {
+            var shown = lines.filter(function (l) { return l.visible; });
+            var xs = [], ys = [];
+            shown.forEach(function (l) {
+                xs.push(l.x); ys.push(l.y);
+                if (l.band) (bandX ? xs : ys).push(l.band[0], l.band[1]);
+            });
+            return {x: p.xlim || finiteRange(xs), y: p.ylim || finiteRange(ys)};
+        }
+        var canvas = document.createElement("canvas");
+        canvas.width = p.width || 800; canvas.height = p.height || 500;
+        container.appendChild(canvas);
+        var view = fullView();
+        var box = {x: MARGIN.left, y: MARGIN.top,
+                   w: canvas.width - MARGIN.left - MARGIN.right, h: canvas.height - MARGIN.top - MARGIN.bottom};
+
+        function draw() {
+            var ctx = canvas.getContext("2d");
+            ctx.clearRect(0, 0, canvas.width, canvas.height);
+            var axes = new Axes(ctx, box, view, p.invert_y);
+            axes.frame(p.title, p.xlabel, p.ylabel);
+            axes.clip();
+            if (p.zero_x) {
+                ctx.strokeStyle = "#000"; ctx.lineWidth = 1;
+                ctx.beginPath(); ctx.moveTo(axes.px(0), box.y); ctx.lineTo(axes.px(0), box.y + box.h); ctx.stroke();
+            }
+            lines.forEach(function (l) {
+                if (!l.visible) return;
+                if (l.band) {
+                    ctx.fillStyle = l.color; ctx.globalAlpha = 0.25;
+                    ctx.beginPath();
+                    var n = l.x.length, i;
+                    for (i = 0; i < n; i++) {
+                        ctx.lineTo(bandX ? axes.px(l.band[0][i]) : axes.px(l.x[i]),
+                                   bandX ? axes.py(l.y[i]) : axes.py(l.band[0][i]));
+                    }
+                    for (i = n - 1; i >= 0; i--) {
+                        ctx.lineTo(bandX ? axes.px(l.band[1][i]) : axes.px(l.x[i]),
+                                   bandX ? axes.py(l.y[i]) : axes.py(l.band[1][i]));
+                    }
+                    ctx.closePath(); ctx.fill(); ctx.globalAlpha = 1;
+                }
+                ctx.strokeStyle = l.color; ctx.lineWidth = 2; ctx.setLineDash(dashPattern(l.style));
+                ctx.beginPath();
+                var pen = false;
+                for (var j = 0; j < l.x.length; j++) {
+                    if (!isFinite(l.x[j]) || !isFinite(l.y[j])) { pen = false; continue; }
+                    if (pen) ctx.lineTo(axes.px(l.x[j]), axes.py(l.y[j]));
+                    else ctx.moveTo(axes.px(l.x[j]), axes.py(l.y[j]));
+                    pen = true;
+                }
+                ctx.stroke(); ctx.setLineDash([]);
+            });
+            ctx.restore();
+            return axes;
+        }
+        var axes = draw();
+        addZoom(canvas, function () { return axes; },
+                function (x0, x1, y0, y1) { view = {x: [x0, x1], y: [y0, y1]}; axes = draw(); },
+                function () { view = fullView(); axes = draw(); });
+        addToggles(container, lines, function (i, shown) { lines[i].visible = shown; axes = draw(); });
+    }
+
+    function nearestIndices(coord, lo, hi, n) {
+        // Index of the sample of coord nearest to each of n pixel centers between lo and hi
+        var order = Array.from(coord)
+            .map(function (v, i) { return [v, i]; })
+            .sort(function (a, b) { return a[0] - b[0]; });
+        var sorted = order.map(function (o) { return o[0]; });
+        var out = new Int32Array(n), first = sorted[0], last = sorted[sorted.length - 1];
+        var half = sorted.length > 1 ? 0.5 * (last - first) / (sorted.length - 1) : 0.5;
+        for (var k = 0; k < n; k++) {
+            var v = lo + (k + 0.5) / n * (hi - lo);
+            if (v < first - half || v > last + half) { out[k] = -1; continue; }
+            var a = 0, b = sorted.length - 1;
+            while (b - a > 1) { var m = (a + b) >> 1; if (sorted[m] <= v) a = m; else b = m; }
+            out[k] = order[(Math.abs(v - sorted[a]) <= Math.abs(sorted[b] - v)) ? a : b][1];
+        }
+        return out;
+    }
+
+    function levelColor(levels, colors, v) {
+        if (!isFinite(v)) return null;
+        var a = 0, b = levels.length - 1;
+        if (v <= levels[0]) return colors[0];
+        if (v >= levels[b]) return colors[colors.length - 1];
+        while (b - a > 1) { var m = (a + b) >> 1; if (levels[m] <= v) a = m; else b = m; }
+        return colors[a];
+    }
+
+    function hexToRgb(hex) {
+        return [parseInt(hex.substr(1, 2), 16), parseInt(hex.substr(3, 2), 16), parseInt(hex.substr(5, 2), 16)];
+    }
+
+    // Time-height and 2D diurnal composites: one panel per dataset, shared levels
+    function drawFieldPlot(container, p) {
+        var panels = p.fields.map(function (f) {
+            return {label: f.label, visible: true, x: decode(f.x), y: decode(f.y), values: decode(f.values),
+                    nx: f.nx, ny: f.ny};
+        });
+        var colors = p.colors.map(hexToRgb);
+        function fullView() {
+            var shown = panels.filter(function (f) { return f.visible; });
+            return {x: p.xlim || finiteRange(shown.map(function (f) { return f.x; })),
+                    y: p.ylim || finiteRange(shown.map(function (f) { return f.y; }))};
+        }
+        var view = fullView();
+        var panelW = 480, panelH = 380, colorbarW = 90;
+        var canvas = document.createElement("canvas");
+        container.appendChild(canvas);
+        var axesList = [];
+
+        function draw() {
+            var shown = panels.filter(function (f) { return f.visible; });
+            var nCols = Math.min(2, Math.max(shown.length, 1)), nRows = Math.max(1, Math.ceil(shown.length / 2));
+            canvas.width = nCols * panelW + colorbarW; canvas.height = nRows * panelH + 30;
+            var ctx = canvas.getContext("2d");
+            ctx.clearRect(0, 0, canvas.width, canvas.height);
+            ctx.font = "bold 15px sans-serif"; ctx.fillStyle = "#000"; ctx.textAlign = "center"; ctx.textBaseline = "top";
+            ctx.fillText(p.title, canvas.width / 2, 5);
+            axesList = [];
+            shown.forEach(function (f, i) {
+                var box = {x: (i % 2) * panelW + MARGIN.left, y: 30 + Math.floor(i / 2) * panelH + MARGIN.top,
+                           w: panelW - MARGIN.left - MARGIN.right, h: panelH - MARGIN.top - MARGIN.bottom};
+                var axes = new Axes(ctx, box, view, p.invert_y);
+                var w = Math.round(box.w), h = Math.round(box.h);
+                var xi = nearestIndices(f.x, view.x[0], view.x[1], w);
+                var yi = nearestIndices(f.y, p.invert_y ? view.y[0] : view.y[1],
+                                        p.invert_y ? view.y[1] : view.y[0], h);
+                var image = ctx.createImageData(w, h);
+                for (var r = 0; r < h; r++) {
+                    if (yi[r] < 0) continue;
+                    for (var c = 0; c < w; c++) {
+                        if (xi[c] < 0) continue;
+                        var rgb = levelColor(p.levels, colors, f.values[xi[c] * f.ny + yi[r]]);
+                        if (!rgb) continue;
+                        var o = 4 * (r * w + c);
+                        image.data[o] = rgb[0]; image.data[o + 1] = rgb[1]; image.data[o + 2] = rgb[2];
+                        image.data[o + 3] = 255;
+                    }
+                }
+                ctx.putImageData(image, box.x, box.y);
+                axes.frame(f.label, p.xlabel, p.ylabel);
+                axesList.push(axes);
+            });
+
+            // Colorbar of the shared levels
+            var cb = {x: nCols * panelW + 10, y: 30 + MARGIN.top, w: 18, h: panelH - MARGIN.top - MARGIN.bottom};
+            var n = colors.length;
+            for (var k = 0; k < n; k++) {
+                ctx.fillStyle = "rgb(" + colors[k].join(",") + ")";
+                ctx.fillRect(cb.x, cb.y + cb.h * (1 - (k + 1) / n), cb.w, cb.h / n + 0.5);
+            }
+            ctx.strokeStyle = "#000"; ctx.strokeRect(cb.x, cb.y, cb.w, cb.h);
+            ctx.font = "11px sans-serif"; ctx.textAlign = "left"; ctx.textBaseline = "middle"; ctx.fillStyle = "#000";
+            for (var l = 0; l < p.levels.length; l += 2) {
+                ctx.fillText(formatTick(+p.levels[l].toPrecision(4)), cb.x + cb.w + 4, cb.y + cb.h * (1 - l / n));
+            }
+            ctx.textAlign = "center"; ctx.textBaseline = "top";
+            ctx.fillText(p.units, cb.x + cb.w / 2, cb.y + cb.h + 8);
+        }
+        draw();
+        addZoom(canvas,
+                function (x, y) {
+                    return axesList.filter(function (a) {
+                        return x >= a.box.x && x <= a.box.x + a.box.w && y >= a.box.y && y <= a.box.y + a.box.h;
+                    })[0];
+                },
+                function (x0, x1, y0, y1) { view = {x: [x0, x1], y: [y0, y1]}; draw(); },
+                function () { view = fullView(); draw(); });
+        addToggles(container, panels, function (i, shown) { panels[i].visible = shown; draw(); });
+    }
+
+    function drawAll() {
+        var nodes = document.querySelectorAll(".diagnostics-plot");
+        for (var i = 0; i < nodes.length; i++) {
+            var payload = diagnosticsPayloads[nodes[i].getAttribute("data-payload")];
+            if (!payload) {
+                nodes[i].textContent = "Missing plot data.";
+            } else if (payload.type === "field") {
+                drawFieldPlot(nodes[i], payload);
+            } else {
+                drawLinePlot(nodes[i], payload);
+            }
+        }
+    }
+
+    window.addEventListener("load", drawAll);
+})();